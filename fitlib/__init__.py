@@ -1,34 +1,79 @@
 from subprocess import Popen as popen, PIPE
-from os import stat, path, chdir, getcwd, close as osclose, remove, mkdir, devnull
+from os import stat, fstat, path, chdir, getcwd, remove, mkdir, makedirs, devnull, fdopen, rename, environ, urandom, listdir, utime
+from os import open as osopen, O_WRONLY, O_CREAT, O_EXCL
 from tempfile import mkstemp
-from json import load, dump
-from paths import fitMapToTree, fitTreeToMap
+from json import load
+import marshal
+from struct import Struct, error as StructError
+from binascii import hexlify, unhexlify
+from mmap import mmap, ACCESS_READ
+from manifest import manifestMagic, isManifest, readManifest, writeManifestItems, iterManifest, manifestSortKey, patchManifest, FitManifest
+import plumbing
 import re
-import platform
 from threading import Thread as thread
-from sys import stdout
+from sys import stdout, stderr, platform
+from contextlib import contextmanager
 from gzip import GzipFile as gz
 from StringIO import StringIO
+from hashlib import sha1
+from time import time
+from Queue import Queue, Empty
 
 # Below two lines prevents Python raising an exception
 # when piping output to commands like less, head that
 # can prematurely terminate the pipe. Disabling this in
 # windows since windows does not have SIGPIPE
 # https://mail.python.org/pipermail/python-list/2004-June/273297.html
-if platform.system() != "Windows":
+if platform != "win32":
     import signal
     signal.signal(signal.SIGPIPE, signal.SIG_DFL) 
 
-# Get the repo root directory if inside one, otherwise exit
-_p = popen('git rev-parse --show-toplevel'.split(), stdout=PIPE)
-repoDir = _p.communicate()[0].strip()
-if _p.returncode != 0:
-    raise Exception('Could not determine git working tree.')
+# The environment variables that change how git finds the repository. If any of
+# them is set, git itself is asked to find it.
+_gitDiscoveryEnvKeys = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_CEILING_DIRECTORIES', 'GIT_DISCOVERY_ACROSS_FILESYSTEM')
+
+_repo = []
+
+# Looks for a .git directory in the current directory and its parents, the way
+# git would in the common case. Anything else (.git files of linked worktrees
+# and submodules, running from inside a git directory) is left to git.
+def _findRepo():
+    if any(k in environ for k in _gitDiscoveryEnvKeys):
+        return None
+
+    cwd = getcwd()
+    d = cwd
+    while True:
+        candidate = path.join(d, '.git')
+        if path.isdir(candidate) and path.isfile(path.join(candidate, 'HEAD')):
+            if (cwd+'/').startswith(candidate+'/'):
+                return None
+            return d, candidate
+        elif path.exists(candidate):
+            return None
+        parent = path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+
+def _revParseRepo():
+    p = popen('git rev-parse --show-toplevel --git-dir'.split(), stdout=PIPE)
+    lines = p.communicate()[0].splitlines()
+    if p.returncode != 0 or len(lines) != 2:
+        raise Exception('Could not determine git working tree.')
+    return lines[0], path.abspath(lines[1])
+
+# Returns the (working tree, git directory) of the repository containing the
+# current directory, found once without running git where possible
+def discoverRepo():
+    if not _repo:
+        _repo.extend(_findRepo() or _revParseRepo())
+    return tuple(_repo)
 
 # Get some more directory/file paths we're interested in
+repoDir, gitDir = discoverRepo()
 selfDir = path.dirname(path.realpath(__file__))
 workingDir = getcwd()
-gitDir = popen('git rev-parse --git-dir'.split(), stdout=PIPE).communicate()[0].strip()
 fitDir = path.join(gitDir,'fit')
 fitFile = path.join(repoDir, '.fit')
 cacheDir = path.join(fitDir, 'cache')
@@ -36,15 +81,23 @@ objectsDir = path.join(cacheDir, 'objects')
 savesDir = path.join(cacheDir, 'saves')
 commitsDir = path.join(cacheDir, 'commits')
 lruFile = path.join(cacheDir, 'lru')
+cacheIndexFile = path.join(cacheDir, 'index')
 statFile = path.join(fitDir, 'stat')
 addedStatFile = path.join(fitDir, 'stat.added')
+attributesCacheFile = path.join(fitDir, 'attributes')
+binaryCacheFile = path.join(fitDir, 'binary')
+shardDepthCacheFile = path.join(fitDir, 'shardDepth')
 mergeMineFitFile = path.join(fitDir, 'merge-mine')
 mergeOtherFitFile = path.join(fitDir, 'merge-other')
 tempDir = path.join(fitDir, 'temp')
+watchDir = path.join(fitDir, 'watch')
+manifestsDir = path.join(fitDir, 'manifests')
 fitManifestItemsTempDir = path.join(fitDir, 'manifest_items_tmp')
 
 _fitFileItemRgx = re.compile('([^:]+):\[([^,]+),(\d+)\],?')
 zeroByteSha1 = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+statLogMinCompactSize = 65536
+manifestCacheSize = 16
 
 # Parameterized decorator that will wrap the decoratee with a cd into the git directory
 # before running the operation, and a cd back into the starting directory afterwards.
@@ -82,83 +135,722 @@ def gitDirOperation(arg):
 
     return wrapper if isParameterized else decorator
 
+# With GIT_FIT_TRACE_PERFORMANCE set in the environment (to 1 or true, or to an
+# absolute path to append to), the time taken by each traced phase of a command
+# is printed to stderr as it ends, in the manner of git's GIT_TRACE_PERFORMANCE
+tracePerformanceEnvKey = 'GIT_FIT_TRACE_PERFORMANCE'
+
+@contextmanager
+def tracePhase(name):
+    start = time()
+    try:
+        yield
+    finally:
+        trace = environ.get(tracePerformanceEnvKey, '')
+        if trace.lower() not in ('', '0', 'false'):
+            line = 'performance: %.6f s: git-fit %s\n'%(time()-start, name)
+            if trace.startswith('/'):
+                traceOut = open(trace, 'a')
+                traceOut.write(line)
+                traceOut.close()
+            else:
+                stderr.write(line)
+
+# Python 2's os.stat only gives float timestamps, so nanosecond timestamps are
+# only as precise as those floats are
 def fitStats(filename):
     stats = stat(filename)
-    return stats.st_size, stats.st_mtime, stats.st_ctime, stats.st_ino
+    return stats.st_size, int(stats.st_mtime*1e9), int(stats.st_ctime*1e9), stats.st_ino, stats.st_dev
+
+# A long-running git-fit server (see server.py) keeps the contents of the .fit
+# and stat files it has read, for as long as the files' stats stay the same.
+# Files changed within the last few seconds are read again every time, since
+# they could still change without their stats showing it.
+_fileMemo = {'enabled': False, 'files': {}}
+fileMemoRacyTime = 3
+
+def memoizeFiles():
+    _fileMemo['enabled'] = True
 
-def readFitFile(filePath=fitFile, rev=None):
+def _readMemoized(filePath, read):
+    if not _fileMemo['enabled']:
+        return read()
+    try:
+        stats = stat(filePath)
+    except OSError:
+        return read()
+
+    key = (stats.st_size, stats.st_mtime, stats.st_ctime, stats.st_ino, stats.st_dev)
+    memo = _fileMemo['files'].get(filePath)
+    if memo and memo[0] == key:
+        return memo[1]
+
+    value = read()
+    if time() - stats.st_mtime > fileMemoRacyTime:
+        _fileMemo['files'][filePath] = (key, value)
+    return value
+
+# Returns the items of a .fit file as a FitManifest (see manifest.py), which
+# works like a dict of paths to [hash, size]. If paths is given, only the items
+# at or under those paths (relative to the repo root) are read. Only binary
+# .fit files can be read this way without reading all of the file. The .fit
+# file of the working tree (or of rev) may be sharded (see getShardDepth), in
+# which case replaced can map the paths (relative to the repo root) of any of
+# its .fit files to other files to read instead.
+def readFitFile(filePath=fitFile, rev=None, paths=None, replaced=None):
+    if filePath == fitFile and getShardDepth():
+        return _readShardedFitFile(repoDir, getShardDepth(), rev, paths, replaced or {})
+    if replaced and '.fit' in replaced:
+        filePath = replaced['.fit']
     if rev:
-        fitDataString = _getFitDataStringForRev(rev=rev)
-        try:
-            return load(gz(None,None,None,StringIO(fitDataString)))
-        except:
-            return fitTreeToMap(_readFitFileRec(StringIO(fitDataString)))
+        return _readFitFile(filePath, rev, paths)
+    return _readFitFileMemoized(filePath, paths)
+
+def _readFitFileMemoized(filePath, paths):
+    if not _fileMemo['enabled']:
+        return _readFitFile(filePath, paths=paths)
+    # Callers are free to change what they get
+    fitData = _readMemoized(filePath, lambda: _readFitFile(filePath))
+    return fitData.copy() if paths == None else fitData.select(paths)
+
+def _selectFitPaths(fitData, paths):
+    if paths == None:
+        return fitData
+    return fitData.select(paths)
+
+def _readFitFile(filePath=fitFile, rev=None, paths=None):
+    if rev:
+        return _readFitFileForRev(rev, paths)
     elif not (path.exists(filePath) and path.getsize(filePath) > 0):
-        return {}
+        return FitManifest()
     else:
+        fitFileIn = open(filePath, 'rb')
+        if isManifest(fitFileIn.read(len(manifestMagic))):
+            buf = mmap(fitFileIn.fileno(), 0, access=ACCESS_READ)
+            fitFileIn.close()
+            try:
+                return readManifest(buf, paths)
+            finally:
+                buf.close()
+        fitFileIn.close()
+
         try:
-            return load(gz(filePath))
+            fitData = FitManifest(load(gz(filePath)))
         except:
             fitFileIn = open(filePath)
-            fitData = fitTreeToMap(_readFitFileRec(fitFileIn))
+            fitData = FitManifest(_iterFitFileText(fitFileIn))
             fitFileIn.close()
-            return fitData
+    return _selectFitPaths(fitData, paths)
     
-def _readFitFileRec(fitFileIn):
-    items = {}
+# The .fit files of past revisions are parsed once and kept in manifestsDir,
+# named by the hash of their blob, so that reading one again only takes a git
+# rev-parse. Binary ones are kept as they are (they are read from in place),
+# others as the marshaled state of their FitManifest. Only the keep (by default
+# manifestCacheSize) most recently used are kept.
+def _readFitFileForRev(rev, paths):
+    return _readFitBlob(_getFitBlobForRev(rev), paths)
+
+def _readFitBlob(blob, paths, keep=manifestCacheSize):
+    if not blob:
+        return FitManifest()
+
+    cachedPath = path.join(manifestsDir, blob)
+    if path.exists(cachedPath):
+        try:
+            utime(cachedPath, None)
+            cachedIn = open(cachedPath, 'rb')
+            try:
+                if isManifest(cachedIn.read(len(manifestMagic))):
+                    return _readFitFile(cachedPath, paths=paths)
+                cachedIn.seek(0)
+                return _selectFitPaths(FitManifest.fromState(marshal.load(cachedIn)), paths)
+            finally:
+                cachedIn.close()
+        except (OSError, IOError, EOFError, ValueError, TypeError):
+            # Parse it again below, and replace what was there
+            pass
+
+    fitDataString = _getFitDataStringForBlob(blob)
+    if isManifest(fitDataString):
+        _cacheParsedManifest(blob, fitDataString, keep)
+        return readManifest(fitDataString, paths)
+    try:
+        fitData = FitManifest(load(gz(None,None,None,StringIO(fitDataString))))
+    except:
+        fitData = FitManifest(_iterFitFileText(StringIO(fitDataString)))
+    _cacheParsedManifest(blob, marshal.dumps(fitData.getState()), keep)
+    return _selectFitPaths(fitData, paths)
+
+def _cacheParsedManifest(blob, data, keep=manifestCacheSize):
+    if not path.exists(manifestsDir):
+        mkdir(manifestsDir)
+    handle, tempPath = mkstemp(dir=manifestsDir, prefix='.')
+    cachedOut = fdopen(handle, 'wb')
+    cachedOut.write(data)
+    cachedOut.close()
+    rename(tempPath, path.join(manifestsDir, blob))
+
+    cached = [path.join(manifestsDir, f) for f in listdir(manifestsDir) if not f.startswith('.')]
+    if len(cached) > keep:
+        for f in sorted(cached, key=path.getmtime)[:-keep]:
+            try:
+                remove(f)
+            except OSError:
+                pass
+
+# Yields the (path, [hash, size]) items of a text .fit file in the order they
+# are in the file
+def _iterFitFileText(fitFileIn):
+    openDirs = []
+    prefix = ''
     for l in fitFileIn:
         l = l.strip()
         if l.endswith('{'):
-            items[l.split(':')[0]] = _readFitFileRec(fitFileIn)
-        elif l in ('}', '},') :
-            break
+            openDirs.append(l.split(':')[0])
+            prefix = '/'.join(openDirs)+'/'
+        elif l in ('}', '},'):
+            openDirs.pop()
+            prefix = '/'.join(openDirs)+'/' if openDirs else ''
         else:
-            parts = list(_fitFileItemRgx.match(l).groups())
-            items[parts[0]] = [parts[1], int(parts[2])]
-    return items
+            name, h, size = _fitFileItemRgx.match(l).groups()
+            yield prefix+name, [h, int(size)]
 
-def writeFitFile(fitData, filePath=fitFile):
-    fitFileOut = open(filePath, 'wb')
-    _writeFitFileRec(fitFileOut, fitMapToTree(fitData))
-    fitFileOut.close()
-
-def _dictItemComparator(a,b):
-    if type(a[1]) == type(b[1]):
-        return -1 if a[0] < b[0] else (1 if a[0] > b[0] else 0)
-    if type(a[1]) == type({}):
-        return 1
-    return -1
-
-def _writeFitFileRec(fitFileOut, fitData):
-    if len(fitData) == 0:
+# Yields the items of a .fit file in sortKey order (fitSortKey or
+# manifestSortKey). They come straight from the file if it is in the format
+# that is written in that order; otherwise the file is read whole and sorted.
+# The order of the items of a text file is as they were written, which can be
+# checked against sortKey as they come if the file may have been edited.
+def iterFitFile(filePath, sortKey):
+    if not (path.exists(filePath) and path.getsize(filePath) > 0):
+        return
+
+    fitFileIn = open(filePath, 'rb')
+    try:
+        head = fitFileIn.read(len(manifestMagic))
+        if isManifest(head) and sortKey == manifestSortKey:
+            buf = mmap(fitFileIn.fileno(), 0, access=ACCESS_READ)
+            try:
+                for i in iterManifest(buf):
+                    yield i
+            finally:
+                buf.close()
+            return
+        if not isManifest(head) and not head.startswith('\x1f\x8b') and sortKey == fitSortKey:
+            fitFileIn.seek(0)
+            for i in _iterFitFileText(fitFileIn):
+                yield i
+            return
+    finally:
+        fitFileIn.close()
+
+    for i in sorted(readFitFile(filePath).iteritems(), key=lambda i: sortKey(i[0])):
+        yield i
+
+# The format .fit files are written in, set through the fit.manifest.format git
+# config key: "text" (the nested text format) or "binary" (see manifest.py).
+# Both are always read.
+manifestFormats = ('text', 'binary')
+defaultManifestFormat = 'text'
+
+_configMemo = {}
+
+def getManifestFormat():
+    if 'manifestFormat' not in _configMemo:
+        manifestFormat = getGitConfig('fit.manifest.format', defaultManifestFormat)
+        if manifestFormat not in manifestFormats:
+            print 'warning: Ignoring unknown fit.manifest.format in git config: %s'%manifestFormat
+            manifestFormat = defaultManifestFormat
+        _configMemo['manifestFormat'] = manifestFormat
+    return _configMemo['manifestFormat']
+
+# If given, changed are the only paths whose values differ from those in the
+# file at filePath (no paths were added or removed). When all of them can be
+# updated in place (see _patchFitFile), the rest of the file isn't rewritten.
+# If given, touched are the only paths that may have been changed, added or
+# removed at all, so that only the .fit files they are in need writing when
+# the working tree's .fit file is sharded (see getShardDepth).
+def writeFitFile(fitData, filePath=fitFile, changed=None, touched=None):
+    if filePath == fitFile:
+        _removeUnusedFitFiles()
+    if filePath == fitFile and getShardDepth():
+        _writeShardedFitFile(fitData, repoDir, getShardDepth(), changed, touched)
+    else:
+        _writeFitFile(fitData, filePath, changed)
+
+def _writeFitFile(fitData, filePath, changed=None):
+    if changed and path.exists(filePath) and _patchFitFile(fitData, filePath, changed):
         return
 
-    items = sorted(fitData.iteritems(), cmp=_dictItemComparator)
-    for k,v in items[:-1]:
-        _writeFitFileItem(fitFileOut, k, v)
-    k,v = items[-1]
-    _writeFitFileItem(fitFileOut, k, v, sep='')
-
-def _writeFitFileItem(fitFileOut, k,v, sep=','):
-    if type(v) == type({}):
-        print >>fitFileOut, '%s:{'%k
-        _writeFitFileRec(fitFileOut, v)
-        print >>fitFileOut, '}'+sep
+    sortKey = getFitItemSortKey()
+    writeFitItems(sorted(fitData.iteritems(), key=lambda i: sortKey(i[0])), filePath)
+
+# With fit.manifest.shardDepth set to a number of directory levels, the items
+# of the working tree are kept in a .fit file in each directory at that depth
+# with items under it (which has their paths relative to that directory),
+# rather than all in the .fit file at the top of the working tree. That one
+# then only keeps the items above that depth, and is always there. The .fit
+# files are read as one, only those under the paths a command is given, and
+# only those with changes are written. Each is merged on its own by the merge
+# driver. .fit files at smaller depths (left from a smaller setting) are read
+# too, and replaced by the next save. Where the setting is not set (e.g. in a
+# clone), the depth is that of the deepest .fit file git tracks. The merge
+# driver is told the path of the .fit file it merges (%P) to keep the conflicts
+# of each apart (see setUpGitIntegration in git-fit).
+defaultShardDepth = 0
+
+def getShardDepth():
+    if 'shardDepth' not in _configMemo:
+        shardDepth = getGitConfig('fit.manifest.shardDepth', valueType='int')
+        try:
+            shardDepth = max(0, int(shardDepth)) if shardDepth != None else _getTrackedShardDepth()
+        except ValueError:
+            print 'warning: Ignoring invalid fit.manifest.shardDepth value in git config.'
+            shardDepth = defaultShardDepth
+        _configMemo['shardDepth'] = shardDepth
+    return _configMemo['shardDepth']
+
+# The depth found is cached along with the stats of the index it was found in.
+# Like _readMemoized, an index changed within the last few seconds could still
+# change without its stats showing it, so the depth found in it isn't cached.
+def _getTrackedShardDepth():
+    try:
+        indexStats = stat(environ.get('GIT_INDEX_FILE') or path.join(gitDir, 'index'))
+    except OSError:
+        return defaultShardDepth
+    key = (indexStats.st_size, indexStats.st_mtime, indexStats.st_ctime, indexStats.st_ino, indexStats.st_dev)
+    try:
+        cachedKey, depth = marshal.load(open(shardDepthCacheFile, 'rb'))
+        if cachedKey == key:
+            return depth
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    tracked = popen('git ls-files -z -- */.fit'.split(), stdout=PIPE, cwd=repoDir).communicate()[0].split('\0')
+    depth = max([p.count('/') for p in tracked if p] or [defaultShardDepth])
+    if time() - indexStats.st_mtime > fileMemoRacyTime and path.isdir(fitDir):
+        cacheOut = open(shardDepthCacheFile+'.tmp', 'wb')
+        marshal.dump((key, depth), cacheOut)
+        cacheOut.close()
+        rename(shardDepthCacheFile+'.tmp', shardDepthCacheFile)
+    return depth
+
+# Returns the directory (relative to the repo root) of the .fit file that item
+# p is kept in, '' being the top of the working tree
+def _getShardDir(p, depth):
+    parts = p.split('/', depth)
+    return '/'.join(parts[:depth]) if len(parts) > depth else ''
+
+def _getShardFile(root, d):
+    return path.join(root, d, '.fit') if d else path.join(root, '.fit')
+
+# Returns the paths of the items under the paths (relative to the repo root)
+# that are in the .fit file of directory d, relative to d
+def _getShardPaths(d, paths):
+    if paths == None or not d:
+        return paths
+    shardPaths = []
+    for p in paths:
+        if not p or p == d or d.startswith(p+'/'):
+            return None
+        if p.startswith(d+'/'):
+            shardPaths.append(p[len(d)+1:])
+    return shardPaths
+
+# Returns [(directory, fit file)] for the .fit files below the top that can have
+# items at or under the given paths (or all of them), down to depth levels.
+# listDirs(d) lists the subdirectories of d, and getFitFile(d) returns what to
+# read the .fit file of d from (a path or blob hash), or nothing if it has none.
+def _findShards(depth, paths, listDirs, getFitFile):
+    shards = {}
+    def look(dirs):
+        for d in dirs:
+            if d not in shards:
+                shards[d] = getFitFile(d)
+
+    for p in ([''] if paths == None else paths):
+        parts = p.split('/') if p else []
+        look('/'.join(parts[:n]) for n in xrange(1, min(len(parts), depth)+1))
+        level = [p]
+        for n in xrange(len(parts), depth):
+            level = [d+'/'+name if d else name for d in level for name in listDirs(d)]
+            look(level)
+    return sorted((d,f) for d,f in shards.iteritems() if f)
+
+def _listWorkingDirs(root, d):
+    try:
+        names = listdir(path.join(root, d))
+    except OSError:
+        return []
+    isDir = lambda p: path.isdir(p) and not path.islink(p)
+    return [n for n in names if (d or n != '.git') and isDir(path.join(root, d, n))]
+
+def _findWorkingShards(root, depth, paths=None, replaced={}):
+    def getFitFile(d):
+        f = path.join(root, replaced[d+'/.fit']) if d+'/.fit' in replaced else _getShardFile(root, d)
+        return f if path.isfile(f) else None
+    return _findShards(depth, paths, lambda d: _listWorkingDirs(root, d), getFitFile)
+
+def _findShardsForRev(rev, depth, paths=None):
+    listDirs = lambda d: [n for m,n,h in plumbing.listTree('%s:%s'%(rev, d)) or () if m == '40000']
+    return _findShards(depth, paths, listDirs, lambda d: _getFitBlobForRev(rev, d))
+
+def _readShardedFitFile(root, depth, rev=None, paths=None, replaced={}):
+    if rev:
+        shards = [('', _getFitBlobForRev(rev))] + _findShardsForRev(rev, depth, paths)
+        read = lambda blob, shardPaths: _readFitBlob(blob, shardPaths, manifestCacheSize*len(shards))
     else:
-        print >>fitFileOut, ('%s:[%s,%s]'+sep)%(k,v[0],v[1])
+        topFile = path.join(root, replaced.get('.fit', '.fit'))
+        shards = [('', topFile if path.isfile(topFile) else None)] + _findWorkingShards(root, depth, paths, replaced)
+        read = _readFitFileMemoized
+
+    parts = []
+    for d,f in shards:
+        shardPaths = _getShardPaths(d, paths)
+        if f and shardPaths != []:
+            parts.append((d, read(f, shardPaths)))
+    return FitManifest.fromParts(parts)
+
+# Whether the .fit files are not all where the configured depth puts them
+def _isShardLayoutStale(root, depth, shards):
+    if any(d.count('/')+1 != depth for d,f in shards):
+        return True
+    return any(_getShardDir(p, depth) for p in _readFitFile(_getShardFile(root, '')))
+
+def isFitFileLayoutStale():
+    shardDepth = getShardDepth()
+    if _getUnusedFitFiles():
+        return True
+    return bool(shardDepth) and _isShardLayoutStale(repoDir, shardDepth, _findWorkingShards(repoDir, shardDepth))
+
+# The .fit files git tracks below the configured depth (left from a greater
+# one, or from sharding before it was turned off), which are removed with the
+# next write, so that clones don't take the layout to be deeper than it is
+@gitDirOperation(repoDir)
+def _getUnusedFitFiles():
+    tracked = popen('git ls-files -z -- */.fit'.split(), stdout=PIPE).communicate()[0].split('\0')
+    return [p for p in tracked if p.count('/') > getShardDepth()]
+
+@gitDirOperation(repoDir)
+def _removeUnusedFitFiles():
+    unused = _getUnusedFitFiles()
+    if unused:
+        popen('git rm -q -f --ignore-unmatch --'.split() + unused).wait()
+
+def _writeShardedFitFile(fitData, root, depth, changed=None, touched=None):
+    if not isinstance(fitData, FitManifest):
+        fitData = FitManifest(fitData)
+    topFile = _getShardFile(root, '')
+
+    shards = _findWorkingShards(root, depth)
+    if touched == None or _isShardLayoutStale(root, depth, shards):
+        # All of them are written, and any not in the configured layout removed
+        dirs = {_getShardDir(p, depth) for p in fitData} | {''}
+        for d,f in shards:
+            if d not in dirs:
+                remove(f)
+        changed = None
+    else:
+        dirs = {_getShardDir(p, depth) for p in touched}
+        if not path.exists(topFile):
+            dirs.add('')
+
+    for d in dirs:
+        shardFile = _getShardFile(root, d)
+        if d:
+            shardData = {p[len(d)+1:]:v for p,v in fitData.select([d]).iteritems()}
+        else:
+            shardData = {p:v for p,v in fitData.iteritems() if not _getShardDir(p, depth)}
+        shardChanged = changed and {p[len(d)+1:] if d else p for p in changed if _getShardDir(p, depth) == d}
+
+        if d and not shardData:
+            if path.exists(shardFile):
+                remove(shardFile)
+        else:
+            if not path.isdir(path.dirname(shardFile)):
+                makedirs(path.dirname(shardFile))
+            _writeFitFile(shardData, shardFile, shardChanged)
+
+# The order writeFitItems takes items in, for the configured format
+def getFitItemSortKey():
+    return manifestSortKey if getManifestFormat() == 'binary' else fitSortKey
+
+# Writes the (path, [hash, size]) items, which must be in getFitItemSortKey()
+# order, as they come
+def writeFitItems(items, filePath=fitFile):
+    fitFileOut = open(filePath, 'wb')
+    try:
+        if getManifestFormat() == 'binary':
+            writeManifestItems(fitFileOut, items)
+        else:
+            _writeFitItemsText(fitFileOut, items)
+    finally:
+        fitFileOut.close()
+
+# The order of items in the text format: at each level of the tree, the items
+# (sorted by name) come before the directories (sorted by name). The key is a
+# string that sorts the same way, with each directory name marked by a \2 and
+# the item name by a \1, separated by \0 (which sorts before any name character).
+def fitSortKey(p):
+    d, sep, name = p.rpartition('/')
+    if not sep:
+        return '\1'+name
+    return '\2'+d.replace('/', '\0\2')+'\0\1'+name
+
+# Writes the nested text format in one pass over the items in fitSortKey order,
+# opening and closing directories as the paths go into and out of them. An item
+# or directory is followed by a comma unless it is the last one at its level,
+# i.e. unless the next path is outside of its parent directory.
+def _writeFitItemsText(fitFileOut, items):
+    within = lambda d, parent: d != None and (not parent or (d+'/').startswith(parent+'/'))
+    items = iter(items)
+
+    lines = []
+    openDirs = []
+    openDir = ''
+    following = next(items, None)
+    nextDir = following[0].rpartition('/')[0] if following else None
+    while following:
+        p, (h, s) = following
+        d, name = nextDir, p[len(nextDir)+1 if nextDir else 0:]
+        if d != openDir:
+            for n in d.split('/')[len(openDirs):]:
+                lines.append('%s:{\n'%n)
+                openDirs.append(n)
+            openDir = d
+
+        following = next(items, None)
+        nextDir = following[0].rpartition('/')[0] if following else None
+        if nextDir == d:
+            lines.append('%s:[%s,%s],\n'%(name, h, s))
+        else:
+            lines.append('%s:[%s,%s]%s\n'%(name, h, s, ',' if within(nextDir, d) else ''))
+            while openDirs and not within(nextDir, openDir):
+                openDirs.pop()
+                openDir = '/'.join(openDirs)
+                lines.append('}%s\n'%(',' if within(nextDir, openDir) else ''))
+
+        if len(lines) >= 4096:
+            fitFileOut.write(''.join(lines))
+            lines = []
+
+    fitFileOut.write(''.join(lines))
+
+_fitFileValueRgx = re.compile('[^:]+:\[([^,]+),(\d+)\]')
+
+# Finds where the values of the changed paths are in a text .fit file, without
+# building anything but the current directory path
+def _getTextPatches(data, fitData, changed):
+    patches = []
+    openDirs = []
+    offset = 0
+    for l in data.splitlines(True):
+        s = l.strip()
+        if s.endswith('{'):
+            openDirs.append(s.split(':')[0])
+        elif s in ('}', '},'):
+            openDirs.pop()
+        else:
+            m = _fitFileValueRgx.match(l)
+            p = '/'.join(openDirs + [l[:l.index(':')]])
+            if p in changed:
+                h, size = fitData[p]
+                value = '%s,%s'%(h, size)
+                if len(value) != m.end(2) - m.start(1):
+                    return None
+                patches.append((offset + m.start(1), value))
+        offset += len(l)
+    return patches
+
+# Updates the values of the changed paths where they are in the file, if the
+# file is in the configured format and each new value takes up exactly as many
+# bytes as the old one (always so for the binary format). Returns whether the
+# file was patched.
+def _patchFitFile(fitData, filePath, changed):
+    fitFileIn = open(filePath, 'r+b')
+    try:
+        binary = isManifest(fitFileIn.read(len(manifestMagic)))
+        if binary != (getManifestFormat() == 'binary'):
+            return False
+
+        if binary:
+            buf = mmap(fitFileIn.fileno(), 0)
+            try:
+                return patchManifest(buf, fitData, changed)
+            finally:
+                buf.close()
+
+        fitFileIn.seek(0)
+        patches = _getTextPatches(fitFileIn.read(), fitData, changed)
+        if patches == None or len(patches) != len(changed):
+            return False
+        for offset, value in patches:
+            fitFileIn.seek(offset)
+            fitFileIn.write(value)
+        return True
+    finally:
+        fitFileIn.close()
 
 def printAsText(fitData):
     items = sorted([(b[:7],a) for a,(b,c) in  fitData.iteritems()], key=lambda i:i[1])
     print '\n'.join(['%s %s'%(h,p) for h,p in items])
 
-# The stat file is a Python-pickled dictionary of the following form:
-#   {filename --> (st_size, st_mtime, st_ctime, st_ino, checksum_hash)}
-def readStatFile(filePath=statFile):
-    return load(open(filePath)) if path.exists(filePath) else {}
+# The stat file caches the hash and stats of every item, so that only items
+# whose stats changed need to be hashed again:
+#   {filename --> (checksum_hash, (st_size, st_mtime_ns, st_ctime_ns, st_ino, st_dev))}
+# (a hash of 0 marks an item restored as an empty stub). It is stored as a header,
+# fixed-size binary records sorted by filename, an index of the offsets of those
+# records, and a log of records appended by later updates, which take precedence
+# over earlier records for the same filename (and may mark it deleted). The
+# sorted records and their index allow looking up a few items by binary search
+# in an mmap of the file without loading it all. The log is folded back into the
+# sorted records once it grows past a fraction of the file.
+#
+# Like git's index, the stat file guards against "racily clean" items: an item
+# modified within the timestamp granularity of the file system right after its
+# stats were cached could keep the same stats. So, as git does, records of items
+# whose mtime is not older than the time they are written at are written with a
+# size of 0, which no item's stats match, forcing that item to be hashed again.
+_statMagic = 'FITSTAT1'
+_statHeader = Struct('<8sQQ')           # magic, number of sorted records, offset of the log
+_statRecord = Struct('<B20sQqqQQH')     # flags, hash, size, mtime, ctime, inode, device, filename length
+_statOffset = Struct('<Q')
+_statDeleted = 1
+_statNoHash = 2
+_statNullHash = '\0'*20
+
+def _packStatRecord(filename, h, stats, racyTime, flags=0):
+    flags |= 0 if h else _statNoHash
+    if stats[1] >= racyTime:
+        stats = (0,)+stats[1:]
+    return _statRecord.pack(flags, unhexlify(h) if h else _statNullHash, *stats+(len(filename),)) + filename
+
+def _unpackStatRecord(buf, offset):
+    flags, h, size, mtime, ctime, ino, dev, n = _statRecord.unpack_from(buf, offset)
+    offset += _statRecord.size
+    filename = buf[offset:offset+n]
+    if len(filename) != n:
+        raise EOFError()
+    return offset+n, filename, flags, (0 if flags & _statNoHash else hexlify(h), (size, mtime, ctime, ino, dev))
+
+def _openStatFile(filePath):
+    if not (path.exists(filePath) and path.getsize(filePath) >= _statHeader.size):
+        return None
+    statIn = open(filePath, 'rb')
+    buf = mmap(statIn.fileno(), 0, access=ACCESS_READ)
+    statIn.close()
+    magic, count, logOffset = _statHeader.unpack_from(buf, 0)
+    if magic != _statMagic:
+        # Stat files of older versions of git-fit are simply discarded
+        buf.close()
+        return None
+    return buf, count, logOffset
+
+def _readStatLog(buf, logOffset):
+    offset = logOffset
+    try:
+        while offset < len(buf):
+            offset, filename, flags, value = _unpackStatRecord(buf, offset)
+            yield filename, flags, value
+    except (EOFError, StructError):
+        # A torn record at the end of the log, from an interrupted update
+        pass
+
+def _findStatRecord(buf, count, logOffset, filename):
+    indexOffset = logOffset - count*_statOffset.size
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo+hi)//2
+        offset, name, flags, value = _unpackStatRecord(buf, _statOffset.unpack_from(buf, indexOffset+mid*_statOffset.size)[0])
+        if name == filename:
+            return value
+        elif name < filename:
+            lo = mid+1
+        else:
+            hi = mid
+    return None
+
+# If items is given, only the stats for those items are looked up
+def readStatFile(filePath=statFile, items=None):
+    if items == None and _fileMemo['enabled']:
+        return dict(_readMemoized(filePath, lambda: _readStatFile(filePath)))
+    return _readStatFile(filePath, items)
+
+def _readStatFile(filePath=statFile, items=None):
+    opened = _openStatFile(filePath)
+    if not opened:
+        return {}
+    buf, count, logOffset = opened
+
+    stats = {}
+    if items == None:
+        offset = _statHeader.size
+        for i in xrange(count):
+            offset, filename, flags, value = _unpackStatRecord(buf, offset)
+            stats[filename] = value
+    else:
+        for i in items:
+            value = _findStatRecord(buf, count, logOffset, i)
+            if value:
+                stats[i] = value
+
+    for filename, flags, value in _readStatLog(buf, logOffset):
+        if items != None and filename not in items:
+            continue
+        if flags & _statDeleted:
+            stats.pop(filename, None)
+        else:
+            stats[filename] = value
+
+    buf.close()
+    return stats
+
+# Returns the time (as the file system has it) that records written to the
+# opened stat file count as written at
+def _getStatRacyTime(statOut):
+    utime(statOut.name, None)
+    return int(fstat(statOut.fileno()).st_mtime*1e9)
 
 def writeStatFile(stats, filePath=statFile):
-    statOut = open(filePath, 'wb')
-    dump(stats, statOut)
+    tempFilePath = filePath+'.tmp'
+    statOut = open(tempFilePath, 'wb')
+    racyTime = _getStatRacyTime(statOut)
+    records = [_packStatRecord(filename, h, tuple(s), racyTime) for filename,(h,s) in sorted(stats.iteritems())]
+    offsets = []
+    offset = _statHeader.size
+    for r in records:
+        offsets.append(offset)
+        offset += len(r)
+    statOut.write(_statHeader.pack(_statMagic, len(records), offset+len(offsets)*_statOffset.size))
+    statOut.write(''.join(records))
+    statOut.write(''.join(_statOffset.pack(o) for o in offsets))
+    statOut.close()
+    rename(tempFilePath, filePath)
+
+# Records updated stats for some items (and the removal of others) by appending
+# to the log of the stat file, or by rewriting it if the log has grown too long.
+def updateStatFile(updates, removals=(), filePath=statFile):
+    if not (updates or removals):
+        return
+
+    opened = _openStatFile(filePath)
+    if opened:
+        buf, count, logOffset = opened
+        fileSize = len(buf)
+        buf.close()
+
+    if not opened or fileSize - logOffset > max(logOffset/4, statLogMinCompactSize):
+        stats = readStatFile(filePath=filePath)
+        stats.update(updates)
+        for i in removals:
+            stats.pop(i, None)
+        writeStatFile(stats, filePath=filePath)
+        return
+
+    statOut = open(filePath, 'ab')
+    racyTime = _getStatRacyTime(statOut)
+    records = [_packStatRecord(i, h, tuple(s), racyTime) for i,(h,s) in updates.iteritems()]
+    records += [_packStatRecord(i, 0, (0,0,0,0,0), racyTime, flags=_statDeleted) for i in removals]
+    statOut.write(''.join(records))
     statOut.close()
 
 def _gitHashInputProducer(stream, items):
@@ -167,40 +859,171 @@ def _gitHashInputProducer(stream, items):
         stream.flush()
     stream.close()
 
+hashChunkSize = 1048576
+
+# Computes the same SHA-1 that git hash-object gives for the file (that of the
+# "blob <size>\0" header followed by the file's contents), reading the file in
+# bounded chunks. If an out stream is given, the contents are also written to
+# it as they are read, so a copy of the file costs no extra read.
+def hashFile(filePath, out=None):
+    fileIn = open(filePath, 'rb')
+    try:
+        h = sha1('blob %d\0'%fstat(fileIn.fileno()).st_size)
+        for chunk in iter(lambda: fileIn.read(hashChunkSize), ''):
+            h.update(chunk)
+            if out:
+                out.write(chunk)
+    finally:
+        fileIn.close()
+    return h.hexdigest()
+
+# Returns the subset of items whose contents git would convert before hashing
+# (line endings, clean filters, ident), which must be hashed by git itself
+# for the hashes to come out the same.
+def _getConvertedItems(items):
+    if getGitConfig('core.autocrlf', 'false') in ('true', 'input'):
+        return set(items)
+
+    return {p for p,a,v in plumbing.checkAttr(items, ('filter', 'text', 'eol', 'ident')) if v not in ('unspecified', 'unset')}
+
+def _createStagingFile():
+    filePath = path.join(tempDir, 'staged-'+hexlify(urandom(16)))
+    return fdopen(osopen(filePath, O_WRONLY | O_CREAT | O_EXCL, 0666), 'wb'), filePath
+
+def getHashJobs():
+    # multiprocessing is slow to import, and only needed here
+    from multiprocessing import cpu_count
+    try:
+        return max(1, int(getGitConfig('fit.hash.jobs', cpu_count(), valueType='int')))
+    except ValueError:
+        return cpu_count()
+
+# Hashes items off the work queue in-process until it is empty, putting
+# (index, hash, staged copy, error) tuples on the results queue. hashlib
+# releases the GIL while hashing large buffers (as does reading a file), so
+# several of these threads keep several cores busy. An item with an expected
+# hash is only staged (read again, likely from the page cache) if it turns out
+# to have changed.
+def _hashWorker(work, results, stage):
+    while True:
+        try:
+            n, item, expected = work.get_nowait()
+        except Empty:
+            return
+        try:
+            if not stage or expected:
+                h = hashFile(item)
+                if not stage or h == expected:
+                    results.put((n, h, None, None))
+                    continue
+            stagingFile, stagedPath = _createStagingFile()
+            try:
+                try:
+                    h = hashFile(item, out=stagingFile)
+                finally:
+                    stagingFile.close()
+            except Exception:
+                remove(stagedPath)
+                raise
+            results.put((n, h, stagedPath, None))
+        except Exception as e:
+            results.put((n, None, None, e))
+
+# Hashes the given (index, item) pairs with one git hash-object process: the
+# long-lived one if pooled (see plumbing), or one of its own
+def _gitHashWorker(items, results, pooled=False):
+    if pooled:
+        try:
+            hashes = plumbing.hashObjects(item for n,item in items)
+        except Exception as e:
+            hashes = [None]*len(items)
+        for (n,item),h in zip(items, hashes):
+            results.put((n, h, None, None) if h else (n, None, None, Exception('error: git could not hash %s'%item)))
+        return
+
+    p = popen('git hash-object --stdin-paths'.split(), stdin=PIPE, stdout=PIPE)
+    thread(target=_gitHashInputProducer, args=(p.stdin,[item for n,item in items])).start()
+    lines = iter(p.stdout)
+    for n,item in items:
+        l = next(lines, None)
+        results.put((n, l.strip(), None, None) if l else (n, None, None, Exception('error: git could not hash %s'%item)))
+    p.wait()
+
+# Items are hashed by fit.hash.jobs worker threads (by default one per CPU),
+# in-process or, for items git would convert, through as many git hash-object
+# processes. The hashes are returned in the same order as items.
+# If a staged dict is given, every item hashed in-process is also copied to a
+# new file in the temp directory while it is being hashed, and staged maps the
+# item to that copy (for cache.insert to move into place later). Items that
+# still have the hashes expected maps them to are not copied.
 @gitDirOperation(repoDir)
-def computeHashes(items):
+def computeHashes(items, staged=None, expected={}):
     if not items:
         return []
 
-    hashes = []
+    hashes = [None]*len(items)
     numItems = len(items)
     numDigits = str(len(str(numItems)+''))
     progress_fmt = ('\rComputing hashes for new objects...%6.2f%%  '+'%'+numDigits+'s/%'+numDigits+'s')
     print progress_fmt%(0, 0, numItems),
-    p = popen('git hash-object --stdin-paths'.split(), stdin=PIPE, stdout=PIPE)
-    thread(target=_gitHashInputProducer, args=(p.stdin,items)).start()
-    i = 0
-    for l in p.stdout:
-        hashes.append(l.strip())
-        i += 1
-        print progress_fmt%(i*100./numItems, i, numItems),
+
+    if staged != None and not path.exists(tempDir):
+        mkdir(tempDir)
+
+    jobs = getHashJobs()
+    converted = _getConvertedItems(items)
+    work = Queue()
+    results = Queue()
+    for n,item in enumerate(items):
+        if item not in converted:
+            work.put((n, item, expected.get(item)))
+    gitItems = [(n, item) for n,item in enumerate(items) if item in converted]
+
+    workers = [thread(target=_hashWorker, args=(work, results, staged != None)) for j in xrange(min(jobs, work.qsize()))]
+    workers += [thread(target=_gitHashWorker, args=(gitItems[j::jobs], results, j == 0)) for j in xrange(min(jobs, len(gitItems)))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    error = None
+    for i in xrange(numItems):
+        # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+        while True:
+            try:
+                n, h, stagedPath, e = results.get(True, 0.5)
+                break
+            except Empty:
+                pass
+        hashes[n] = h
+        error = error or e
+        if stagedPath:
+            staged[items[n]] = stagedPath
+        print progress_fmt%((i+1)*100./numItems, i+1, numItems),
         stdout.flush()
+
     print '\r'+(' '*(45+int(numDigits)*2))+'\r',
+    if error:
+        raise error
     return hashes
 
 @gitDirOperation(repoDir)
 def refreshStats(items, filePath=statFile):
-    stats = readStatFile(filePath=filePath)
-    for i in items:
-        stats[i] = (items[i], fitStats(i))
-    writeStatFile(stats, filePath=filePath)
+    updateStatFile({i: (items[i], fitStats(i)) for i in items}, filePath=filePath)
 
 @gitDirOperation(repoDir)
-def updateStats(items, filePath=statFile):
-    oldStats = readStatFile(filePath=filePath)
+# unchanged, if given, tells which items are known not to have changed since the
+# stat cache was last updated, so that they don't need to be stat'ed again. Racily
+# clean entries (whose size reads as 0) are always stat'ed. Unless scoped (items
+# are only those under some paths), the cached stats of all other items are dropped.
+# expected maps items to the hashes they are tracked with, which need no staging.
+def updateStats(items, filePath=statFile, staged=None, unchanged=None, scoped=False, expected={}):
+    oldStats = readStatFile(filePath=filePath, items=set(items) if scoped else None)
     newStats = {}
     stubs = []
     for i in items:
+        if unchanged and i in oldStats and oldStats[i][1][0] > 0 and unchanged(i):
+            newStats[i] = tuple(oldStats[i][1])
+            continue
         stats = fitStats(i)
         if stats[0] > 0:
             newStats[i] = stats
@@ -212,23 +1035,21 @@ def updateStats(items, filePath=statFile):
     # be considered "modified". Modified items are those that are touched
     # AND whose checksums are different, so we do checksum comparisons next
     touched = [i for i,s in newStats.iteritems() if i not in oldStats or tuple(oldStats[i][1]) != s]
-    touched = dict(zip(touched, computeHashes(touched)))
-
-    statsUpdated = False
-    if len(touched) > 0:
-        statsUpdated = True
-        for i,h in touched.iteritems():
-            oldStats[i] = (h,newStats[i])
-    if len(newStats) != len(oldStats):
-        statsUpdated = True
-        for s in set(oldStats) - set(newStats):
-            del oldStats[s]
-    if statsUpdated:
-        writeStatFile(oldStats, filePath=filePath)
+    touched = dict(zip(touched, computeHashes(touched, staged=staged, expected=expected)))
+
+    updates = {}
+    for i,h in touched.iteritems():
+        updates[i] = oldStats[i] = (h,newStats[i])
+    removals = set(oldStats) - set(newStats)
+    for s in removals:
+        del oldStats[s]
+    updateStatFile(updates, removals, filePath=filePath)
 
     return oldStats, stubs
 
 def getFitSize(fitTrackedData):
+    if isinstance(fitTrackedData, FitManifest):
+        return fitTrackedData.getTotalSize()
     return sum(int(s) for p,(h,s) in fitTrackedData.iteritems())
 
 def getCommitFile(rev=None):
@@ -236,16 +1057,43 @@ def getCommitFile(rev=None):
         mkdir(commitsDir)
     return path.join(commitsDir, rev or getHashForRevision() or '---')
 
+# valueType can be 'int' or 'bool' to have git validate and normalize the
+# value (e.g. expanding 'k', 'm', 'g' suffixes of integers)
+def getGitConfig(key, default=None, valueType=None):
+    cmd = ['git', 'config'] + (['--'+valueType] if valueType else []) + [key]
+    value = popen(cmd, stdout=PIPE).communicate()[0].strip()
+    return value or default
+
+# Revisions and blobs are looked up through the long-lived git cat-file
+# processes (see plumbing). Missing ones come out as ''.
 def getHashForRevision(rev='HEAD'):
-    return popen(('git rev-parse %s'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
+    info = plumbing.getObjectInfo(rev)
+    return info[0] if info else ''
 
-@gitDirOperation(repoDir)
-def _getFitDataStringForRev(rev):
-    return popen(('git show %s:.fit'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0]
+# The blob of the .fit file of directory d (the top, by default) in rev
+def _getFitBlobForRev(rev, d=''):
+    info = plumbing.getObjectInfo('%s:%s'%(rev, d+'/.fit' if d else '.fit'))
+    return info[0] if info else ''
+
+# Returns the hash of the .fit file of rev, or with a sharded layout, a hash of
+# the hashes of all its .fit files
+def getFitFileHashForRev(rev='HEAD'):
+    shardDepth = getShardDepth()
+    if not shardDepth:
+        return _getFitBlobForRev(rev)
+    shards = _findShardsForRev(rev, shardDepth)
+    return _hashFitFiles([('.fit', _getFitBlobForRev(rev))] + [(d+'/.fit', b) for d,b in shards])
+
+def _hashFitFiles(blobs):
+    blobs = sorted((p,b) for p,b in blobs if b)
+    return sha1(''.join('%s %s\n'%(b, p) for p,b in blobs)).hexdigest() if blobs else ''
+
+def _getFitDataStringForBlob(blob):
+    return plumbing.readObject(blob) or ''
 
 @gitDirOperation(repoDir)
 def getFitManifestChanges(rev='HEAD@{1}'):
-    lines = popen(("git diff-tree -r --name-only %s HEAD -- *.gitattributes .fit"%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
+    lines = popen(("git diff-tree -r --name-only %s HEAD -- *.gitattributes .fit */.fit"%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
     return lines.split('\n') if lines else []
 
 @gitDirOperation(repoDir)
@@ -253,28 +1101,129 @@ def dirtyGitItemsFilter(items):
     lines = popen('git status --porcelain -u --ignored'.split() + list(items), stdout=PIPE).communicate()[0].rstrip()
     return [l.split(None, 1)[1] for l in lines.split('\n')] if lines else []
 
+# The staged counterpart of getFitFileHashForRev
 @gitDirOperation(repoDir)
 def getStagedFitFileHash():
-    return popen('git ls-files -s .fit'.split(), stdout=PIPE).communicate()[0].strip().split()[1]
+    shardDepth = getShardDepth()
+    if not shardDepth:
+        return popen('git ls-files -s .fit'.split(), stdout=PIPE).communicate()[0].strip().split()[1]
+    entries = popen('git ls-files -s -z -- .fit */.fit'.split(), stdout=PIPE).communicate()[0].split('\0')
+    entries = [e.split('\t', 1) for e in entries if e]
+    return _hashFitFiles((p, e.split()[1]) for e,p in entries if p.count('/') <= shardDepth)
+
+# The paths (relative to the repo root) of the .fit files of the working tree:
+# the one at the top and, with a sharded layout, the others that are there or
+# that git tracks
+@gitDirOperation(repoDir)
+def getFitFilePaths():
+    if not getShardDepth():
+        return ['.fit']
+    tracked = popen('git ls-files -z -- */.fit'.split(), stdout=PIPE).communicate()[0].split('\0')
+    shards = _findWorkingShards(repoDir, getShardDepth())
+    return sorted({'.fit'} | {d+'/.fit' for d,f in shards} | {p for p in tracked if p})
 
+# Returns the git status --porcelain -z output for the .fit files, which
+# parseFitFileStatus splits into [(status, path)]
 @gitDirOperation(repoDir)
 def getFitFileStatus():
-    return popen('git status --porcelain -u --ignored .fit'.split(), stdout=PIPE).communicate()[0].rstrip()
+    return popen('git status --porcelain -z -u --ignored --'.split() + getFitFilePaths(), stdout=PIPE).communicate()[0].rstrip('\0')
 
+def parseFitFileStatus(fitFileStatus):
+    entries = []
+    fields = iter(fitFileStatus.split('\0') if fitFileStatus else ())
+    for e in fields:
+        entries.append((e[:2], e[3:]))
+        # Renames and copies are followed by the path they were from
+        if 'R' in e[:2] or 'C' in e[:2]:
+            next(fields, None)
+    return entries
+
+# Files are told to be binary or text from their first binarySniffSize bytes
+# (as much as git looks at), like git does: a NUL byte makes them binary. Text
+# in encodings other than UTF-8 (and UTF-16, with a byte order mark) is allowed
+# a few control characters, but is binary beyond binarySniffMaxOdd of them.
+binarySniffSize = 8000
+binarySniffMaxOdd = 0.1
+binarySniffJobs = 8
+binaryCacheMaxCount = 65536
+
+_oddBytes = set(chr(c) for c in range(32) if chr(c) not in '\b\t\n\f\r\x1b') | {'\x7f'} | set(chr(c) for c in range(0x80, 0xa0))
+_textBytes = ''.join(chr(c) for c in range(256) if chr(c) not in _oddBytes)
+
+def isBinaryData(data):
+    if data.startswith(('\xff\xfe', '\xfe\xff')):
+        return False
+    if '\0' in data:
+        return True
+    try:
+        data.decode('utf-8')
+        return False
+    except UnicodeDecodeError as e:
+        # A character cut off at the end of the sniffed bytes
+        if e.reason == 'unexpected end of data':
+            return False
+    return len(data.translate(None, _textBytes)) > len(data)*binarySniffMaxOdd
+
+# Sniffs files off the work queue, or the blobs given for them
+def _binarySniffWorker(work, verdicts):
+    while True:
+        try:
+            f, blob = work.get_nowait()
+        except Empty:
+            return
+        try:
+            if blob:
+                verdicts[f] = isBinaryData((plumbing.readObject(blob) or '')[:binarySniffSize])
+                continue
+            fileIn = open(f, 'rb')
+            try:
+                verdicts[f] = isBinaryData(fileIn.read(binarySniffSize))
+            finally:
+                fileIn.close()
+        except Exception:
+            verdicts[f] = True
+
+# Returns those of the files that are binary. If blobs is given (mapping files
+# to the hashes of their staged blobs), the verdicts are cached by blob hash in
+# binaryCacheFile, so that the same contents are never looked at again. Files
+# whose working tree differs from what is staged (partly staged, or edited
+# since) are told apart by their staged blobs instead, which are read whole.
 @gitDirOperation(repoDir)
-def filterBinaryFiles(files):
-    binaryFiles = []
+def filterBinaryFiles(files, blobs=None):
+    cached = {}
+    if blobs:
+        try:
+            cached = marshal.load(open(binaryCacheFile, 'rb'))
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
 
-    p = popen('file -f -'.split(), stdout=PIPE, stdin=PIPE)
-    fileTypes = p.communicate('\n'.join(files))[0].strip().split('\n')
+    verdicts = {f: cached[blobs[f]] for f in files if blobs and blobs.get(f) in cached}
+    unknown = [f for f in files if f not in verdicts]
+    differing = set()
+    if blobs and any(f in blobs for f in unknown):
+        diff = popen(['git', '--literal-pathspecs', 'diff-files', '--name-only', '-z', '--']+[f for f in unknown if f in blobs], stdout=PIPE)
+        differing = set(diff.communicate()[0].split('\0')[:-1])
 
-    for f in fileTypes:
-        sepIdx = f.find(':')
-        filepath = f[:sepIdx]
-        if f.find('text', sepIdx) < 0:
-            binaryFiles.append(filepath)
+    work = Queue()
+    for f in unknown:
+        work.put((f, blobs[f] if f in differing else None))
+    sniffed = work.qsize()
+    workers = [thread(target=_binarySniffWorker, args=(work, verdicts)) for j in xrange(min(binarySniffJobs, sniffed))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
 
-    return binaryFiles
+    if blobs and sniffed:
+        if len(cached) + sniffed > binaryCacheMaxCount:
+            cached = {}
+        cached.update((blobs[f], verdicts[f]) for f in files if f in blobs)
+        cacheOut = open(binaryCacheFile+'.tmp', 'wb')
+        marshal.dump(cached, cacheOut)
+        cacheOut.close()
+        rename(binaryCacheFile+'.tmp', binaryCacheFile)
+
+    return [f for f in files if verdicts[f]]
 
 class DataStore:
     def __init__(self, progress):
@@ -287,3 +1236,20 @@ class DataStore:
         return False
     def close(self):
         pass
+
+    # Batched forms of check, get and put. git-fit always calls these, so a store
+    # that can handle many keys in one round trip (a single listing for checkMany,
+    # for example) should override them. By default they fall back to one call
+    # of the per-key method for each item.
+
+    # Takes a list of keys and returns a dict mapping each key to what check()
+    # would return for it
+    def checkMany(self, keys):
+        return {k: self.check(k) for k in keys}
+
+    # Take a list of (src, dst, size) tuples and return a list of per-item
+    # results in the same order, each being what get()/put() would return
+    def getMany(self, items):
+        return [self.get(src, dst, size) for src,dst,size in items]
+    def putMany(self, items):
+        return [self.put(src, dst, size) for src,dst,size in items]
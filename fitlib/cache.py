@@ -1,73 +1,142 @@
-from . import lruFile, objectsDir
-from json import load,dump
-from os import remove, makedirs
+from . import lruFile, cacheIndexFile, objectsDir
+from materialize import ingest
+from json import load
+from os import remove, makedirs, rename
 from os.path import exists
-from shutil import copyfile
 from sys import stdout
+from time import time
+import sqlite3
+
+# The cache index is an SQLite database with one row per cached object. Objects
+# are either in the "lru" (counter is set, ordering them by last use) or in the
+# "map" (counter is NULL), which holds saved objects that must not be evicted,
+# along with whether they have been committed yet. The running totals of both
+# parts and the last-used counter are kept in the meta table, so that none of
+# the operations below needs to visit objects it is not asked about. The time
+# an lru object was last used is kept next to its counter for age-based eviction.
+_schema = '''
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    counter INTEGER,
+    committed INTEGER NOT NULL DEFAULT 0,
+    atime INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_counter ON objects (counter);
+CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('lruSize', 0);
+INSERT OR IGNORE INTO meta VALUES ('lruCount', 0);
+INSERT OR IGNORE INTO meta VALUES ('mapSize', 0);
+'''
+
+# Keeps the number of bound parameters per query under SQLite's limit
+_queryChunkSize = 500
+
+_index = []
+
+def _getIndex():
+    if not _index:
+        migrate = not exists(cacheIndexFile) and exists(lruFile)
+        db = sqlite3.connect(cacheIndexFile)
+        db.text_factory = str
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            columns = [c[1] for c in db.execute('PRAGMA table_info(objects)')]
+            if columns and 'atime' not in columns:
+                db.execute('ALTER TABLE objects ADD COLUMN atime INTEGER NOT NULL DEFAULT 0')
+            db.executescript(_schema)
+            if migrate:
+                _migrateLruFile(db)
+        if migrate:
+            remove(lruFile)
+        _index.append(db)
+    return _index[0]
+
+# Imports the JSON lru file used by older versions of git-fit
+def _migrateLruFile(db):
+    data = load(open(lruFile))
+    l = data['lru']
+    m = data['map']
+    now = int(time())
+    db.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,?,0,?)', ((k,s,c,now) for k,(s,c) in l['items'].iteritems()))
+    db.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,NULL,?,?)', ((k,s,int(c),now) for k,(s,c) in m['items'].iteritems()))
+    _pack(db, l['size'], l['count'], m['size'])
 
 def _cacheIO(decoratee):
     def decorator(*a, **k):
-        loaded = False
-
-        if k.get('data') == None:
-            loaded = True
-            k['data'] = load(open(lruFile)) if exists(lruFile) else {'lru':{'size':0,'count':0,'items':{}},'map':{'size':0,'items':{}}}
+        if k.get('db') != None:
+            return decoratee(*a, **k)
 
-        updated, r = decoratee(*a, **k)
+        k['db'] = _getIndex()
+        with k['db']:
+            return decoratee(*a, **k)
+    return decorator
 
-        if loaded and updated:
-            f = open(lruFile, 'w')
-            dump(k['data'], f)
-            f.close()
+def _unpack(db):
+    meta = dict(db.execute('SELECT name, value FROM meta'))
+    return meta['lruSize'], meta['lruCount'], meta['mapSize']
 
-        return r
-    return decorator
+def _pack(db, ls, lc, ms):
+    db.executemany('UPDATE meta SET value = ? WHERE name = ?', ((ls, 'lruSize'), (lc, 'lruCount'), (ms, 'mapSize')))
 
-def _unpack(data):
-    l = data['lru']
-    m = data['map']
-    return l['size'], l['count'], l['items'], m['size'], m['items']
+# Returns {key: [size, counter, committed]} for those of the given keys that are in the index
+def _lookup(db, keys):
+    keys = list(set(keys))
+    found = {}
+    for i in xrange(0, len(keys), _queryChunkSize):
+        chunk = keys[i:i+_queryChunkSize]
+        query = 'SELECT key, size, counter, committed FROM objects WHERE key IN (%s)'%','.join('?'*len(chunk))
+        found.update((k, [s,c,m]) for k,s,c,m in db.execute(query, chunk))
+    return found
 
-def _pack(data, ls, lc, ms):
-    l = data['lru']
-    m = data['map']
-    l['size'], l['count'], m['size'] = ls, lc, ms
+def _objectPath(k):
+    return '%s/%s/%s'%(objectsDir, k[:2], k[2:])
 
 @_cacheIO
-def insert(keys, inLru=False, progressMsg=None, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def insert(keys, inLru=False, progressMsg=None, staged=None, db=None):
+    ls, lc, ms = _unpack(db)
+    existing = _lookup(db, keys)
 
     inserted = {}
     inOther = []
+    rows = []
     if inLru:
         for k,(s,f) in keys.iteritems():
             lc += 1
-            if k in mi:
+            e = existing.get(k)
+            if e and e[1] == None:
                 inOther.append(k)
-                del mi[k]
                 ms -= s
                 ls += s
-            elif k not in li:
+            elif not e:
                 inserted[k] = f
                 ls += s
-            li[k] = (s,lc)
+            rows.append((k,s,lc,0))
     else:
         for k,(s,f) in keys.iteritems():
-            if k in li:
+            e = existing.get(k)
+            if e and e[1] != None:
                 inOther.append(k)
                 lc += 1
-                li[k] = (s,lc)
-            elif k not in mi:
+                rows.append((k,s,lc,0))
+            elif not e:
                 inserted[k] = f
-                mi[k] = (s, False)
+                rows.append((k,s,None,0))
                 ms += s
 
     n = len(inserted)
     for i,(k,f) in enumerate(inserted.iteritems()):
         dstDir = '%s/%s'%(objectsDir, k[:2])
-        dst = '%s/%s'%(dstDir, k[2:])
         exists(dstDir) or makedirs(dstDir)
-        copyfile(f, dst)
+        if staged and f in staged:
+            rename(staged.pop(f), _objectPath(k))
+        else:
+            ingest(f, _objectPath(k))
         if progressMsg:
             print '\r%s...%6.2f%%  %s/%s           '%(progressMsg,(i+1)*100./n, i+1, n),
             stdout.flush()
@@ -75,111 +144,109 @@ def insert(keys, inLru=False, progressMsg=None, data=None):
     if progressMsg and len(inserted) > 0:
         print
 
-    _pack(data, ls, lc, ms)
-    return True, (inserted, inOther, ls, ms)
+    now = int(time())
+    db.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,?,?,?)', (r+(now,) for r in rows))
+    _pack(db, ls, lc, ms)
+    return inserted, inOther, ls, ms
 
 @_cacheIO
-def commit(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-
-    commited = {}
-    for k in keys:
-        if k in mi and not mi[k][1]:
-            s = mi[k][0]
-            mi[k] = (s, True)
-            commited[k] = s
-
-    _pack(data, ls, lc, ms)
-    return len(commited) > 0, commited
+def commit(keys, db=None):
+    commited = {k:s for k,(s,c,m) in _lookup(db, keys).iteritems() if c == None and not m}
+    db.executemany('UPDATE objects SET committed = 1 WHERE key = ?', ((k,) for k in commited))
+    return commited
 
 @_cacheIO
-def enque(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def enque(keys, db=None):
+    ls, lc, ms = _unpack(db)
+    keys = list(keys)
+    existing = _lookup(db, keys)
 
     enqued = {}
     fromMap = {}
     for k in keys:
-        val = None
-        if k in li:
-            val = li[k][0]
-        elif k in mi:
-            val = mi.pop(k)
-            fromMap[k] = val
-            val = val[0]
-            ms -= val
-            ls += val
-
-        if val:
-            enqued[k] = val
-            lc += 1
-            li[k] = (val, lc)
+        e = existing.get(k)
+        if not e:
+            continue
+        s,c,m = e
+        if c == None:
+            fromMap[k] = (s, bool(m))
+            ms -= s
+            ls += s
+        lc += 1
+        e[1] = lc
+        enqued[k] = s
 
-    _pack(data, ls, lc, ms)
-    return len(enqued) > 0, (enqued, fromMap)
+    now = int(time())
+    db.executemany('UPDATE objects SET counter = ?, committed = 0, atime = ? WHERE key = ?', ((existing[k][1], now, k) for k in enqued))
+    _pack(db, ls, lc, ms)
+    return enqued, fromMap
 
 @_cacheIO
-def find(keys, inMap=False, update=True, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def find(keys, inMap=False, update=True, db=None):
+    existing = _lookup(db, keys)
     if inMap:
-        return False, {k:'%s/%s/%s'%(objectsDir, k[:2], k[2:]) for k in keys if k in mi}
+        return {k:_objectPath(k) for k,(s,c,m) in existing.iteritems() if c == None}
 
-    inLru = False
-    found = {}
-    for k in keys:
-        if k in li:
-            inLru = True
-            lc += 1
-            val = li[k][0]
-            li[k] = (val, lc)
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
-        elif k in mi:
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
+    inLru = [k for k,(s,c,m) in existing.iteritems() if c != None]
+    if inLru and update:
+        ls, lc, ms = _unpack(db)
+        now = int(time())
+        db.executemany('UPDATE objects SET counter = ?, atime = ? WHERE key = ?', ((lc+i+1, now, k) for i,k in enumerate(inLru)))
+        _pack(db, ls, lc+len(inLru), ms)
 
-    _pack(data, ls, lc, ms)
-    return inLru and update, found
+    return {k:_objectPath(k) for k in existing}
 
 @_cacheIO
-def delete(keys, commits=False, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-    deleted = {}
-    for k in keys:
-        if k in mi:
-            s,c = mi.pop(k)
-            if commits == c:
-                deleted[k] = s
-                ms -= s
-                remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
-
-    _pack(data, ls, lc, ms)
-    return len(deleted) > 0, (deleted, ls, ms)
-
+def delete(keys, commits=False, db=None):
+    ls, lc, ms = _unpack(db)
+    deleted = {k:s for k,(s,c,m) in _lookup(db, keys).iteritems() if c == None and bool(m) == commits}
+    for k,s in deleted.iteritems():
+        ms -= s
+        remove(_objectPath(k))
+
+    db.executemany('DELETE FROM objects WHERE key = ?', ((k,) for k in deleted))
+    _pack(db, ls, lc, ms)
+    return deleted, ls, ms
+
+# Evicts lru objects, least recently used first, until the lru size is within
+# the given size. Objects last used more than maxAge seconds ago are evicted
+# regardless of size. Pinned objects are never evicted. Only the objects that
+# end up evicted (plus any pinned ones passed over on the way) are visited,
+# through range scans over the atime and counter indexes.
 @_cacheIO
-def prune(size, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-    
-    i = 0
-    items = sorted(li.iteritems(), key=lambda (i,(j,k)): k)
-    while ls > size and i < len(items):
-        k, (s, c) = items[i]
-        remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
-        ls -= s
-        i += 1
-
-    for k,(s,c) in items[:i]:
-        del li[k]
-
-    lc = 0
-    for k,(s,c) in items[i:]:
-        lc += 1
-        li[k] = (s,lc)
-
-    _pack(data, ls, lc, ms)
-    return True,ls
+def prune(size, maxAge=None, pinned=frozenset(), db=None):
+    ls, lc, ms = _unpack(db)
+
+    pruned = 0
+    if maxAge != None:
+        expired = db.execute('SELECT key, size FROM objects WHERE counter IS NOT NULL AND atime < ?', (int(time()) - maxAge,))
+        expired = [(k,s) for k,s in expired if k not in pinned]
+        for k,s in expired:
+            remove(_objectPath(k))
+            ls -= s
+        db.executemany('DELETE FROM objects WHERE key = ?', ((k,) for k,s in expired))
+        pruned += len(expired)
+
+    evicted = []
+    if ls > size:
+        for k,s in db.execute('SELECT key, size FROM objects WHERE counter IS NOT NULL ORDER BY counter'):
+            if ls <= size:
+                break
+            if k not in pinned:
+                remove(_objectPath(k))
+                evicted.append((k,))
+                ls -= s
+        db.executemany('DELETE FROM objects WHERE key = ?', evicted)
+        pruned += len(evicted)
+
+    _pack(db, ls, lc, ms)
+    return pruned, ls
 
 @_cacheIO
-def size(data=None):
-    return False, (data['lru']['size'], data['map']['size'])
+def size(db=None):
+    ls, lc, ms = _unpack(db)
+    return ls, ms
 
 @_cacheIO
-def getCommittedObjects(data=None):
-    return False, {h for h,(s,c) in data['map']['items'].iteritems() if c}
+def getCommittedObjects(db=None):
+    return {k for (k,) in db.execute('SELECT key FROM objects WHERE counter IS NULL AND committed = 1')}
@@ -1,16 +1,20 @@
 
-from . import fitFile, gitDirOperation, repoDir, savesDir, workingDir
+from . import fitFile, gitDirOperation, repoDir, savesDir, workingDir, objectsDir
 from . import updateStats, refreshStats, addedStatFile, writeFitFile, readFitFile
-from . import filterBinaryFiles, getStagedFitFileHash, getFitFileStatus
+from . import filterBinaryFiles, getStagedFitFileHash, getFitFileStatus, parseFitFileStatus, isFitFileLayoutStale
+from . import gitDir, attributesCacheFile, hashFile, getCommitFile, tracePhase
 from objects import getUpstreamItems, getDownstreamItems
-from paths import getValidFitPaths
-import merge, cache
+from paths import getValidFitPaths, getPathPrefixes
+from materialize import materialize, sharesData
+import merge, cache, watcher, plumbing
 from subprocess import Popen as popen, PIPE
-from os.path import exists, dirname, join as joinpath
-from os import remove, makedirs, stat, listdir, mkdir
-from shutil import copyfile
+from os.path import exists, lexists, dirname, basename, join as joinpath
+from os import remove, makedirs, listdir, rename, environ
+from os.path import expanduser
+from threading import Thread as thread
+import marshal
 import re
-from sys import stdout
+from sys import stdout, exc_info
 
 restoreMissingMessage = '''
 git-fit: %d objects were only lazily restored as empty stubs.
@@ -46,18 +50,63 @@ def printLegend():
     print '\n'
 
 
-def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, mergeInfo=None):
+# Runs func in a thread, and returns a function that waits for it to finish and
+# returns its result (or raises its exception)
+def _inBackground(name, func, *args):
+    result = []
+    def run():
+        try:
+            with tracePhase(name):
+                result.append((func(*args), None))
+        except BaseException:
+            # Including KeyboardInterrupt and SystemExit, which wait() raises again
+            result.append((None, exc_info()))
+
+    t = thread(target=run)
+    t.daemon = True
+    t.start()
+
+    def wait():
+        t.join()
+        value, error = result[0]
+        if error:
+            raise error[0], error[1], error[2]
+        return value
+    return wait
+
+# Everything status needs is looked up once. The git commands that don't depend
+# on the scan of the working tree run in the background alongside it. They
+# change into the repo root (see gitDirOperation) like the scan does, which is
+# only safe because status itself is run from there.
+# fitFileStatus is the output of getFitFileStatus, if it has been run already.
+@gitDirOperation(repoDir)
+def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, mergeInfo=None, fitFileStatus=None):
+    with tracePhase('status'):
+        _printStatus(fitTrackedData, pathArgs, legend, showall, mergeInfo, fitFileStatus)
+
+def _printStatus(fitTrackedData, pathArgs, legend, showall, mergeInfo, fitFileStatus):
+    getOffenders = _inBackground('status: staged offenders', getStagedOffenders)
+    getCommitFitData = _inBackground('status: commit file', lambda: readFitFile(getCommitFile()))
+    if fitFileStatus == None:
+        getFitFileStatusOutput = _inBackground('status: .fit file status', getFitFileStatus)
+    else:
+        getFitFileStatusOutput = lambda: fitFileStatus
+
     if legend:
         printLegend()
 
-    trackedItems = getTrackedItems()
-    fitItems = set(fitTrackedData)
-    allItems = fitItems | trackedItems
-    paths = None if not pathArgs else getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir)
+    with tracePhase('status: tracked items'):
+        watched = watcher.getChanges()
+        scope = getPathPrefixes(pathArgs, basePath=repoDir, workingDir=workingDir) if pathArgs else None
+        trackedItems = getTrackedItems(watched, scope)
+        fitItems = set(fitTrackedData)
+        paths = None if not pathArgs else getValidFitPaths(pathArgs, fitTrackedData.getPathIndex(), basePath=repoDir, workingDir=workingDir, others=trackedItems-fitItems)
 
-    modifiedItems, addedItems, removedItems, untrackedItems, unchangedItems, stats, stubs = getChangedItems(fitTrackedData, trackedItems=trackedItems, paths=paths)
+    with tracePhase('status: changed items'):
+        modifiedItems, addedItems, removedItems, untrackedItems, unchangedItems, stats, stubs = getChangedItems(fitTrackedData, trackedItems=trackedItems, paths=paths, watched=watched)
 
-    conflict, binary = getStagedOffenders()
+    with tracePhase('status: waiting for staged offenders'):
+        conflict, binary = getOffenders()
     offenders = conflict | binary
 
     modifiedItems = set(modifiedItems) - offenders
@@ -66,8 +115,9 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
     untrackedItems = untrackedItems - offenders
     unchangedItems = unchangedItems - offenders
 
-    downstream = getDownstreamItems(fitTrackedData, fitItems if paths == None else paths, stats)
-    upstream = getUpstreamItems()
+    with tracePhase('status: cache lookups'):
+        downstream = getDownstreamItems(fitTrackedData, fitItems if paths == None else paths, stats)
+        upstream = getUpstreamItems(getCommitFitData())
 
     modified,added,removed,untracked,unchanged = [],[],[],[],[]
 
@@ -101,8 +151,9 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
     conflict =      [('F  ', i) for i in conflict]
     binary =        [('B  ', i) for i in binary]
 
-    fitFileStatus = getFitFileStatus()
-    dirtyFit = fitFileStatus and fitFileStatus[1] != ' '
+    with tracePhase('status: waiting for .fit file status'):
+        fitFileStatus = getFitFileStatusOutput()
+    dirtyFit = any(s[1] != ' ' for s,p in parseFitFileStatus(fitFileStatus))
 
     noChanges = all(len(l) == 0 for l in [modified,added,removed,untracked,unchanged,conflict,binary,upstream,downstream,stubs])
 
@@ -141,25 +192,142 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
         print '   them with their actual contents.'
 
 
+# Past this many changed paths, listing the whole working tree is cheaper than
+# listing each of them
+watchedPathsMaxCount = 10000
+
+# The untracked items with the fit attribute set, only looking at and under the
+# given paths (relative to the repo root) if any. Unless cached is False, the
+# verdicts of git check-attr are cached (see _getCachedFitSetItems).
+def _getFitSetItems(paths=None, cached=True):
+    if paths == None:
+        pathspecs = [[]]
+    else:
+        paths = sorted(paths)
+        pathspecs = [['--'] + [':(literal)%s'%p for p in paths[i:i+1000]] for i in xrange(0, len(paths), 1000)]
+    listings = [popen('git ls-files -z -o'.split() + a, stdout=PIPE) for a in pathspecs]
+
+    # Found while git is still listing the untracked items
+    attributes = _getAttributesFiles(paths) if cached else None
+    items = [i for l in listings for i in l.communicate()[0].split('\0')[:-1]]
+    if not cached:
+        return _checkFitAttr(items)
+    return _getCachedFitSetItems(items, attributes, complete=paths == None)
+
+def _checkFitAttr(items):
+    if not items:
+        return set()
+    return {p for p,a,v in plumbing.checkAttr(items, ('fit',)) if v == 'set'}
+
+def _hashAttributesFiles(files):
+    return {f: hashFile(f) if exists(f) else None for f in files}
+
+# The attributes files that apply to the working tree, mapped to the hashes of
+# their contents (None if missing): the tracked .gitattributes files, those in
+# the directories above the given paths and, by absolute path, the
+# repository-wide and global ones. (Other untracked .gitattributes files are
+# among the untracked items.)
+def _getAttributesFiles(paths=None):
+    tracked = popen(['git', 'ls-files', '-z', '--', '.gitattributes', '*/.gitattributes'], stdout=PIPE)
+    globalFile = popen('git config core.attributesFile'.split(), stdout=PIPE).communicate()[0].strip()
+    if not globalFile:
+        globalFile = joinpath(environ.get('XDG_CONFIG_HOME') or expanduser('~/.config'), 'git', 'attributes')
+
+    files = set(tracked.communicate()[0].split('\0')[:-1])
+    files |= {joinpath(gitDir, 'info', 'attributes'), expanduser(globalFile)}
+    for p in paths or []:
+        p = p.rstrip('/')
+        while p:
+            p = dirname(p)
+            files.add(joinpath(p, '.gitattributes'))
+    return _hashAttributesFiles(files)
+
+# git check-attr is only asked about the fit attribute of untracked items it
+# hasn't been asked about before, or whose attributes may have changed since.
+# The verdicts are cached along with the hashes of the attributes files they
+# were given under (see _getAttributesFiles). The verdicts for the items in the
+# directory of a changed attributes file and below are dropped, or all of them
+# if a repository-wide or global one changed. Unless the items are complete
+# (all the untracked items), the verdicts for other items are kept.
+def _getCachedFitSetItems(items, attributes, complete=True):
+    try:
+        cachedAttributes, verdicts = marshal.load(open(attributesCacheFile, 'rb'))
+    except (IOError, EOFError, ValueError, TypeError):
+        cachedAttributes, verdicts = {}, {}
+
+    attributes.update(_hashAttributesFiles(i for i in items if basename(i) == '.gitattributes'))
+    changed = {f for f in set(attributes) | set(cachedAttributes) if attributes.get(f) != cachedAttributes.get(f)}
+    if any(f.startswith('/') or not dirname(f) for f in changed):
+        verdicts = {}
+    elif changed:
+        changedDirs = tuple(dirname(f)+'/' for f in changed)
+        verdicts = {i:v for i,v in verdicts.iteritems() if not i.startswith(changedDirs)}
+    query = [i for i in items if i not in verdicts]
+
+    fitSet = _checkFitAttr(query)
+    updated = {i: verdicts[i] for i in items if i in verdicts} if complete else dict(verdicts)
+    updated.update((i, i in fitSet) for i in query)
+    if changed or updated != verdicts:
+        cacheOut = open(attributesCacheFile+'.tmp', 'wb')
+        marshal.dump((attributes, updated), cacheOut)
+        cacheOut.close()
+        rename(attributesCacheFile+'.tmp', attributesCacheFile)
+
+    return {i for i in items if updated[i]}
+
+# Updates the tracked items from the last watcher-acknowledged scan by finding
+# out again only about the paths that have changed since. A changed
+# .gitattributes file may change any path below its directory.
+def _getWatchedTrackedItems(tracked, dirty):
+    dirty = set(dirty)
+    for p in [p for p in dirty if basename(p) == '.gitattributes']:
+        if not dirname(p):
+            return
+        dirty.add(dirname(p) + '/')
+
+    if len(dirty) > watchedPathsMaxCount:
+        return
+
+    isDirty = watcher.getDirtyFilter(dirty)
+    tracked = {i for i in tracked if not isDirty(i)}
+    return tracked | _getFitSetItems(dirty, cached=False)
+
 @gitDirOperation(repoDir)
-def getTrackedItems():
+def getTrackedItems(watched=None, paths=None):
     # The tracked items in the working tree according to the
-    # currently set fit attributes
-    fitSetRgx = re.compile('(.*): fit: set')
-    p = popen('git ls-files -o'.split(), stdout=PIPE)
-    p = popen('git check-attr --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
-    return {m.group(1) for m in [fitSetRgx.match(l) for l in p.stdout] if m}
+    # currently set fit attributes (at and under paths, if given)
+    if watched and watched[1] != None and watched[2] != None:
+        tracked = _getWatchedTrackedItems(watched[2], watched[1])
+        if tracked != None:
+            return tracked
+    if paths != None and not paths:
+        return set()
+    return _getFitSetItems(paths)
 
 @gitDirOperation(repoDir)
-def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None):
+def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None, staged=None, watched=None):
+
+    # Use the watcher's record of what changed in the working tree, if one is running
+    if trackedItems == None and watched == None:
+        watched = watcher.getChanges()
+    unchanged = None
+    if watched and watched[1] != None:
+        isDirty = watcher.getDirtyFilter(watched[1])
+        unchanged = lambda i: not isDirty(i)
 
     # The tracked items according to the saved/committed .fit file
     expectedItems = set(fitTrackedData)
-    trackedItems = trackedItems or getTrackedItems()
+
+    # Only the parts of the working tree at and under the given paths are looked at
+    if trackedItems == None:
+        scope = paths
+        if paths == None and pathArgs:
+            scope = getPathPrefixes(pathArgs, basePath=repoDir, workingDir=workingDir)
+        trackedItems = getTrackedItems(watched, scope)
 
     # Get valid, fit-friendly repo paths from given arbitrary path arguments
     if paths == None and pathArgs:
-        paths = getValidFitPaths(pathArgs, expectedItems | trackedItems, basePath=repoDir, workingDir=workingDir)
+        paths = getValidFitPaths(pathArgs, fitTrackedData.getPathIndex(), basePath=repoDir, workingDir=workingDir, others=trackedItems-expectedItems)
 
     if paths != None:
         if len(paths) == 0:
@@ -182,10 +350,15 @@ def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None
 
     # Check all existing items for modification by comparing their expected
     # hash sums (those stored in the .fit file) to their new, actual hash sums.
-    stats, stubs = updateStats(existingItems)
+    expected = {i: fitTrackedData[i][0] for i in existingItems} if staged != None else {}
+    stats, stubs = updateStats(existingItems, staged=staged, unchanged=unchanged, scoped=paths != None, expected=expected)
     modifiedItems = {i: [h,s[0]] for i,(h,s) in stats.iteritems() if h != fitTrackedData[i][0]}
     unchangedItems = existingItems - set(modifiedItems)
 
+    # The stat cache is now up to date for the whole working tree
+    if watched and paths == None:
+        watcher.acknowledge(watched[0], trackedItems)
+
     return modifiedItems, newItems, removedItems, untrackedItems, unchangedItems, stats, stubs
 
 @gitDirOperation(repoDir)
@@ -193,24 +366,25 @@ def getStagedOffenders():
     fitConflict = []
     binaryFiles = []
 
+    # The added files, with the hashes of their staged blobs
+    fields = popen('git diff --raw -z --no-abbrev --diff-filter=A --cached'.split(), stdout=PIPE).communicate()[0].split('\0')[:-1]
+    blobs = {fields[i+1]: fields[i].split()[3] for i in xrange(0, len(fields)-1, 2)}
+
     staged = []
-    p = popen('git diff --name-only --diff-filter=A --cached'.split(), stdout=PIPE)
-    p = popen('git check-attr --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
-    for l in p.stdout:
-        filepath = l[:l.find(':')]
-        if l.endswith(' set\n'):
-            fitConflict.append(filepath)
-        elif l.endswith(' unspecified\n'):
-            staged.append(filepath)
+    for p,a,v in plumbing.checkAttr(blobs, ('fit',)):
+        if v == 'set':
+            fitConflict.append(p)
+        elif v == 'unspecified':
+            staged.append(p)
 
     if len(staged) > 0:
-        binaryFiles = filterBinaryFiles(staged)
+        binaryFiles = filterBinaryFiles(staged, blobs=blobs)
 
     return set(fitConflict), set(binaryFiles)
 
 @gitDirOperation(repoDir)
-def checkForChanges(fitTrackedData, paths=None, pathArgs=None):
-    changes = getChangedItems(fitTrackedData, paths=paths, pathArgs=pathArgs)[:-3]
+def checkForChanges(fitTrackedData, paths=None, pathArgs=None, staged=None):
+    changes = getChangedItems(fitTrackedData, paths=paths, pathArgs=pathArgs, staged=staged)[:-3]
     if not any(changes):
         return
     
@@ -261,11 +435,13 @@ def _restoreFromCache(restoreType, objects, fitTrackedData, quiet=False):
         if objHash in cached:
             if not quiet:
                 print '%s: %s'%(restoreType, filePath)
-            copyfile(cached[objHash], filePath)
+            materialize(cached[objHash], filePath)
             touched[filePath] = objHash
         else:
             if not quiet:
                 print '%s (empty): %s'%(restoreType, filePath)
+            # remove first, in case the file is a hard link into the cache
+            lexists(filePath) and remove(filePath)
             open(filePath, 'w').close()  #write a 0-byte file as placeholder
             touched[filePath] = 0
             missing += 1
@@ -274,7 +450,18 @@ def _restoreFromCache(restoreType, objects, fitTrackedData, quiet=False):
 
 @gitDirOperation(repoDir)
 def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=False):
-    added,removed,stubs = saveItems(fitTrackedData, paths=paths, pathArgs=pathArgs, quiet=quiet)
+    # Unless the cache can share data with the working tree (see materialize.ingest),
+    # items are copied into the temp directory while they are hashed, so that caching
+    # them takes no second read. Copies that end up not being cached are removed here.
+    staged = None if sharesData(objectsDir) else {}
+    try:
+        return _save(fitTrackedData, paths, pathArgs, forceWrite, quiet, staged)
+    finally:
+        for f in (staged or {}).itervalues():
+            remove(f)
+
+def _save(fitTrackedData, paths, pathArgs, forceWrite, quiet, staged):
+    added,removed,stubs = saveItems(fitTrackedData, paths=paths, pathArgs=pathArgs, quiet=quiet, staged=staged)
 
     if stubs:
         print '\nerror: The following items are empty, zero-byte files and cannot be added to fit:\n'
@@ -285,28 +472,33 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
 
     if len(added) + len(removed) > 0 or forceWrite:
         print 'Working-tree changes saved.'
+        # When items were only modified, their entries can be updated in place
+        writeFitFile(fitTrackedData, changed=None if removed or forceWrite else set(added), touched=None if forceWrite else set(added) | removed)
+    elif isFitFileLayoutStale():
+        print 'The .fit files have been rearranged for fit.manifest.shardDepth.'
         writeFitFile(fitTrackedData)
 
-    fitFileStatus = getFitFileStatus()
-    if len(fitFileStatus) == 0 or fitFileStatus[1] == ' ':
+    fitFileStatus = parseFitFileStatus(getFitFileStatus())
+    unstaged = [p for s,p in fitFileStatus if s[1] != ' ']
+    if not unstaged:
         return True
 
     oldStagedFitFileHash = None
     newStagedFitFileHash = None
-    if fitFileStatus[0] == 'A':
+    if any(s[0] == 'A' for s,p in fitFileStatus):
         oldStagedFitFileHash = getStagedFitFileHash()
-    popen('git add -f'.split()+[fitFile]).wait()
+    popen('git add -f --'.split()+unstaged).wait()
     newStagedFitFileHash = getStagedFitFileHash()
     print 'Staged .fit file.'
 
     if oldStagedFitFileHash != newStagedFitFileHash:
-        _saveToCache(added, fitTrackedData, newStagedFitFileHash)
+        _saveToCache(added, fitTrackedData, newStagedFitFileHash, staged=staged)
 
     return True
 
 @gitDirOperation(repoDir)
-def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
-    changes = checkForChanges(fitTrackedData, paths=paths, pathArgs=pathArgs)
+def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False, staged=None):
+    changes = checkForChanges(fitTrackedData, paths=paths, pathArgs=pathArgs, staged=staged)
     if not changes:
         if not quiet:
             print 'Nothing to save (no changes detected).'
@@ -314,7 +506,7 @@ def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
     
     modified, added, removed, untracked = changes
 
-    stats, stubs = updateStats(added, filePath=addedStatFile)
+    stats, stubs = updateStats(added, filePath=addedStatFile, staged=staged, scoped=paths != None or bool(pathArgs))
     modified.update((i,[h,s[0]]) for i,(h,s) in stats.iteritems())
     removed |= untracked
 
@@ -324,7 +516,7 @@ def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
 
     return modified,removed,stubs
 
-def _saveToCache(newItems, fitTrackedData, fitFileHash):
+def _saveToCache(newItems, fitTrackedData, fitFileHash, staged=None):
     toAdd = dict(newItems)
     toRemove = set()
 
@@ -340,4 +532,4 @@ def _saveToCache(newItems, fitTrackedData, fitFileHash):
 
     writeFitFile(toAdd, joinpath(savesDir,fitFileHash))
     cache.delete(toRemove - {toAdd[i][0] for i in toAdd})
-    cache.insert({h:(s,f) for f,(h,s) in newItems.iteritems()}, progressMsg='Caching new and modified items')
+    cache.insert({h:(s,f) for f,(h,s) in newItems.iteritems()}, progressMsg='Caching new and modified items', staged=staged)
@@ -1,13 +1,13 @@
 from . import gitDirOperation, repoDir, savesDir, getCommitFile
-from . import getFitManifestChanges, dirtyGitItemsFilter, readFitFile
+from . import getFitManifestChanges, dirtyGitItemsFilter, readFitFile, getFitFileHashForRev
 from changes import getStagedOffenders, saveItems, restoreItems, restoreMissingMessage, checkForChanges
 from merge import getMergedFit
-from subprocess import PIPE, Popen as popen
+from subprocess import Popen as popen
 from textwrap import fill as wrapline
 from os import remove, mkdir, devnull
 from os.path import join as joinpath, exists
 from shutil import move
-import cache
+import cache, plumbing
 
 # This msg string should be left exactly as it is in the multi-line string
 infoMsg='''
@@ -28,11 +28,14 @@ def _getWorkingTreeStateForLastHead(fitData, fitManifestChanges):
     if not fitManifestChanges:
         return fitData
 
-    if '.fit' in fitManifestChanges:
-        fitManifestChanges.remove('.fit')
+    # Only the .gitattributes files are checked out (the .fit files were read)
+    fitManifestChanges -= {c for c in fitManifestChanges if c.rpartition('/')[2] == '.fit'}
 
+    # The git processes kept by plumbing would go on with the .gitattributes
+    # files they have already read
     if fitManifestChanges:
         popen('git checkout HEAD@{1}'.split() + list(fitManifestChanges), stdout=open(devnull, 'wb'), stderr=open(devnull, 'wb')).wait()
+        plumbing.reset()
     try:
         saveItems(fitData, quiet=True)
     except:
@@ -40,6 +43,7 @@ def _getWorkingTreeStateForLastHead(fitData, fitManifestChanges):
     finally:
         if fitManifestChanges:
             popen('git checkout HEAD'.split() + list(fitManifestChanges), stdout=open(devnull, 'wb'), stderr=open(devnull, 'wb')).wait()
+            plumbing.reset()
     return fitData
 
 @gitDirOperation(repoDir)
@@ -65,11 +69,10 @@ def postCheckout():
 
 @gitDirOperation(repoDir)
 def postCommit():
-    fitFileHash = popen('git ls-tree HEAD .fit'.split(), stdout=PIPE).communicate()[0].strip()
+    fitFileHash = getFitFileHashForRev('HEAD')
     if not fitFileHash:
         return
 
-    fitFileHash = fitFileHash.split()[2]
     savesFile = joinpath(savesDir, fitFileHash)
     committed = []
     if exists(savesFile):
@@ -0,0 +1,527 @@
+from struct import Struct
+from binascii import hexlify, unhexlify
+from os.path import commonprefix
+from array import array
+from collections import Mapping, MutableMapping
+from heapq import merge
+from itertools import izip, chain
+from operator import itemgetter
+from paths import PathIndex
+
+# The binary .fit format. Items are sorted by path (bytewise, so that all the
+# items under a directory are next to each other) and stored in blocks of
+# manifestBlockSize items. Within a block, each path only stores what differs
+# from the previous path. The first path of every block is stored in full, so
+# that a block can be decoded on its own, and an index of block offsets at the
+# end of the file allows finding the block holding any path by binary search.
+#
+#   header    magic, item count, total size of all items, offset of the index
+#   blocks    per item: length of the prefix shared with the previous path,
+#             length of the rest of the path, hash (20 bytes), size, followed
+#             by the rest of the path
+#   index     per block: offset of the block
+manifestMagic = 'FITMAN1\n'
+manifestBlockSize = 64
+
+_header = Struct('<8sQQQ')
+_entry = Struct('<HH20sQ')
+_offset = Struct('<Q')
+
+def isManifest(data):
+    return data[:len(manifestMagic)] == manifestMagic
+
+# The order of items in the binary format, and so the order writeManifestItems
+# takes them in
+def manifestSortKey(p):
+    return p.encode('utf-8') if isinstance(p, unicode) else p
+
+def writeManifest(fitFileOut, fitData):
+    writeManifestItems(fitFileOut, sorted(fitData.iteritems(), key=lambda i: manifestSortKey(i[0])))
+
+# Writes the (path, [hash, size]) items, which must be in manifestSortKey order,
+# a block at a time. fitFileOut must be seekable, as the header is only known
+# once all the items are written.
+def writeManifestItems(fitFileOut, items):
+    start = fitFileOut.tell()
+    fitFileOut.write(_header.pack(manifestMagic, 0, 0, 0))
+
+    records = []
+    offsets = []
+    offset = _header.size
+    previous = ''
+    count = 0
+    totalSize = 0
+    for p,(h,s) in items:
+        p = manifestSortKey(p)
+        if count % manifestBlockSize == 0:
+            fitFileOut.write(''.join(records))
+            records = []
+            offsets.append(offset)
+            shared = 0
+        else:
+            shared = len(commonprefix((previous, p)))
+        record = _entry.pack(shared, len(p)-shared, unhexlify(h), int(s)) + p[shared:]
+        records.append(record)
+        offset += len(record)
+        previous = p
+        count += 1
+        totalSize += int(s)
+
+    fitFileOut.write(''.join(records))
+    fitFileOut.write(''.join(_offset.pack(o) for o in offsets))
+    end = fitFileOut.tell()
+    fitFileOut.seek(start)
+    fitFileOut.write(_header.pack(manifestMagic, count, totalSize, offset))
+    fitFileOut.seek(end)
+
+# Yields (path, binary hash, size, offset of the item) for the items in buf from
+# the block at offset onwards, until the end of the blocks
+def _iterRawEntries(buf, offset, end):
+    previous = ''
+    while offset < end:
+        shared, n, h, s = _entry.unpack_from(buf, offset)
+        p = previous[:shared] + buf[offset+_entry.size:offset+_entry.size+n]
+        yield p, h, s, offset
+        offset += _entry.size + n
+        previous = p
+
+# Yields (path, [hash, size], offset of the item), as _iterRawEntries
+def _iterEntries(buf, offset, end):
+    for p,h,s,o in _iterRawEntries(buf, offset, end):
+        yield p, [hexlify(h), s], o
+
+def _iterBlocks(buf, offset, end):
+    for p,v,o in _iterEntries(buf, offset, end):
+        yield p,v
+
+# Yields all the items in buf in order
+def iterManifest(buf):
+    magic, count, totalSize, indexOffset = _header.unpack_from(buf, 0)
+    return _iterBlocks(buf, _header.size, indexOffset)
+
+def _getBlockOffsets(buf):
+    magic, count, totalSize, indexOffset = _header.unpack_from(buf, 0)
+    blockCount = (count + manifestBlockSize - 1) // manifestBlockSize
+    return [_offset.unpack_from(buf, indexOffset + i*_offset.size)[0] for i in xrange(blockCount)], indexOffset
+
+# Yields the items (and their offsets) with start <= path < end, decoding only
+# the blocks they are in
+def _iterRange(buf, offsets, indexOffset, start, end):
+    lo, hi = 0, len(offsets)
+    while hi - lo > 1:
+        mid = (lo+hi)//2
+        shared, n, h, s = _entry.unpack_from(buf, offsets[mid])
+        first = buf[offsets[mid]+_entry.size:offsets[mid]+_entry.size+n]
+        if first <= start:
+            lo = mid
+        else:
+            hi = mid
+
+    for p,v,o in _iterEntries(buf, offsets[lo] if offsets else indexOffset, indexOffset):
+        if p >= end:
+            break
+        if p >= start:
+            yield p,v,o
+
+# Reads the items in buf (a string or mmap of a binary .fit file) into a
+# FitManifest. If paths is given, only the items at or under those paths are
+# read.
+def readManifest(buf, paths=None):
+    offsets, indexOffset = _getBlockOffsets(buf)
+    if paths == None:
+        return FitManifest.fromRawItems((p,h,s) for p,h,s,o in _iterRawEntries(buf, _header.size, indexOffset))
+
+    items = []
+    for p in sorted(paths):
+        # The items under directory p sort between "p/" and "p0" ('0' follows '/')
+        items.extend(i for i in _iterRange(buf, offsets, indexOffset, p, p+'\0'))
+        items.extend(i for i in _iterRange(buf, offsets, indexOffset, p+'/', p+'0'))
+    return FitManifest((k,v) for k,v,o in items)
+
+# Overwrites the hashes and sizes of the changed paths in buf (a writable mmap
+# of a binary .fit file) with those in fitData, along with the total size in the
+# header. Nothing is changed unless all the paths are found. Returns whether
+# the paths were found.
+def patchManifest(buf, fitData, changed):
+    magic, count, totalSize, indexOffset = _header.unpack_from(buf, 0)
+    offsets = _getBlockOffsets(buf)[0]
+
+    patches = []
+    for p in changed:
+        found = list(_iterRange(buf, offsets, indexOffset, p, p+'\0'))
+        if not found:
+            return False
+        k,(h,s),o = found[0]
+        newHash, newSize = fitData[p]
+        totalSize += int(newSize) - s
+        patches.append((o, newHash, int(newSize)))
+
+    for o, h, s in patches:
+        shared, n = _entry.unpack_from(buf, o)[:2]
+        _entry.pack_into(buf, o, shared, n, unhexlify(h), s)
+    _header.pack_into(buf, 0, magic, count, totalSize, indexOffset)
+    return True
+
+# Sizes are kept as 64-bit integers or, where longs are smaller than that
+# (64-bit Windows), as doubles, which are exact up to 2**53
+_sizeType = 'l' if array('l').itemsize >= 8 else 'd'
+
+# A mapping of the paths of fit items to their [hash, size], which can stand in
+# for the dicts .fit files used to be read into while taking a fraction of the
+# memory. The items are kept sorted by path (as in the binary format), each as
+# the index of its directory name and its file name (both interned, so shared
+# by all the items they are part of), its hash as 20 bytes and its size. Paths
+# are looked up through a hash table of arrays (of the hashes of the paths and
+# the indexes of the items), built the first time one is.
+#
+# Items added or removed afterwards are kept aside (the added ones in a dict)
+# until there are enough of them to be worth sorting in. Values are made as
+# they are asked for, so an item only changes by being set again.
+class FitManifest(MutableMapping):
+    compactMinChanges = 65536
+
+    def __init__(self, items=()):
+        if isinstance(items, Mapping):
+            items = items.iteritems()
+        # Sorting them first (stably, so that of items with the same path the
+        # one given last still comes last) is quicker than _sortItems
+        items = sorted(((manifestSortKey(p), v) for p,v in items), key=itemgetter(0))
+        self._buildRaw((p, unhexlify(h), int(s)) for p,(h,s) in items)
+
+    # Makes a FitManifest from (path, binary hash, size) items
+    @staticmethod
+    def fromRawItems(items):
+        fitManifest = FitManifest.__new__(FitManifest)
+        fitManifest._buildRaw(items)
+        return fitManifest
+
+    # Makes one FitManifest of the items of several, given as (directory,
+    # FitManifest) pairs where the paths of each are relative to its directory
+    @staticmethod
+    def fromParts(parts):
+        # The items under each directory come in one run in order, so only the
+        # items of the parts without a directory need to be merged in
+        top = [m._iterRawItems() for d,m in parts if not d]
+        below = sorted((d+'/', m) for d,m in parts if d)
+        return FitManifest.fromRawItems(merge(chain.from_iterable(m._iterRawItems(d) for d,m in below), *top))
+
+    def _iterRawItems(self, prefix=''):
+        self._compact()
+        hashes, sizes = self._hashes, self._sizes
+        for i,p in enumerate(self._iterPaths()):
+            yield prefix+p, str(hashes[20*i:20*i+20]), sizes[i]
+
+    def _buildRaw(self, items):
+        self._dirs = dirs = []
+        self._dirIds = array('I')
+        self._names = names = []
+        self._hashes = hashes = bytearray()
+        self._sizes = sizes = array(_sizeType)
+        self._added = {}
+        self._removed = set()
+        self._lookup = None
+        self._pathIndex = [None]
+
+        appendDirId, appendName, appendSize = self._dirIds.append, names.append, sizes.append
+        dirIds = {}
+        previous = None
+        ordered = True
+        for p,h,s in items:
+            if type(p) is unicode:
+                p = p.encode('utf-8')
+            if p <= previous:
+                if p == previous:
+                    # As in a dict, the last value given for a path is kept
+                    hashes[-20:] = h
+                    sizes[-1] = s
+                    continue
+                ordered = False
+            previous = p
+            d, sep, name = p.rpartition('/')
+            dirId = dirIds.get(d)
+            if dirId == None:
+                dirId = dirIds[d] = len(dirs)
+                dirs.append(intern(d))
+            appendDirId(dirId)
+            appendName(intern(name))
+            hashes += h
+            appendSize(s)
+
+        if not ordered:
+            self._sortItems()
+        self._count = len(self._names)
+
+    def _sortItems(self):
+        paths = list(self._iterPaths())
+        order = sorted(xrange(len(paths)), key=paths.__getitem__)
+        # The sort is stable, so the last of the items with the same path is
+        # the one given last
+        order = [i for n,i in enumerate(order) if n+1 == len(order) or paths[order[n+1]] != paths[i]]
+
+        hashes = self._hashes
+        self._dirIds = array('I', (self._dirIds[i] for i in order))
+        self._names = [self._names[i] for i in order]
+        self._hashes = bytearray().join(hashes[20*i:20*i+20] for i in order)
+        self._sizes = array(_sizeType, (self._sizes[i] for i in order))
+
+    def _path(self, i):
+        d = self._dirs[self._dirIds[i]]
+        return d+'/'+self._names[i] if d else self._names[i]
+
+    def _iterPaths(self):
+        dirs = self._dirs
+        for dirId, name in izip(self._dirIds, self._names):
+            d = dirs[dirId]
+            yield d+'/'+name if d else name
+
+    def _value(self, i):
+        return [hexlify(self._hashes[20*i:20*i+20]), int(self._sizes[i])]
+
+    # The lookup table has at least half again as many slots as there are
+    # items, each the hash of a path and the index of its item (-1 if empty).
+    # Collisions go to the next free slot.
+    def _buildLookup(self):
+        mask = (1 << max(3, (3*len(self._names)//2).bit_length())) - 1
+        keys = array('l', [0])*(mask+1)
+        slots = array('i', [-1])*(mask+1)
+        for i,p in enumerate(self._iterPaths()):
+            k = hash(p)
+            j = k & mask
+            while slots[j] != -1:
+                j = (j+1) & mask
+            keys[j] = k
+            slots[j] = i
+        self._lookup = keys, slots, mask
+
+    # Returns the index of the sorted item with path p, or None
+    def _find(self, p):
+        if self._lookup == None:
+            self._buildLookup()
+
+        keys, slots, mask = self._lookup
+        k = hash(p)
+        j = k & mask
+        while True:
+            i = slots[j]
+            if i == -1:
+                return None
+            if keys[j] == k and self._path(i) == p:
+                return i
+            j = (j+1) & mask
+
+    # Returns the index of the first sorted item with a path not before p
+    def _bisect(self, p):
+        lo, hi = 0, len(self._names)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._path(mid) < p:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    # This is what most of the time spent with a FitManifest goes to, so _find
+    # and _value are written out here
+    def __getitem__(self, p):
+        if type(p) is unicode:
+            p = p.encode('utf-8')
+        added = self._added
+        if added and p in added:
+            return list(added[p])
+
+        if self._lookup == None:
+            self._buildLookup()
+        keys, slots, mask = self._lookup
+        k = hash(p)
+        j = k & mask
+        while True:
+            i = slots[j]
+            if i == -1:
+                raise KeyError(p)
+            if keys[j] == k:
+                d = self._dirs[self._dirIds[i]]
+                if (d+'/'+self._names[i] if d else self._names[i]) == p:
+                    break
+            j = (j+1) & mask
+
+        if self._removed and i in self._removed:
+            raise KeyError(p)
+        return [hexlify(self._hashes[20*i:20*i+20]), int(self._sizes[i])]
+
+    def __contains__(self, p):
+        p = manifestSortKey(p)
+        if p in self._added:
+            return True
+        i = self._find(p)
+        return i != None and i not in self._removed
+
+    def __setitem__(self, p, value):
+        h, s = value
+        p = manifestSortKey(p)
+        i = None if p in self._added else self._find(p)
+        if i == None:
+            if p not in self._added:
+                self._count += 1
+                self._pathIndex = [None]
+            self._added[p] = [h, int(s)]
+            self._compactIfNeeded()
+            return
+
+        if i in self._removed:
+            self._removed.remove(i)
+            self._count += 1
+            self._pathIndex = [None]
+        self._hashes[20*i:20*i+20] = unhexlify(h)
+        self._sizes[i] = int(s)
+
+    def __delitem__(self, p):
+        p = manifestSortKey(p)
+        if p in self._added:
+            del self._added[p]
+            self._count -= 1
+            self._pathIndex = [None]
+            return
+
+        i = self._find(p)
+        if i == None or i in self._removed:
+            raise KeyError(p)
+        self._removed.add(i)
+        self._count -= 1
+        self._pathIndex = [None]
+        self._compactIfNeeded()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        removed = self._removed
+        if not removed:
+            for p in self._iterPaths():
+                yield p
+        else:
+            for i,p in enumerate(self._iterPaths()):
+                if i not in removed:
+                    yield p
+        for p in sorted(self._added):
+            yield p
+
+    def iteritems(self):
+        removed, hashes, sizes = self._removed, self._hashes, self._sizes
+        for i,p in enumerate(self._iterPaths()):
+            if i not in removed:
+                yield p, [hexlify(hashes[20*i:20*i+20]), int(sizes[i])]
+        for p,v in sorted(self._added.iteritems()):
+            yield p, list(v)
+
+    def itervalues(self):
+        return (v for p,v in self.iteritems())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        fitManifest = FitManifest.__new__(FitManifest)
+        fitManifest._dirs = self._dirs
+        fitManifest._dirIds = array('I', self._dirIds)
+        fitManifest._names = list(self._names)
+        fitManifest._hashes = bytearray(self._hashes)
+        fitManifest._sizes = array(_sizeType, self._sizes)
+        fitManifest._added = {p:list(v) for p,v in self._added.iteritems()}
+        fitManifest._removed = set(self._removed)
+        fitManifest._lookup = self._lookup
+        fitManifest._pathIndex = self._pathIndex
+        fitManifest._count = self._count
+        return fitManifest
+
+    def _compactIfNeeded(self):
+        if len(self._added) + len(self._removed) > max(self.compactMinChanges, len(self._names)//4):
+            self._compact()
+
+    # Sorts the added items in with the others, leaving out the removed ones.
+    # (The directory names and the path lookup only ever get replaced, so
+    # copies can share them. The paths stay the same, and so does their index.)
+    def _compact(self):
+        if not self._added and not self._removed:
+            return
+        kept = ((self._path(i), self._hashes[20*i:20*i+20], self._sizes[i]) for i in xrange(len(self._names)) if i not in self._removed)
+        added = ((p, unhexlify(h), int(s)) for p,(h,s) in sorted(self._added.iteritems()))
+        pathIndex = self._pathIndex
+        self.__dict__.update(FitManifest.fromRawItems(merge(kept, added)).__dict__)
+        self._pathIndex = pathIndex
+
+    # Returns a PathIndex (see paths.py) of the paths, which is only built once
+    # for a FitManifest and the copies made of it before either is changed, so
+    # that the copies handed out of a memoized .fit file all share one
+    def getPathIndex(self):
+        if self._pathIndex[0] == None:
+            self._pathIndex[0] = PathIndex(self)
+        return self._pathIndex[0]
+
+    def getTotalSize(self):
+        removed = sum(self._sizes[i] for i in self._removed)
+        return int(sum(self._sizes) - removed) + sum(s for h,s in self._added.itervalues())
+
+    # Returns the items at or under the given paths, as a new FitManifest
+    def select(self, paths):
+        dirs = tuple(p+'/' for p in paths)
+        items = []
+        for p in sorted(paths):
+            # The items under directory p sort between "p/" and "p0" ('0' follows '/')
+            for start, end in ((p, p+'\0'), (p+'/', p+'0')):
+                i = self._bisect(start)
+                while i < len(self._names) and self._path(i) < end:
+                    if i not in self._removed:
+                        items.append((self._path(i), self._hashes[20*i:20*i+20], self._sizes[i]))
+                    i += 1
+        items.extend((p, unhexlify(h), int(s)) for p,(h,s) in self._added.iteritems() if p in paths or p.startswith(dirs))
+        return FitManifest.fromRawItems(items)
+
+    # Returns the (modified, added, removed) paths of other relative to this,
+    # going through the two in order rather than building sets of all paths
+    def diff(self, other):
+        self._compact()
+        other._compact()
+
+        modified, added, removed = set(), set(), set()
+        i, j = 0, 0
+        n, m = len(self._names), len(other._names)
+        while i < n and j < m:
+            p, q = self._path(i), other._path(j)
+            if p == q:
+                if self._sizes[i] != other._sizes[j] or self._hashes[20*i:20*i+20] != other._hashes[20*j:20*j+20]:
+                    modified.add(p)
+                i += 1
+                j += 1
+            elif p < q:
+                removed.add(p)
+                i += 1
+            else:
+                added.add(q)
+                j += 1
+        removed.update(self._path(k) for k in xrange(i, n))
+        added.update(other._path(k) for k in xrange(j, m))
+        return modified, added, removed
+
+    # The contents as strings and lists of strings, which marshal can store
+    def getState(self):
+        self._compact()
+        return _sizeType, self._dirs, self._dirIds.tostring(), self._names, str(self._hashes), self._sizes.tostring()
+
+    @staticmethod
+    def fromState(state):
+        sizeType, dirs, dirIds, names, hashes, sizes = state
+        if sizeType != _sizeType:
+            raise ValueError('Sizes stored as %s'%sizeType)
+        fitManifest = FitManifest()
+        fitManifest._dirs = [intern(d) for d in dirs]
+        fitManifest._dirIds.fromstring(dirIds)
+        fitManifest._names = [intern(n) for n in names]
+        fitManifest._hashes = bytearray(hashes)
+        fitManifest._sizes.fromstring(sizes)
+        fitManifest._count = len(fitManifest._names)
+        if not (len(fitManifest._dirIds) == len(fitManifest._sizes) == fitManifest._count == len(fitManifest._hashes)//20):
+            raise ValueError('Inconsistent manifest state')
+        return fitManifest
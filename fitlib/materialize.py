@@ -0,0 +1,129 @@
+from . import getGitConfig
+from os import remove, link, chmod, stat, write, open as osopen, close as osclose, O_RDONLY, O_WRONLY, O_CREAT, O_EXCL
+from os.path import lexists
+from shutil import copyfileobj
+from tempfile import mkstemp
+import stat as statmode
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+# ioctl request number of FICLONE (from linux/fs.h), which makes dst share all
+# of src's data blocks until either one is modified (a "reflink")
+FICLONE = 0x40049409
+
+# Ways in which cached objects can be placed into the working tree, set through
+# the fit.materialize git config key:
+#   copy      always make a full copy
+#   reflink   clone the object where the filesystem supports it (btrfs, XFS,
+#             APFS-style copy-on-write), otherwise make a full copy
+#   hardlink  hard-link the object and make it read-only, so that it cannot be
+#             modified in place (which would also modify the cached object).
+#             Falls back to reflink when a link is not possible. Only the
+#             permissions guard the cached object: a tool that makes the file
+#             writable again and rewrites it in place (or anything running as
+#             root) modifies the cached object as well.
+materializeModes = ('copy', 'reflink', 'hardlink')
+defaultMaterializeMode = 'reflink'
+
+copyBufferSize = 1048576
+
+_state = {}
+
+def getMaterializeMode():
+    if 'mode' not in _state:
+        mode = getGitConfig('fit.materialize', defaultMaterializeMode)
+        if mode not in materializeModes:
+            print 'warning: Ignoring unknown fit.materialize mode in git config: %s'%mode
+            mode = defaultMaterializeMode
+        _state['mode'] = mode
+    return _state['mode']
+
+def _reflink(src, dst):
+    # Once the filesystem has turned down a clone, don't keep trying
+    if not ioctl or _state.get('noReflink'):
+        return False
+
+    srcFd = osopen(src, O_RDONLY)
+    try:
+        dstFd = osopen(dst, O_WRONLY | O_CREAT | O_EXCL, stat(src).st_mode & 0777)
+        try:
+            ioctl(dstFd, FICLONE, srcFd)
+            return True
+        except IOError:
+            _state['noReflink'] = True
+        finally:
+            osclose(dstFd)
+    finally:
+        osclose(srcFd)
+
+    remove(dst)
+    return False
+
+def _makeReadOnly(filePath):
+    mode = stat(filePath).st_mode
+    chmod(filePath, mode & ~(statmode.S_IWUSR | statmode.S_IWGRP | statmode.S_IWOTH))
+
+def _hardlink(src, dst):
+    try:
+        link(src, dst)
+    except OSError:
+        return False
+    _makeReadOnly(dst)
+    return True
+
+def _copyFile(src, dst):
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            copyfileobj(fsrc, fdst, copyBufferSize)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+# Places the cached object src at the working tree path dst, replacing whatever
+# is at dst. An existing dst is always removed first rather than written over,
+# since it may be a hard link to a cached object.
+def materialize(src, dst):
+    if lexists(dst):
+        remove(dst)
+
+    mode = getMaterializeMode()
+    if mode == 'hardlink' and _hardlink(src, dst):
+        return
+    if mode != 'copy' and _reflink(src, dst):
+        return
+    _copyFile(src, dst)
+
+# Adds the working tree file src to the cache as the object dst. The file's data
+# is shared with the cache by a reflink wherever possible, whatever the mode,
+# since a clone never exposes the cached object to changes of the working tree
+# file. Otherwise the file is copied, reading it once in large chunks. It is
+# never hard-linked, even in hardlink mode: that would make the file the user
+# just saved read-only, and leave the cached object open to its next edit.
+def ingest(src, dst):
+    if lexists(dst):
+        remove(dst)
+
+    if _reflink(src, dst):
+        return
+    _copyFile(src, dst)
+
+# Whether ingest() can add files to the cache in directory without copying
+# them. Whether reflinks work is found out once, by cloning a small file.
+def sharesData(directory):
+    if 'noReflink' not in _state:
+        (probeHandle, probeFile) = mkstemp(dir=directory)
+        write(probeHandle, 'probe')
+        osclose(probeHandle)
+        try:
+            _state['noReflink'] = not _reflink(probeFile, probeFile+'.clone')
+        finally:
+            remove(probeFile)
+            lexists(probeFile+'.clone') and remove(probeFile+'.clone')
+
+    return not _state['noReflink']
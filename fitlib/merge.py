@@ -1,8 +1,15 @@
-from . import gitDirOperation, repoDir, fitFile, readFitFile, writeFitFile
-from . import mergeOtherFitFile, mergeMineFitFile, filterBinaryFiles, getFitFileStatus
+from . import gitDirOperation, repoDir, readFitFile, writeFitFile, iterFitFile, writeFitItems, getFitItemSortKey
+from . import mergeOtherFitFile, mergeMineFitFile, filterBinaryFiles, getFitFileStatus, parseFitFileStatus
+from manifest import FitManifest
 import changes
-from os import path, remove
+from os import path, remove, close
 from shutil import move
+from tempfile import mkstemp
+from glob import glob
+from urllib import quote
+from heapq import merge as mergeSorted
+from itertools import groupby
+from operator import itemgetter
 from subprocess import Popen as popen, PIPE
 import re
 
@@ -116,23 +123,52 @@ likewise, "theirs" actually refers to YOUR version that's already in the current
 
 _conflictLine_re = re.compile('\s*([(]?)\s*\[([MTW]?)\]\s*([)]?)\s*(\*\*|\+\+|\*-|-\*)\s*(.+)\s*$')
 
-def mergeDriver(common, mine, other):
-    commonFit, mineFit, otherFit = readFitFile(common), readFitFile(mine), readFitFile(other)
-    mergedFit, modified, added, removed, conflicts = getMergedFit(commonFit, mineFit, otherFit)
-
-    if conflicts:
+# The three .fit files are merged in one pass over their items in the order
+# they are written in (see iterMergedFit), so only the conflicts are kept in
+# memory. The merged items are written to a temp file as they come, which then
+# replaces mine (or becomes the merge-mine file if there were conflicts).
+# fitFilePath is the path of the .fit file being merged, relative to the repo
+# root: with a sharded layout (see getShardDepth), each .fit file is merged on
+# its own, and has merge files of its own.
+def mergeDriver(common, mine, other, fitFilePath='.fit'):
+    handle, mergedFile = mkstemp(dir=path.dirname(path.abspath(mine)))
+    close(handle)
+
+    sortKey = getFitItemSortKey()
+    conflicts = {'add': set(), 'mod': set(), 'modRem': set(), 'remMod': set()}
+    try:
+        fitItems = [iterFitFile(f, sortKey) for f in (common, mine, other)]
+        writeFitItems(iterMergedFit(fitItems[0], fitItems[1], fitItems[2], sortKey, conflicts), mergedFile)
+    except UnsortedFitItems:
+        # A .fit file edited by hand may be out of order, so merge in memory,
+        # into a new file rather than the half-written one
+        for it in fitItems:
+            it.close()
+        remove(mergedFile)
+        handle, mergedFile = mkstemp(dir=path.dirname(path.abspath(mine)))
+        close(handle)
+
+        commonFit, mineFit, otherFit = readFitFile(common), readFitFile(mine), readFitFile(other)
+        mergedFit, modified, added, removed, conflicts = getMergedFit(commonFit, mineFit, otherFit)
+        writeFitFile(mergedFit, mergedFile)
+
+    if conflicts and any(conflicts.itervalues()):
         resolved = False
-        writeFitFile(mergedFit, mergeMineFitFile)
-        move(other, mergeOtherFitFile)
+        mergeMineFile, mergeOtherFile = getMergeFiles(fitFilePath)
+        move(mergedFile, mergeMineFile)
+        move(other, mergeOtherFile)
         prepareResolutionForm(conflicts, mine)
         print conflictMsg
     else:
         resolved = True
-        writeFitFile(mergedFit, mine)
+        move(mergedFile, mine)
 
     return resolved
 
 def fitDiff(old, new):
+    if isinstance(old, FitManifest) and isinstance(new, FitManifest):
+        return old.diff(new)
+
     oldItems = set(old)
     newItems = set(new)
 
@@ -174,8 +210,31 @@ def resolve():
     return True
 
 def getResolutions():
-    mineFitData = readFitFile(mergeMineFitFile)
-    otherFitData = readFitFile(mergeOtherFitFile)
+    conflicted = getConflictedFitFiles()
+    mineFitData = readFitFile(replaced={f: getMergeFiles(f)[0] for f in conflicted})
+    otherFitData = readFitFile(replaced={f: getMergeFiles(f)[1] for f in conflicted})
+
+    mine = []
+    theirs = []
+    working = []
+    unresolved = []
+
+    for f in conflicted:
+        result = _getFileResolutions(f, mineFitData, otherFitData)
+        if result == None:
+            return None
+        for resolutions, found in zip((mine, theirs, working, unresolved), result):
+            resolutions.extend(found)
+
+    return mineFitData, mine, theirs, working, unresolved
+
+# Reads the selections in the Conflict Resolution Form in the .fit file at
+# fitFilePath (relative to the repo root), whose item paths are relative to
+# its directory
+def _getFileResolutions(fitFilePath, mineFitData, otherFitData):
+    d = path.dirname(fitFilePath)
+    name = 'the .fit file' if not d else fitFilePath
+    where = (lambda n: n) if not d else (lambda n: '%d of %s'%(n, fitFilePath))
 
     mine = []
     theirs = []
@@ -185,7 +244,7 @@ def getResolutions():
     stack = []
     batchResolution = ''
 
-    for n,l in enumerate(open(fitFile).readlines()):
+    for n,l in enumerate(open(path.join(repoDir, fitFilePath)).readlines()):
         if l.startswith('#'):
             continue
         l = l.strip()
@@ -194,11 +253,13 @@ def getResolutions():
 
         match = _conflictLine_re.match(l)
         if not match:
-            print 'merge error: Line %d in the .fit file has an error. Cannot continue...'%(n + 1)
+            print 'merge error: Line %d in %s has an error. Cannot continue...'%(n + 1, name)
             return None
 
         batchOpen, resolution, batchClose, change, item = match.groups()
         resolution = resolution.upper()
+        if d:
+            item = d+'/'+item
 
         if batchOpen:
             stack.append((resolution, n+1))
@@ -217,43 +278,60 @@ def getResolutions():
         elif resolution == 'W':
             working.append(item)
         else:
-            unresolved.append((n+1, item))
+            unresolved.append((where(n+1), item))
 
         if batchClose:
             if len(stack) == 0:
-                print 'merge error: Line %d in the .fit file has an unmatched close parenthesis. Cannot continue...'%(n + 1)
+                print 'merge error: Line %d in %s has an unmatched close parenthesis. Cannot continue...'%(n + 1, name)
                 return None
             stack.pop()
             batchResolution = '' if len(stack) == 0 else stack[-1][0]
 
     if len(stack) > 0:
-        print 'merge error: Line %d in the .fit file has an unmatched open parenthesis. Cannot continue...'%stack.pop()[1]
+        print 'merge error: Line %d in %s has an unmatched open parenthesis. Cannot continue...'%(stack.pop()[1], name)
         return None
 
-    return mineFitData, mine, theirs, working, unresolved
-
-def isMergeInProgress():
-    fitFileStatus = getFitFileStatus()
-    if fitFileStatus:
-        fitFileStatus = fitFileStatus.split()[0]
-
-    merging = (
-        ('U' in fitFileStatus or fitFileStatus in ('AA', 'DD'))
-        and path.exists(mergeMineFitFile) and path.exists(mergeOtherFitFile)
-        and path.exists(fitFile) and fitFile not in filterBinaryFiles([fitFile])
-        and open(fitFile).next().strip() == crfHeader[0]
-    )
+    return mine, theirs, working, unresolved
+
+# Returns the paths (relative to the repo root) of the .fit files that have
+# been replaced by a Conflict Resolution Form. fitFileStatus is the output of
+# getFitFileStatus, if it has been run already.
+@gitDirOperation(repoDir)
+def getConflictedFitFiles(fitFileStatus=None):
+    if fitFileStatus == None:
+        fitFileStatus = getFitFileStatus()
+
+    conflicted = []
+    for s,f in parseFitFileStatus(fitFileStatus):
+        if (
+            ('U' in s or s in ('AA', 'DD'))
+            and all(path.exists(m) for m in getMergeFiles(f))
+            and path.exists(f) and f not in filterBinaryFiles([f])
+            and open(f).next().strip() == crfHeader[0]
+        ):
+            conflicted.append(f)
+    return conflicted
+
+# fitFileStatus is the output of getFitFileStatus, if it has been run already
+def isMergeInProgress(fitFileStatus=None):
+    merging = bool(getConflictedFitFiles(fitFileStatus))
 
     if not merging:
         cleanupMergeArtifacts()
 
     return merging
 
+# The merge-mine and merge-other files of the .fit file at fitFilePath
+def getMergeFiles(fitFilePath):
+    d = path.dirname(fitFilePath)
+    if not d:
+        return mergeMineFitFile, mergeOtherFitFile
+    suffix = '.'+quote(d, safe='')
+    return mergeMineFitFile+suffix, mergeOtherFitFile+suffix
+
 def cleanupMergeArtifacts():
-    if path.exists(mergeMineFitFile):
-        remove(mergeMineFitFile)
-    if path.exists(mergeOtherFitFile):
-        remove(mergeOtherFitFile)
+    for f in glob(mergeMineFitFile+'*') + glob(mergeOtherFitFile+'*'):
+        remove(f)
 
 def getMergedFit(common, mine, other):
     mineMod,mineAdd,mineRem = fitDiff(common, mine)
@@ -286,3 +364,46 @@ def getMergedFit(common, mine, other):
         }
 
     return mine, modified, added, removed, conflicts
+
+class UnsortedFitItems(Exception):
+    pass
+
+def _keyFitItems(fitItems, sortKey, n):
+    last = None
+    for p,v in fitItems:
+        k = sortKey(p)
+        if last != None and k <= last:
+            raise UnsortedFitItems(p)
+        last = k
+        yield k, n, p, v
+
+# The streaming form of getMergedFit. common, mine and other are iterables of
+# (path, [hash, size]) items in sortKey order (UnsortedFitItems is raised if
+# any of them isn't). Yields the merged items in the same order, and adds the
+# conflicting paths to the sets in conflicts (a dict of the form getMergedFit
+# returns). As with getMergedFit, mine is kept where there is a conflict.
+def iterMergedFit(common, mine, other, sortKey, conflicts):
+    keyed = [_keyFitItems(f, sortKey, n) for n,f in enumerate((common, mine, other))]
+    for k,group in groupby(mergeSorted(*keyed), itemgetter(0)):
+        values = [None, None, None]
+        for k,n,p,v in group:
+            values[n] = v
+        c, m, o = values
+
+        if o == c or o == m:
+            merged = m
+        elif m == c:
+            merged = o
+        else:
+            merged = m
+            if c == None:
+                conflicts['add'].add(p)
+            elif m == None:
+                conflicts['remMod'].add(p)
+            elif o == None:
+                conflicts['modRem'].add(p)
+            else:
+                conflicts['mod'].add(p)
+
+        if merged != None:
+            yield p, merged
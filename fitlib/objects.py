@@ -1,13 +1,19 @@
-from . import gitDirOperation, refreshStats, getFitSize, readFitFile, writeFitFile, getCommitFile, commitsDir
+from . import gitDirOperation, refreshStats, getFitSize, readFitFile, writeFitFile, getCommitFile, commitsDir, getGitConfig
 from . import repoDir, fitDir, objectsDir, tempDir, workingDir
 from paths import getValidFitPaths
+from materialize import materialize
 import cache
 from subprocess import Popen as popen, PIPE
 from os.path import dirname, basename, exists, join as joinpath, getsize
-from os import walk, makedirs, remove, close as osclose, mkdir, listdir, stat
-from shutil import copyfile, move
+from os import walk, makedirs, remove, close as osclose, mkdir, listdir, stat, devnull
+from shutil import move
 from sys import stdout
 from tempfile import mkstemp
+from threading import Thread as thread, Lock as lock, current_thread
+from Queue import Queue
+
+defaultTransferJobs = 4
+checkBatchSize = 1000
 
 def getDataStore(progressCallback):
     moduleName = popen('git config fit.datastore.moduleName'.split(), stdout=PIPE).communicate()[0].strip()
@@ -27,71 +33,167 @@ def getDataStore(progressCallback):
         print 'error: Could not load the data store configured in fit.datastore.'
         raise
 
-def getUpstreamItems():
+def getTransferBatchSize():
+    try:
+        return max(1, int(getGitConfig('fit.transfer.batchSize', 1)))
+    except ValueError:
+        print 'warning: Ignoring invalid fit.transfer.batchSize value in git config.'
+        return 1
+
+def getTransferJobs():
+    try:
+        return max(1, int(getGitConfig('fit.transfer.jobs', defaultTransferJobs)))
+    except ValueError:
+        print 'warning: Ignoring invalid fit.transfer.jobs value in git config.'
+        return defaultTransferJobs
+
+# commitFitData is the .fit data in the commit file, if it has been read already
+def getUpstreamItems(commitFitData=None):
     cachedCommits = cache.getCommittedObjects()
-    return set(f for f,(h,s) in readFitFile(getCommitFile()).iteritems() if h in cachedCommits)
+    if commitFitData == None:
+        commitFitData = readFitFile(getCommitFile())
+    return set(f for f,(h,s) in commitFitData.iteritems() if h in cachedCommits)
 
+# Paths not in fitTrackedData (e.g. newly added items) are not downstream
 def getDownstreamItems(fitTrackedData, paths, stats):
-    cached = cache.find((fitTrackedData[p][0] for p in paths), update=False)
-    return [p for p in paths if not (p in stats or fitTrackedData[p][0] in cached)]
-
+    hashes = [(p, v[0]) for p,v in ((p, fitTrackedData.get(p)) for p in paths) if v]
+    cached = cache.find((h for p,h in hashes), update=False)
+    return [p for p,h in hashes if not (p in stats or h in cached)]
+
+# Items may be transferred by several worker threads at once, so the printer
+# keeps the in-flight item of each thread separately. Data stores report
+# progress through updateProgress() from the worker thread doing the transfer,
+# which is how a progress update is matched with its item.
 class _ProgressPrinter:
     def __init__(self):
         self.size_total = 0
-        self.size_item = 0
         self.size_done = 0
-        self.item_name = ''
-        self.item_started = False
+        self.items = {}
+        self.line_open = False
+        self.lock = lock()
 
-    def updateProgress(self, done, size, custom_item_string=None):
+    def _printLine(self, name, size, done, custom_item_string=None):
+        overall = (self.size_done+sum(i[2] for i in self.items.itervalues()))*100./self.size_total if self.size_total else 100.
         if custom_item_string:
-            fmt_args = (
-                (self.size_done+done)*100./self.size_total,
-                custom_item_string,
-                self.item_name
-            )
-            print '\rOverall: %6.2f%%    %s   %s'%fmt_args,
+            print '\rOverall: %6.2f%%    %s   %s'%(overall, custom_item_string, name),
         else:
-            fmt_args = (
-                (self.size_done+done)*100./self.size_total,
-                self.size_item/1048576.,
-                done*100./size,
-                self.item_name
-            )
-            print '\rOverall: %6.2f%%    %7.3f MB   %6.2f%%   %s'%fmt_args,
+            print '\rOverall: %6.2f%%    %7.3f MB   %6.2f%%   %s'%(overall, size/1048576., done*100./size if size else 100., name),
         stdout.flush()
-        self.item_started = True
+
+    def updateProgress(self, done, size, custom_item_string=None):
+        with self.lock:
+            item = self.items.get(current_thread().ident)
+            if not item:
+                return
+            item[2] = min(done, item[1])
+            self._printLine(item[0], item[1], done, custom_item_string)
+            self.line_open = True
+
     def newItem(self, name, size):
-        if self.size_item and self.item_started:
+        with self.lock:
+            self.items[current_thread().ident] = [name, size, 0]
+
+    def finishItem(self, custom_item_string=None):
+        with self.lock:
+            if current_thread().ident not in self.items:
+                return
+            name, size, done = self.items.pop(current_thread().ident)
+            self.size_done += size
+            self._printLine(name, size, size, custom_item_string)
             print
-
-        self.size_done += self.size_item
-        self.item_name = name
-        self.size_item = size
-        self.item_started = False
+            self.line_open = False
 
     def done(self):
-        if self.size_item > 0:
-            self.size_done += self.size_item
+        if self.line_open:
             print
+            self.line_open = False
 
     def setTotalSize(self, totalSize):
         self.size_total = totalSize
 
 class _QuietProgressPrinter:
-    def updateProgress(self, done, size):
+    def updateProgress(self, done, size, custom_item_string=None):
         pass
     def newItem(self, name, size):
         pass
+    def finishItem(self, custom_item_string=None):
+        pass
     def done(self):
         pass
     def setTotalSize(self, totalSize):
         pass
 
+# Each worker thread pulls items off the queue until it finds a None, and hands
+# them to work() along with the worker's own data store instance, so stores
+# never have to be thread-safe. A batch that work() fails on is recorded in
+# failures, and the worker goes on with the rest of the queue.
+def _startWorkers(stores, work, queue, pp, failures):
+    def worker(store):
+        for batch in iter(queue.get, None):
+            try:
+                work(store, batch)
+            except Exception as e:
+                pp.finishItem(custom_item_string='ERROR')
+                failures.extend('%s (%s)'%(i[0], e) for i in batch)
+
+    threads = [thread(target=worker, args=(s,)) for s in stores]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    return threads
+
+def _waitWorkers(threads):
+    # Joining with a timeout keeps the main thread responsive to Ctrl-C
+    for t in threads:
+        while t.is_alive():
+            t.join(0.2)
+
+def _getKeyName(objHash):
+    return '%s/%s'%(objHash[:2], objHash[2:])
+
+def _getBatches(items, batchSize):
+    for i in xrange(0, len(items), batchSize):
+        yield items[i:i+batchSize]
+
+def _getBatchProgressItem(batch):
+    filePath = batch[0][0]
+    if len(batch) > 1:
+        filePath = '%s (and %d more)'%(filePath, len(batch) - 1)
+    return filePath, sum(i[2] for i in batch)
+
+# Runs the existence checks for all items in the calling thread, one checkMany()
+# call per chunk of items, and queues the items each chunk selects for transfer
+# in batches of fit.transfer.batchSize. The transfer workers can start on the
+# first batches while the checks for later chunks are still running. The items
+# of a chunk whose check fails are failures, rather than taken to be missing.
+def _checkAndTransfer(items, stores, transferBatch, select, pp, failures):
+    checker, workers = stores[0], stores[1:]
+    batchSize = getTransferBatchSize()
+    batches = Queue()
+    threads = _startWorkers(workers, transferBatch, batches, pp, failures)
+
+    for chunk in _getBatches(items, checkBatchSize):
+        keys = [_getKeyName(objHash) for f,objHash,s in chunk]
+        try:
+            found = checker.checkMany(keys)
+        except Exception as e:
+            for filePath,objHash,size in chunk:
+                pp.newItem(filePath, size)
+                pp.finishItem(custom_item_string='ERROR')
+                failures.append('%s (%s)'%(filePath, e))
+            continue
+        selected = [i+(k, found.get(k)) for i,k in zip(chunk, keys) if select(i, found.get(k))]
+        for batch in _getBatches(selected, batchSize):
+            batches.put(batch)
+
+    for s in workers:
+        batches.put(None)
+    _waitWorkers(threads)
+
+# With pathArgs, fitTrackedData need only hold the items under them
 @gitDirOperation(repoDir)
 def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=False):    
-    allItems = fitTrackedData.keys()
-    validPaths = getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir) if pathArgs else allItems
+    validPaths = getValidFitPaths(pathArgs, fitTrackedData.getPathIndex(), basePath=repoDir, workingDir=workingDir) if pathArgs else fitTrackedData.keys()
 
     needed = []   # not in working tree nor in cache, must be downloaded
     touched = {}
@@ -104,7 +206,7 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
             fileDir = dirname(filePath)
             fileDir and (exists(fileDir) or makedirs(fileDir))
             if objPath:
-                copyfile(objPath, filePath)
+                materialize(objPath, filePath)
                 touched[filePath] = objHash
             else:
                 needed.append((filePath, objHash, size))
@@ -127,39 +229,68 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
         print 'Run \'git-fit get -l\' to list these items.'
     else:
         successes = []
-        _transfer(_get, needed, totalSize, fitTrackedData, successes, quiet)
+        _transfer(_get, needed, totalSize, None if pathArgs else fitTrackedData, successes, quiet)
 
         for filePath, objHash, size in successes:
             touched[filePath] = objHash
 
     refreshStats(touched)
 
-def _get(items, store, pp, successes, failures):
+# Returns the results of a getMany or putMany call as a list, making sure there
+# is one for each object of the batch
+def _checkTransferred(transferred, batch):
+    transferred = list(transferred)
+    if len(transferred) != len(batch):
+        raise Exception('the data store returned %d results for %d objects'%(len(transferred), len(batch)))
+    return transferred
+
+def _get(items, stores, pp, successes, failures):
     if not exists(tempDir):
         mkdir(tempDir)
 
-    for filePath,objHash,size in items:
-        pp.newItem(filePath, size)
-        
+    def selectItem((filePath, objHash, size), key):
+        if not key:
+            pp.newItem(filePath, size)
+            pp.finishItem(custom_item_string='ERROR')
+            failures.append(filePath)
+        return key
+
+    def getBatch(store, batch):
+        pp.newItem(*_getBatchProgressItem(batch))
+
         # Copy download to temp file first, and then to actual object location
         # This is to prevent interrupted downloads from causing bad objects to be placed
         # in the objects cache
-        (tempHandle, tempTransferFile) = mkstemp(dir=tempDir)
-        osclose(tempHandle)
-        key = store.check('%s/%s'%(objHash[:2], objHash[2:]))
+        tempFiles = []
+        for i in batch:
+            (tempHandle, tempTransferFile) = mkstemp(dir=tempDir)
+            osclose(tempHandle)
+            tempFiles.append(tempTransferFile)
 
+        error = None
         try:
-            transferred = store.get(key, tempTransferFile, size)
-        except:
-            transferred = False
-        if key and transferred:
-            pp.updateProgress(size, size)
-            popen(['mv', tempTransferFile, filePath]).wait()
-            successes.append((filePath, objHash, size))
-        else:
-            pp.updateProgress(size, size, custom_item_string='ERROR')
-            failures.append(filePath)
+            transferred = _checkTransferred(store.getMany([(key, t, size) for (f,h,size,k,key),t in zip(batch, tempFiles)]), batch)
+        except Exception as e:
+            transferred = [False]*len(batch)
+            error = str(e)
 
+        failed = False
+        for (filePath,objHash,size,keyName,key),tempTransferFile,done in zip(batch, tempFiles, transferred):
+            try:
+                if done:
+                    move(tempTransferFile, filePath)
+                    successes.append((filePath, objHash, size))
+                    continue
+                remove(tempTransferFile)
+                failures.append('%s (%s)'%(filePath, error) if error else filePath)
+            except (IOError, OSError) as e:
+                failures.append('%s (%s)'%(filePath, e))
+            failed = True
+        pp.finishItem(custom_item_string='ERROR' if failed else None)
+
+    _checkAndTransfer(items, stores, getBatch, selectItem, pp, failures)
+
+    successes.sort()
     cache.insert({h:(s,f) for f,h,s in successes}, inLru=True, progressMsg='Caching newly gotten items')
 
 @gitDirOperation(repoDir)
@@ -197,40 +328,53 @@ def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=Fal
     for f in sorted(listdir(commitsDir), key=lambda x: stat(joinpath(commitsDir, x)).st_mtime)[:-2]:
         remove(joinpath(commitsDir, f))
 
-def _put(items, store, pp, successes, failures):
+def _put(items, stores, pp, successes, failures):
     cached = cache.find(o for f,o,s in items)
-    for filePath,objHash,size in items:
+    missing = [i for i in items if i[1] not in cached]
+    for filePath,objHash,size in missing:
         pp.newItem(filePath, size)
-        if objHash not in cached:
-            pp.updateProgress(size, size, custom_item_string='ERROR')
-            failures.append(filePath)
-            continue
-
-        done = True
-        keyName = '%s/%s'%(objHash[:2], objHash[2:])
-        if store.check(keyName):
-            pp.updateProgress(size, size, custom_item_string='No transfer needed.')
-        else:
-            try:
-                transferred = store.put(cached[objHash], keyName, size)
-            except:
-                transferred = False
-            if transferred:
-                pp.updateProgress(size, size)
+        pp.finishItem(custom_item_string='ERROR')
+        failures.append(filePath)
+
+    # Objects that are already in the store are done as soon as their check
+    # comes back, so they never take up an upload slot
+    def selectItem(item, key):
+        if key:
+            pp.newItem(item[0], item[2])
+            pp.finishItem(custom_item_string='No transfer needed.')
+            successes.append(item)
+        return not key
+
+    def putBatch(store, batch):
+        pp.newItem(*_getBatchProgressItem(batch))
+
+        error = None
+        try:
+            transferred = _checkTransferred(store.putMany([(cached[objHash], keyName, size) for f,objHash,size,keyName,k in batch]), batch)
+        except Exception as e:
+            transferred = [False]*len(batch)
+            error = str(e)
+
+        for (filePath,objHash,size,keyName,k),done in zip(batch, transferred):
+            if done:
+                successes.append((filePath, objHash, size))
             else:
-                done = False
-                pp.updateProgress(size, size, custom_item_string='ERROR')
-                failures.append(filePath)
-        if done:
-            successes.append((filePath, objHash, size))
+                failures.append('%s (%s)'%(filePath, error) if error else filePath)
+        pp.finishItem(custom_item_string=None if all(transferred) else 'ERROR')
+
+    _checkAndTransfer([i for i in items if i[1] in cached], stores, putBatch, selectItem, pp, failures)
 
+    # Uploads finish in no particular order, so sort to keep the LRU order of
+    # the enqueued objects the same from run to run
+    successes.sort()
     cache.enque(o for f,o,s in successes)
 
 def _transfer(method, items, size, fitTrackedData, successes, quiet):
     pp = _QuietProgressPrinter() if quiet else _ProgressPrinter()
     pp.setTotalSize(size)
     try:
-        store = getDataStore(pp.updateProgress)
+        # One store more than the number of transfer jobs, for the existence checks
+        stores = [getDataStore(pp.updateProgress) for i in xrange(getTransferJobs() + 1)]
     except Exception as e:
         print e
         return
@@ -238,19 +382,53 @@ def _transfer(method, items, size, fitTrackedData, successes, quiet):
     failures = []
     items.sort()
 
-    method(items, store, pp, successes, failures)
+    method(items, stores, pp, successes, failures)
 
     pp.done()
-    store.close()
+    for store in stores:
+        store.close()
 
     if len(failures) > 0:
         print '\n'.join(failures)
         print 'Above items could not be transferred.'
 
+    _pruneCache(fitTrackedData)
+
+def _getRecentBranches(count):
+    if count <= 0:
+        return []
+    lines = popen('git reflog show --format=%gs HEAD'.split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].split('\n')
+    branches = []
+    for l in lines:
+        if l.startswith('checkout: moving from ') and len(branches) < count:
+            branch = l.rsplit(' to ', 1)[1]
+            branch in branches or branches.append(branch)
+    return branches
+
+def _getPinnedObjects(fitTrackedData):
+    pinned = set()
+    if getGitConfig('fit.cache.pinHead', 'true', valueType='bool') == 'true':
+        pinned.update(h for h,s in fitTrackedData.itervalues())
+    for branch in _getRecentBranches(int(getGitConfig('fit.cache.pinBranches', 0, valueType='int'))):
+        pinned.update(h for h,s in readFitFile(rev=branch).itervalues())
+    return pinned
+
+# fitTrackedData is that of HEAD, which is read here if not given
+def _pruneCache(fitTrackedData):
+    if fitTrackedData == None:
+        fitTrackedData = readFitFile(rev='HEAD')
     fitSize = getFitSize(fitTrackedData)
+    maxSize = int(getGitConfig('fit.cache.maxSize', fitSize * 2, valueType='int'))
+    maxAge = getGitConfig('fit.cache.maxAge', valueType='int')
+    maxAge = int(maxAge) * 86400 if maxAge else None
+
     cacheSize = cache.size()[0]
-    if cacheSize > fitSize * 2:
-        print 'Cache size (%.2fMB) is larger than twice the tracked size (%.2fMB). Pruning...'%(cacheSize/1048576., fitSize/1048576.)
-        cache.prune(fitSize * 2)
-    else:
-        print 'Cache size is %.2fMB and tracked size is %.2fMB (will not prune at this time).'%(cacheSize/1048576., fitSize/1048576.)
+    if cacheSize <= maxSize and maxAge == None:
+        print 'Cache size is %.2fMB and the limit is %.2fMB (will not prune at this time).'%(cacheSize/1048576., maxSize/1048576.)
+        return
+
+    if cacheSize > maxSize:
+        print 'Cache size (%.2fMB) is larger than the limit (%.2fMB). Pruning...'%(cacheSize/1048576., maxSize/1048576.)
+    pruned, cacheSize = cache.prune(maxSize, maxAge=maxAge, pinned=_getPinnedObjects(fitTrackedData))
+    if pruned:
+        print 'Pruned %d object(s) from the cache, which is now %.2fMB.'%(pruned, cacheSize/1048576.)
@@ -1,11 +1,8 @@
 #!/usr/bin/env python2.7
 
 from os.path import dirname, realpath, relpath, join as joinpath, sep as pathSeparator
-
-class FitNode:
-    def __init__(self, path, nodes):
-        self.parentPath = path
-        self.children = nodes
+from bisect import bisect_left
+import re
 
 # Returns a tree constructred from given list of paths
 def getPathTree(paths):
@@ -47,47 +44,229 @@ def _fitMapToTreeRec(fitData, path, items):
         else:
             fitData[next_path] = v
 
-def _addFitItemsToList(path, node, items):
-    # keep a queue of nodes, adding all leafs to fitPaths
-    nodes = [FitNode(path, node)]
-    while len(nodes) > 0:
-        node = nodes.pop(0)
-        if len(node.children) == 0:
-            #Replacement of '\\' is needed(Windows) since cache is already formed and it has paths in UNIX format
-            items.add(node.parentPath.replace('\\', '/'))
+# A sorted index of paths, in which the paths under a directory (or starting
+# with any string) are next to each other, so that they can be found by binary
+# search rather than by looking at all the paths
+class PathIndex(object):
+    def __init__(self, paths):
+        self.paths = sorted(paths)
+
+    # The paths starting with the given string
+    def startingWith(self, prefix):
+        start = bisect_left(self.paths, prefix)
+        end = start
+        while end < len(self.paths) and self.paths[end].startswith(prefix):
+            end += 1
+        return self.paths[start:end]
+
+    # The path itself, if it is in the index, and all the paths under it ('' is
+    # the top of the repository)
+    def under(self, path):
+        if not path:
+            return list(self.paths)
+        # The paths under directory p sort between "p/" and "p0" ('0' follows '/')
+        found = self.paths[bisect_left(self.paths, path+'/'):bisect_left(self.paths, path+'0')]
+        i = bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            found.append(path)
+        return found
+
+    # The paths matching the given pathspec (see Pathspec)
+    def match(self, pathspec):
+        if pathspec.icase:
+            return [p for p in self.paths if pathspec.matches(p)]
+        if not pathspec.hasWildcards():
+            return self.under(pathspec.path)
+        return [p for p in self.startingWith(pathspec.path[:pathspec.literalLength]) if pathspec.matches(p)]
+
+_pathspecMagicWords = ('top', 'literal', 'glob', 'icase', 'exclude')
+_pathspecWildcards = '*?[\\'
+
+# A path argument, which can use git's pathspec magic, either in the long form
+# (":(glob,icase)textures/**/*.dds") or with the short mnemonics (":/" for top,
+# ":!" or ":^" for exclude). Like with git, wildcards in the path match across
+# directory separators, unless the glob magic is given, in which case they
+# follow the rules of git's glob patterns ("**" matching any number of
+# directories). Paths are relative to workingDir (or basePath, with the top
+# magic), and are turned into paths relative to basePath. path is None if the
+# argument is outside basePath.
+class Pathspec(object):
+    def __init__(self, arg, basePath='', workingDir=''):
+        self.arg = arg
+        magic, path = _parsePathspecMagic(arg)
+        self.literal = 'literal' in magic
+        self.glob = 'glob' in magic
+        self.icase = 'icase' in magic
+        self.exclude = 'exclude' in magic
+        self.path = None
+        self.regex = None
+
+        # Only the part of the path before its first wildcard can be normalized
+        literalLength = len(path)
+        if not self.literal:
+            literalLength = min(path.index(c) if c in path else len(path) for c in _pathspecWildcards)
+        leadingDir = path[:path.rfind('/', 0, literalLength)+1]
+        root = basePath if 'top' in magic else workingDir
+        normalized = relpath(realpath(joinpath(root, leadingDir or '.')), basePath).replace(pathSeparator, '/')
+        if normalized == '..' or normalized.startswith('../'):
+            return
+
+        if literalLength == len(path):
+            normalized = relpath(realpath(joinpath(root, path or '.')), basePath).replace(pathSeparator, '/')
+            self.path = '' if normalized == '.' else normalized
+            self.literalLength = len(self.path)
+            if self.icase and self.path:
+                self.regex = re.compile(re.escape(self.path)+r'(?:/.*)?\Z', re.I | re.S)
+            return
+
+        prefix = '' if normalized == '.' else normalized+'/'
+        self.path = prefix + path[len(leadingDir):]
+        self.literalLength = len(prefix) + literalLength - len(leadingDir)
+        pattern = re.escape(prefix) + _translateWildcards(path[len(leadingDir):], self.glob)
+        self.regex = re.compile(pattern, (re.I if self.icase else 0) | re.S)
+
+    def hasWildcards(self):
+        return self.path != None and self.literalLength < len(self.path)
+
+    # The leading directory of the paths the pathspec can match ('' for all)
+    def getLeadingDir(self):
+        return self.path[:self.path.rfind('/', 0, self.literalLength)+1].rstrip('/') if self.hasWildcards() else self.path
+
+    def matches(self, p):
+        if self.regex:
+            return bool(self.regex.match(p))
+        return not self.path or p == self.path or p.startswith(self.path+'/')
+
+def _parsePathspecMagic(arg):
+    if not arg.startswith(':'):
+        return set(), arg
+
+    if arg.startswith(':('):
+        end = arg.find(')')
+        if end < 0:
+            raise Exception('error: Missing \')\' at the end of pathspec magic in \'%s\'.'%arg)
+        magic = {w.strip() for w in arg[2:end].split(',') if w.strip()}
+        for w in magic - set(_pathspecMagicWords):
+            raise Exception('error: Invalid pathspec magic \'%s\' in \'%s\'.'%(w, arg))
+        return magic, arg[end+1:]
+
+    magic = set()
+    i = 1
+    while i < len(arg) and arg[i] in '/!^':
+        magic.add('top' if arg[i] == '/' else 'exclude')
+        i += 1
+    if i < len(arg) and arg[i] == ':':
+        i += 1
+    return magic, arg[i:]
+
+# Returns a regular expression matching the paths the wildcard pattern matches
+def _translateWildcards(pattern, glob):
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            j = i
+            while j < n and pattern[j] == '*':
+                j += 1
+            # With glob, "**" only matches across directories as a whole
+            # component: "**/a", "a/**/b" and "a/**"
+            if glob and j-i == 2 and (i == 0 or pattern[i-1] == '/') and (j == n or pattern[j] == '/'):
+                if j == n:
+                    out.append('.*')
+                else:
+                    out.append('(?:.*/)?')
+                    j += 1
+            else:
+                out.append('[^/]*' if glob else '.*')
+            i = j
+        elif c == '?':
+            out.append('[^/]' if glob else '.')
+            i += 1
+        elif c == '[':
+            j = i+1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 2 if pattern[j] == '\\' else 1
+            if j >= n:
+                out.append(re.escape(c))
+                i += 1
+                continue
+            body = pattern[i+1:j]
+            negate = body[:1] in ('!', '^')
+            chars = []
+            k = 1 if negate else 0
+            while k < len(body):
+                if body[k] == '\\' and k+1 < len(body):
+                    k += 1
+                chars.append('-' if body[k] == '-' and chars and k+1 < len(body) else re.escape(body[k]))
+                k += 1
+            if negate:
+                out.append('[^%s%s]'%('/' if glob else '', ''.join(chars)))
+            else:
+                out.append('[%s]'%''.join(chars))
+            i = j+1
+        elif c == '\\' and i+1 < n:
+            out.append(re.escape(pattern[i+1]))
+            i += 2
         else:
-            nodes.extend([FitNode(node.parentPath.replace('\\', '/') + '/' + k, v) for k,v in node.children.iteritems()])
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out) + r'\Z'
+
+# Returns the given paths as canonical paths relative to basePath, leaving out
+# those not under it, or None if one of them is basePath itself. Pathspecs with
+# wildcards give the directory their literal part is in, excluding ones are
+# left out, and case-insensitive ones (like only having excluding ones) stand
+# for all of basePath.
+def getPathPrefixes(given, basePath='', workingDir=''):
+    pathspecs = [Pathspec(p, basePath, workingDir) for p in given]
+    prefixes = set()
+    for s in pathspecs:
+        if s.exclude or s.path == None:
+            continue
+        if s.icase or not s.getLeadingDir():
+            return None
+        prefixes.add(s.getLeadingDir())
+    if not any(not s.exclude for s in pathspecs):
+        return None
+    return sorted(prefixes)
 
-def getValidFitPaths(given, available, basePath='', workingDir=''):
+# Returns the items in available (a PathIndex, or any iterable of paths) and in
+# others (paths not in available) that the given path arguments (see Pathspec)
+# select: those at or under the given paths, or matching their wildcards, less
+# those matching an excluding one. A PathIndex kept for a .fit file (see
+# FitManifest.getPathIndex) can so be given as is, with only the paths from
+# elsewhere to index.
+def getValidFitPaths(given, available, basePath='', workingDir='', others=()):
     if not given:
         return None
 
-    # Normalize the user-entered paths into canonical paths relative to basePath
-    given = {relpath(realpath(joinpath(workingDir,p)), basePath) for p in given}
-    validPaths = set(available) if '.' in given else set()
-    fitPathTree = getPathTree(available)
+    indexes = [available if isinstance(available, PathIndex) else PathIndex(available)]
+    if others:
+        indexes.append(PathIndex(others))
+    match = lambda s: [p for index in indexes for p in index.match(s)]
+    pathspecs = [Pathspec(p, basePath, workingDir) for p in given]
+    includes = [s for s in pathspecs if not s.exclude]
+    excludes = [s for s in pathspecs if s.exclude]
 
-    # Generate list of individual fit items under user-given paths
-    for p in given:
-        if p.startswith('..' + pathSeparator):
-            print '(...skipping path not under repo: %s)'%p
+    validPaths = set() if includes else set(p for index in indexes for p in index.paths)
+    for s in includes:
+        if s.path == None:
+            print '(...skipping path not under repo: %s)'%s.arg
             continue
 
-        # Determine if normalized user-given path is one that
-        # is tracked by fit by traversing fitPathTree
-        isFit = True
-        node = fitPathTree
-        parts = p.split(pathSeparator)
-        for part in parts:
-            node = node.get(part)
-            if node == None:
-                isFit = False
-                break
-
-        if not isFit:
-            print '(...path not currently tracked by fit: %s)'%p
+        matched = match(s)
+        if not matched:
+            print '(...path not currently tracked by fit: %s)'%(s.path if not s.hasWildcards() else s.arg)
             continue
+        validPaths.update(matched)
 
-        _addFitItemsToList(p, node, validPaths)
+    for s in excludes:
+        if s.path != None:
+            validPaths.difference_update(match(s))
 
     return validPaths
@@ -0,0 +1,191 @@
+import fitlib
+from subprocess import Popen as popen, PIPE
+from os import read, devnull
+from binascii import hexlify
+from threading import Thread as thread, Lock
+import atexit
+
+# Long-lived git plumbing processes, which answer one query after another on
+# their standard input: cat-file --batch-check and --batch to look up and read
+# objects, check-attr --stdin for attributes and hash-object --stdin-paths for
+# hashes. Each kind is started the first time it is needed and kept until
+# reset(), so that a git-fit invocation (a hook in particular) forks git once
+# for all the queries of one kind, rather than once per query.
+#
+# The processes run at the top of the working tree, with the environment they
+# were started with. For as long as they run, git keeps some of what it reads:
+# the index, and the .gitattributes files. So reset() must be called after
+# those change (git-fit checking out .gitattributes files), and by the server
+# between requests. Each process is used by one thread at a time.
+_processes = {}
+_processesLock = Lock()
+
+class _Process(object):
+    def __init__(self, args):
+        # Closing the other descriptors matters: one inherited from a pipe
+        # another thread is reading would never see the end of its output
+        self.process = popen(['git']+args, cwd=fitlib.repoDir, stdin=PIPE, stdout=PIPE, stderr=open(devnull, 'wb'), close_fds=True)
+        self.lock = Lock()
+        self.buffer = ''
+        self.pos = 0
+
+    def write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def _fill(self):
+        chunk = read(self.process.stdout.fileno(), 65536)
+        if not chunk:
+            raise EOFError()
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def readUntil(self, sep):
+        while True:
+            i = self.buffer.find(sep, self.pos)
+            if i >= 0:
+                data = self.buffer[self.pos:i]
+                self.pos = i+len(sep)
+                return data
+            self._fill()
+
+    def readExactly(self, size):
+        data = [self.buffer[self.pos:self.pos+size]]
+        self.pos += len(data[0])
+        size -= len(data[0])
+        while size > 0:
+            chunk = read(self.process.stdout.fileno(), max(size, 65536))
+            if not chunk:
+                raise EOFError()
+            data.append(chunk[:size])
+            self.buffer, self.pos = chunk, len(data[-1])
+            size -= len(data[-1])
+        return ''.join(data)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+# Runs query(process) with the process for the given git arguments, starting it
+# if needed. A process that fails (e.g. git hash-object given a file it cannot
+# read exits) is dropped, to be started again by the next query.
+def _query(args, query):
+    with _processesLock:
+        process = _processes.get(args)
+        if not process:
+            process = _processes[args] = _Process(list(args))
+
+    with process.lock:
+        try:
+            return query(process)
+        except (IOError, OSError, EOFError):
+            with _processesLock:
+                if _processes.get(args) is process:
+                    del _processes[args]
+            process.process.kill()
+            process.process.wait()
+            raise Exception('error: git %s stopped unexpectedly.'%args[0])
+
+def _writeAll(process, data):
+    try:
+        process.write(data)
+    except IOError:
+        pass
+
+# Writes data for the process from another thread, so that a lot of it can go
+# in while the answers are read
+def _writeInBackground(process, data):
+    writer = thread(target=_writeAll, args=(process, data))
+    writer.daemon = True
+    writer.start()
+    return writer
+
+def _parseObjectInfo(line):
+    fields = line.split()
+    if len(fields) != 3 or not fields[2].isdigit():
+        return None
+    return fields[0], fields[1], int(fields[2])
+
+# Returns the (hash, type, size) of the object name refers to (anything git
+# rev-parse takes, such as HEAD@{1} or HEAD:.fit), or None if there is none
+def getObjectInfo(name):
+    if '\n' in name:
+        return None
+
+    def query(process):
+        process.write(name+'\n')
+        return _parseObjectInfo(process.readUntil('\n'))
+    return _query(('cat-file', '--batch-check'), query)
+
+# Returns the contents of the object name refers to, or None if there is none
+def readObject(name):
+    if '\n' in name:
+        return None
+
+    def query(process):
+        process.write(name+'\n')
+        info = _parseObjectInfo(process.readUntil('\n'))
+        if not info:
+            return None
+        data = process.readExactly(info[2])
+        process.readExactly(1)
+        return data
+    return _query(('cat-file', '--batch'), query)
+
+# Returns the [(mode, name, hash)] entries of the tree name refers to (such as
+# HEAD: or HEAD:some/dir), or None if there is no such tree
+def listTree(name):
+    info = getObjectInfo(name)
+    if not info or info[1] != 'tree':
+        return None
+    data = readObject(info[0]) or ''
+
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        entries.append((data[pos:space], data[space+1:nul], hexlify(data[nul+1:nul+21])))
+        pos = nul+21
+    return entries
+
+# Returns [(path, attribute, value)] for the given attributes of the paths
+# (relative to the top of the working tree), like git check-attr -z
+def checkAttr(paths, attributes):
+    paths = list(paths)
+    if not paths:
+        return []
+
+    def query(process):
+        writer = _writeInBackground(process, ''.join(p+'\0' for p in paths))
+        fields = [process.readUntil('\0') for i in xrange(3*len(paths)*len(attributes))]
+        writer.join()
+        return zip(fields[0::3], fields[1::3], fields[2::3])
+    return _query(('check-attr', '-z', '--stdin') + tuple(attributes), query)
+
+# Returns the hashes git gives the contents of the files at the given paths,
+# after converting them as it would when adding them
+def hashObjects(paths):
+    paths = list(paths)
+    if not paths:
+        return []
+
+    def query(process):
+        writer = _writeInBackground(process, ''.join(p+'\n' for p in paths))
+        hashes = [process.readUntil('\n') for p in paths]
+        writer.join()
+        return hashes
+    return _query(('hash-object', '--stdin-paths'), query)
+
+# Ends all the processes. They are started again as needed.
+def reset():
+    with _processesLock:
+        processes = _processes.values()
+        _processes.clear()
+    for p in processes:
+        try:
+            p.close()
+        except (IOError, OSError):
+            pass
+
+atexit.register(reset)
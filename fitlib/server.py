@@ -0,0 +1,336 @@
+from . import fitDir, repoDir, memoizeFiles
+import fitlib, materialize, plumbing
+from os import chdir, getcwd, environ, remove, setsid, devnull, pipe, dup, dup2, read, close, umask, getuid
+from os.path import join as joinpath, exists
+from socket import socket, error as SocketError, AF_UNIX, SOCK_STREAM, SOL_SOCKET
+from struct import Struct
+from subprocess import Popen as popen
+from json import dumps, loads
+from time import sleep
+from threading import Thread as thread, Lock
+from traceback import format_exc
+import errno
+import signal
+import sys
+
+# A git-fit server keeps running in the background for one repository, so that
+# commands (including the ones run by the git hooks) don't each have to start
+# up from scratch. It keeps the parsed .fit and stat files and the cache index
+# around between requests. The git-fit command line hands each invocation to the
+# server when one is running, and runs it in-process otherwise.
+#
+# A request is one line of JSON with the product version, command line, working
+# directory and environment of the client. The server answers with a stream of
+# frames, each a one-byte type and a 4-byte length or code:
+#   o<length><data>  output to print
+#   e<length><data>  output to print to stderr (including that of the git
+#                    processes the command runs)
+#   i<size>          the command reads size bytes of input (all of it if -1)
+#   l<0>             the command reads a line of input
+#   x<code>          end of the output, with the exit code
+#   r<0>             the request was refused (e.g. version mismatch), so the
+#                    client must run the command itself
+# The client answers each i and l frame with a d<length><data> frame of what it
+# read from its stdin (nothing at the end of it). Processes the command runs
+# get no input. Requests are handled one at a time.
+socketFile = joinpath(fitDir, 'server.sock')
+
+_frame = Struct('>ci')
+
+# A request runs with the client's environment, which is as good as running any
+# command, so only the user running the server may connect: the socket is only
+# accessible to them, and (where the system tells) the user at the other end of
+# each connection is checked too
+SO_PEERCRED = 17           # from asm-generic/socket.h
+_peerCred = Struct('3i')    # pid, uid, gid
+
+# Set in the environment of everything a request runs, so that git commands run
+# by the server that trigger hooks (or the merge and textconv drivers) don't try
+# to hand those back to the busy server
+servingEnvKey = 'GIT_FIT_SERVING'
+
+# Frames can be sent by the thread forwarding stderr as well as by the command
+class _SocketOutput(object):
+    def __init__(self, conn, lock, kind='o'):
+        self.conn = conn
+        self.lock = lock
+        self.kind = kind
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            with self.lock:
+                self.conn.sendall(_frame.pack(self.kind, len(data)) + data)
+
+    def writelines(self, lines):
+        for l in lines:
+            self.write(l)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class _SocketInput(object):
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def _request(self, kind, size):
+        with self.lock:
+            self.conn.sendall(_frame.pack(kind, size))
+        kind, size = _frame.unpack(_recvExactly(self.conn, _frame.size))
+        return _recvExactly(self.conn, size) if kind == 'd' else ''
+
+    def read(self, size=-1):
+        return self._request('i', size)
+
+    def readline(self, size=-1):
+        return self._request('l', 0)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def isatty(self):
+        return False
+
+# Sends what is written to the read end of a pipe to the client as stderr frames
+def _forwardErrors(fd, out):
+    try:
+        for chunk in iter(lambda: read(fd, 65536), ''):
+            out.write(chunk)
+    except (SocketError, OSError):
+        pass
+    finally:
+        close(fd)
+
+def _connect():
+    conn = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        conn.connect(socketFile)
+    except SocketError:
+        conn.close()
+        return None
+    return conn
+
+def _recvExactly(conn, size):
+    data = ''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+# Hands the command line to the server, printing its output as it comes. Returns
+# the exit code, or None if there is no server to run the command.
+def runRemote(argv, version):
+    if servingEnvKey in environ or not exists(socketFile):
+        return None
+
+    conn = _connect()
+    if not conn:
+        return None
+
+    try:
+        request = dumps({'version':version, 'argv':argv, 'cwd':getcwd(), 'env':dict(environ)})
+    except UnicodeDecodeError:
+        conn.close()
+        return None
+
+    try:
+        conn.sendall(request + '\n')
+        while True:
+            kind, value = _frame.unpack(_recvExactly(conn, _frame.size))
+            if kind in 'oe':
+                out = sys.stdout if kind == 'o' else sys.stderr
+                out.write(_recvExactly(conn, value))
+                out.flush()
+            elif kind in 'il':
+                data = sys.stdin.readline() if kind == 'l' else sys.stdin.read(*([value] if value >= 0 else []))
+                conn.sendall(_frame.pack('d', len(data)) + data)
+            elif kind == 'x':
+                return value
+            else:
+                return None
+    except (SocketError, EOFError):
+        # The server went away mid-request; whatever it has done is done, so
+        # only report the failure rather than running the command again
+        print 'error: Lost connection to the git-fit server.'
+        return 1
+    finally:
+        conn.close()
+
+# Returns the uid of the process at the other end of conn, or None if the
+# system does not tell (SO_PEERCRED is Linux only)
+def _getPeerUid(conn):
+    if not sys.platform.startswith('linux'):
+        return None
+    return _peerCred.unpack(conn.getsockopt(SOL_SOCKET, SO_PEERCRED, _peerCred.size))[1]
+
+def _readRequest(conn):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return loads(data)
+
+# Path arguments are relative to the directory git-fit was run from, which is
+# looked up once, when fitlib is imported
+def _setWorkingDir(workingDir):
+    import changes, objects
+    for m in (fitlib, changes, objects):
+        m.workingDir = workingDir
+
+# Runs one request with the client's command line, working directory and
+# environment, sending everything it prints (to stdout or stderr) back to the
+# client, and reading its input from the client
+def _serve(conn, main, version):
+    request = _readRequest(conn)
+    argv = [a.encode('utf-8') for a in request['argv']]
+    if argv[1:] == ['--server=stop']:
+        conn.sendall(_frame.pack('x', 0))
+        return False
+
+    # A server left running by another version of git-fit gives way
+    if request['version'] != version:
+        conn.sendall(_frame.pack('r', 0))
+        return False
+
+    serverEnv = dict(environ)
+    savedArgv = list(sys.argv)
+    savedStdout, savedStdin = sys.stdout, sys.stdin
+    lock = Lock()
+
+    # Everything written to fd 2 (by git-fit or the processes it runs) goes
+    # through a pipe to the client
+    errorsIn, errorsOut = pipe()
+    savedStderr = dup(2)
+    dup2(errorsOut, 2)
+    close(errorsOut)
+    forwarder = thread(target=_forwardErrors, args=(errorsIn, _SocketOutput(conn, lock, 'e')))
+    forwarder.daemon = True
+    forwarder.start()
+
+    code = 0
+    try:
+        environ.clear()
+        environ.update((k.encode('utf-8'), v.encode('utf-8')) for k,v in request['env'].iteritems())
+        environ[servingEnvKey] = '1'
+        chdir(request['cwd'])
+        _setWorkingDir(request['cwd'].encode('utf-8'))
+        sys.argv[:] = argv
+        sys.stdout = _SocketOutput(conn, lock)
+        sys.stdin = _SocketInput(conn, lock)
+        materialize._state.clear()
+        fitlib._configMemo.clear()
+        try:
+            main()
+        except SystemExit as e:
+            if isinstance(e.code, basestring):
+                print e.code
+                code = 1
+            else:
+                code = e.code or 0
+        except Exception:
+            print format_exc(),
+            code = 1
+    finally:
+        sys.stdout, sys.stdin = savedStdout, savedStdin
+        sys.stderr.flush()
+        dup2(savedStderr, 2)
+        close(savedStderr)
+        sys.argv[:] = savedArgv
+        environ.clear()
+        environ.update(serverEnv)
+        chdir(repoDir)
+        _setWorkingDir(repoDir)
+        # The git processes of the request ran with its environment
+        plumbing.reset()
+
+    # Processes left running in the background could keep the pipe open
+    forwarder.join(1)
+    with lock:
+        conn.sendall(_frame.pack('x', code))
+    return True
+
+# Serves requests in the foreground until stopped. main is the git-fit entry
+# point, run in-process for each request with sys.argv set to its command line.
+def run(main, version):
+    if _connect():
+        print 'error: A git-fit server is already running for this repository.'
+        return 1
+    if exists(socketFile):
+        remove(socketFile)
+
+    # Clients going away must not take the server down with them
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+    listener = socket(AF_UNIX, SOCK_STREAM)
+    savedUmask = umask(077)
+    try:
+        listener.bind(socketFile)
+    finally:
+        umask(savedUmask)
+    listener.listen(16)
+    memoizeFiles()
+    try:
+        serving = True
+        while serving:
+            conn = listener.accept()[0]
+            try:
+                if _getPeerUid(conn) not in (None, getuid()):
+                    conn.sendall(_frame.pack('r', 0))
+                    continue
+                serving = _serve(conn, main, version)
+            except (SocketError, ValueError, KeyError) as e:
+                # A client that went away or sent garbage only ends its own request
+                if isinstance(e, SocketError) and e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        exists(socketFile) and remove(socketFile)
+    return 0
+
+# Starts the server in the background with the given command line and waits
+# until it accepts requests
+def start(cmd):
+    if _connect():
+        print 'A git-fit server is already running for this repository.'
+        return 0
+
+    null = open(devnull, 'r+')
+    p = popen(cmd, cwd=repoDir, stdin=null, stdout=null, stderr=null, close_fds=True, preexec_fn=setsid)
+    while p.poll() == None:
+        conn = _connect()
+        if conn:
+            conn.close()
+            print 'Started git-fit server (pid %d).'%p.pid
+            return 0
+        sleep(0.01)
+
+    print 'error: The git-fit server could not be started. Run "git-fit --server=run" to see why.'
+    return 1
+
+def stop():
+    conn = _connect()
+    if not conn:
+        print 'No git-fit server is running for this repository.'
+        return 0
+    conn.close()
+
+    runRemote(['git-fit', '--server=stop'], None)
+    while exists(socketFile):
+        sleep(0.01)
+    print 'Stopped git-fit server.'
+    return 0
@@ -0,0 +1,378 @@
+from . import repoDir, gitDir, watchDir
+from os import read, remove, rename, kill, walk, getpid, makedirs, setsid, devnull, urandom, close as osclose
+from os.path import exists, join as joinpath, abspath
+from struct import Struct
+from subprocess import Popen as popen
+from binascii import hexlify
+from time import time, sleep
+from errno import ESRCH, EINTR
+import signal
+import ctypes
+
+# The watcher is a daemon that uses Linux inotify to keep a journal of the
+# working tree paths that changed since it was started, so that status does not
+# have to stat every tracked item and list the whole working tree to find them.
+# Its files live in watchDir:
+#   state     "<pid> <session>" of the running watcher, written once its watches
+#             are in place. A new session starts whenever the journal is reset.
+#   journal   One line per event: a changed path, a changed directory (with a
+#             trailing slash, meaning any path under it may have changed), or a
+#             marker line starting with "!":
+#               !cookie <name>  a client's sync cookie was seen (see _sync)
+#               !index          the git index or info/attributes changed, so
+#                               which paths are fit items must be found again
+#               !rescan         events were lost, a full scan is needed
+#   clean     "<session> <offset>" up to which the journal has been applied to
+#             the stat cache, followed by the fit items in the working tree at
+#             that point, one per line.
+# Attributes set through core.attributesFile are not watched.
+journalFile = joinpath(abspath(watchDir), 'journal')
+stateFile = joinpath(abspath(watchDir), 'state')
+cleanFile = joinpath(abspath(watchDir), 'clean')
+absRepoDir = abspath(repoDir)
+absGitDir = abspath(gitDir)
+absWatchDir = abspath(watchDir)
+
+# Seconds a client waits for the watcher to see its sync cookie before falling
+# back to a full scan
+syncTimeout = 2.0
+
+# The journal is reset (starting a new session) once it grows past this size
+journalMaxSize = 16777216
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_EXCL_UNLINK = 0x4000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 02000000
+
+_treeMask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+_gitMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of name
+_eventHeader = Struct('iIII')
+
+# The symbols of the running process include libc's, which saves looking for
+# libc by name (which would run ldconfig)
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError):
+    _libc = None
+
+def isSupported():
+    return _libc != None
+
+def _readState():
+    try:
+        pid, session = open(stateFile).read().split()
+        return int(pid), session
+    except (IOError, ValueError):
+        return None
+
+def _writeFile(filePath, data):
+    tempPath = '%s.%s'%(filePath, hexlify(urandom(16)))
+    f = open(tempPath, 'wb')
+    f.write(data)
+    f.close()
+    rename(tempPath, filePath)
+
+def _isRunning(pid):
+    try:
+        kill(pid, 0)
+    except OSError as e:
+        return e.errno != ESRCH
+    return True
+
+def _readCleanPoint():
+    try:
+        f = open(cleanFile, 'rb')
+    except IOError:
+        return None
+    try:
+        session, offset = f.readline().split()
+        return session, int(offset), {l[:-1] for l in f}
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+# Makes sure the watcher has journaled every change made before this call, by
+# creating a cookie file and waiting for the watcher to journal it. Since all
+# events come through one queue in order, everything before the cookie is then
+# in the journal as well. Returns the journal lines from start up to the cookie
+# and the offset just after it, or None if the watcher doesn't respond in time.
+def _sync(start):
+    name = 'cookie-%s'%hexlify(urandom(16))
+    marker = '!cookie %s'%name
+    cookie = joinpath(absWatchDir, name)
+    open(cookie, 'w').close()
+    try:
+        journal = open(journalFile, 'rb')
+        journal.seek(start)
+        lines = []
+        offset = start
+        pending = ''
+        deadline = time() + syncTimeout
+        while True:
+            data = journal.read()
+            if not data:
+                if time() > deadline:
+                    return None
+                sleep(0.001)
+                continue
+            data = pending + data
+            end = data.rfind('\n') + 1
+            pending = data[end:]
+            for l in data[:end].splitlines():
+                offset += len(l) + 1
+                if l == marker:
+                    return lines, offset
+                lines.append(l)
+    except IOError:
+        return None
+    finally:
+        remove(cookie)
+
+# Returns (token, dirty, tracked) if the watcher is running, or None otherwise.
+# dirty is the set of paths and directories (with a trailing slash) that may
+# have changed since the last acknowledged scan, and tracked the fit items in
+# the working tree at that point. dirty is None if a full scan is needed, and
+# tracked is None if which paths are fit items must be found out again. Pass
+# token to acknowledge() once the changes have been applied to the stat cache.
+def getChanges():
+    state = _readState()
+    if not state or not _isRunning(state[0]):
+        return None
+    session = state[1]
+
+    clean = _readCleanPoint()
+    valid = clean and clean[0] == session
+    synced = _sync(clean[1] if valid else 0)
+    if not synced or _readState() != state:
+        return None
+    lines, offset = synced
+
+    token = (session, offset)
+    if not valid:
+        return token, None, None
+
+    dirty = set()
+    tracked = clean[2]
+    for l in lines:
+        if l == '!rescan':
+            return token, None, None
+        elif l == '!index':
+            tracked = None
+        elif not l.startswith('!'):
+            dirty.add(l)
+
+    return token, dirty, tracked
+
+# Records that all changes journaled up to token have been applied to the stat
+# cache, and that trackedItems are the fit items in the working tree as of then
+def acknowledge(token, trackedItems):
+    session, offset = token
+    _writeFile(cleanFile, '%s %d\n%s'%(session, offset, ''.join('%s\n'%i for i in trackedItems)))
+
+# Returns a function telling whether the given path may have changed according
+# to the dirty set returned by getChanges()
+def getDirtyFilter(dirty):
+    dirs = tuple(p for p in dirty if p.endswith('/'))
+    return lambda p: p in dirty or p.startswith(dirs)
+
+class _TreeWatcher(object):
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        self.wds = {}
+        self.gitWds = {}
+
+    def _addWatch(self, path, mask):
+        wd = _libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch %s (check fs.inotify.max_user_watches)'%path)
+        return wd
+
+    # Watches relDir and every directory below it, except for .git directories
+    def addTree(self, relDir):
+        for top, dirnames, filenames in walk(joinpath(absRepoDir, relDir)):
+            dirnames[:] = [d for d in dirnames if d != '.git']
+            rel = top[len(absRepoDir)+1:]
+            try:
+                wd = self._addWatch(top, _treeMask)
+            except OSError:
+                if exists(top):
+                    raise
+                continue
+            self.dirs[wd] = rel
+            self.wds[rel] = wd
+
+    # Stops watching relDir and everything below it, since its watches would
+    # report the old paths after a move
+    def removeTree(self, relDir):
+        prefix = relDir + '/'
+        for rel in [r for r in self.wds if r == relDir or r.startswith(prefix)]:
+            wd = self.wds.pop(rel)
+            del self.dirs[wd]
+            _libc.inotify_rm_watch(self.fd, wd)
+
+    def start(self):
+        self.addTree('')
+        self.gitWds[self._addWatch(absGitDir, _gitMask)] = 'index'
+        infoDir = joinpath(absGitDir, 'info')
+        if exists(infoDir):
+            self.gitWds[self._addWatch(infoDir, _gitMask)] = 'attributes'
+        self.watchWd = self._addWatch(absWatchDir, IN_CREATE | IN_ONLYDIR)
+
+    def getEvents(self):
+        try:
+            data = read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == EINTR:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _eventHeader.unpack_from(data, offset)
+            offset += _eventHeader.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            yield wd, mask, name
+
+    # Turns the events of one read into journal lines, in order, without repeats
+    def getJournalLines(self):
+        lines = []
+        seen = set()
+        def add(line):
+            if line not in seen:
+                seen.add(line)
+                lines.append(line)
+
+        for wd, mask, name in self.getEvents():
+            if mask & IN_Q_OVERFLOW:
+                add('!rescan')
+            elif wd == self.watchWd:
+                if name.startswith('cookie-') and mask & IN_CREATE:
+                    add('!cookie %s'%name)
+            elif wd in self.gitWds:
+                if name == self.gitWds[wd]:
+                    add('!index')
+            elif mask & IN_IGNORED:
+                rel = self.dirs.pop(wd, None)
+                if rel != None and self.wds.get(rel) == wd:
+                    del self.wds[rel]
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if self.dirs.get(wd) == '':
+                    raise SystemExit('The working tree has been removed')
+            elif wd in self.dirs:
+                rel = joinpath(self.dirs[wd], name)
+                if '\n' in rel:
+                    add('!rescan')
+                elif mask & IN_ISDIR:
+                    if name == '.git':
+                        continue
+                    if mask & IN_MOVED_FROM:
+                        self.removeTree(rel)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        self.addTree(rel)
+                    add(rel + '/')
+                else:
+                    add(rel)
+
+        return lines
+
+def _startSession(journal):
+    session = hexlify(urandom(16))
+    journal.seek(0)
+    journal.truncate()
+    _writeFile(stateFile, '%d %s'%(getpid(), session))
+
+def _onTerminate(signum, frame):
+    raise SystemExit()
+
+# Runs the watcher in the foreground until it is stopped
+def run():
+    if not isSupported():
+        print 'error: The fit watcher needs Linux inotify, which is not available here.'
+        return 1
+
+    state = _readState()
+    if state and _isRunning(state[0]) and state[0] != getpid():
+        print 'error: A fit watcher is already running for this repository (pid %d).'%state[0]
+        return 1
+
+    exists(absWatchDir) or makedirs(absWatchDir)
+    signal.signal(signal.SIGTERM, _onTerminate)
+    signal.signal(signal.SIGINT, _onTerminate)
+
+    watcher = _TreeWatcher()
+    journal = open(journalFile, 'ab')
+    try:
+        watcher.start()
+        _startSession(journal)
+        while True:
+            lines = watcher.getJournalLines()
+            if not lines:
+                continue
+            journal.write(''.join('%s\n'%l for l in lines))
+            journal.flush()
+            if journal.tell() > journalMaxSize:
+                _startSession(journal)
+    finally:
+        state = _readState()
+        if state and state[0] == getpid():
+            remove(stateFile)
+        journal.close()
+        osclose(watcher.fd)
+
+# Starts the watcher in the background with the given command line and waits
+# for its watches to be in place
+def start(cmd):
+    if not isSupported():
+        print 'error: The fit watcher needs Linux inotify, which is not available here.'
+        return 1
+
+    state = _readState()
+    if state and _isRunning(state[0]):
+        print 'A fit watcher is already running for this repository (pid %d).'%state[0]
+        return 0
+
+    null = open(devnull, 'r+')
+    p = popen(cmd, cwd=absRepoDir, stdin=null, stdout=null, stderr=null, close_fds=True, preexec_fn=setsid)
+    while p.poll() == None:
+        state = _readState()
+        if state and state[0] == p.pid:
+            print 'Started fit watcher (pid %d).'%p.pid
+            return 0
+        sleep(0.01)
+
+    print 'error: The fit watcher could not be started. Run "git-fit --watch=run" to see why.'
+    return 1
+
+def stop():
+    state = _readState()
+    if not state or not _isRunning(state[0]):
+        print 'No fit watcher is running for this repository.'
+        return 0
+
+    kill(state[0], signal.SIGTERM)
+    while _isRunning(state[0]) and _readState() == state:
+        sleep(0.01)
+    print 'Stopped fit watcher (pid %d).'%state[0]
+    return 0
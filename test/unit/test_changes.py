@@ -1,2 +1,13 @@
 import unittest
 
+from fitlib import changes
+
+class TestInBackground(unittest.TestCase):
+    def testResult(self):
+        self.assertEqual(3, changes._inBackground('test', lambda a,b: a+b, 1, 2)())
+
+    def testExitRaisedInCaller(self):
+        def exit():
+            raise SystemExit(2)
+        wait = changes._inBackground('test', exit)
+        self.assertRaises(SystemExit, wait)
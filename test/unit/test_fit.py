@@ -1,2 +1,381 @@
 import unittest
 
+import fitlib
+from tempfile import mkstemp, mkdtemp
+from os import write, close, remove
+from subprocess import Popen as popen, PIPE
+from StringIO import StringIO
+from fitlib import merge, manifest
+import random
+import marshal
+from os import path, listdir
+from shutil import rmtree
+
+class TestHashFile(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        self.files = []
+
+    def tearDown(self):
+        for f in self.files:
+            remove(f)
+
+    def makeFile(self, content):
+        handle, filePath = mkstemp()
+        write(handle, content)
+        close(handle)
+        self.files.append(filePath)
+        return filePath
+
+    def gitHash(self, filePath):
+        return popen(['git', 'hash-object', '--no-filters', filePath], stdout=PIPE).communicate()[0].strip()
+
+    def testEmpty(self):
+        filePath = self.makeFile('')
+        self.assertEqual(fitlib.zeroByteSha1, fitlib.hashFile(filePath))
+
+    def testSameAsGit(self):
+        filePath = self.makeFile('\0binary\r\n'*1000)
+        self.assertEqual(self.gitHash(filePath), fitlib.hashFile(filePath))
+
+    def testLargerThanChunk(self):
+        filePath = self.makeFile('x'*(fitlib.hashChunkSize*2+7))
+        self.assertEqual(self.gitHash(filePath), fitlib.hashFile(filePath))
+
+    def testCopiesWhileHashing(self):
+        content = 'abc'*(fitlib.hashChunkSize/2)
+        out = StringIO()
+        fitlib.hashFile(self.makeFile(content), out=out)
+        self.assertEqual(content, out.getvalue())
+
+    def testStagingCopyRemovedOnError(self):
+        tempDir = fitlib.tempDir
+        fitlib.tempDir = mkdtemp()
+        try:
+            from Queue import Queue
+            work, results = Queue(), Queue()
+            work.put((0, self.makeFile('abc'), None))
+            work.put((1, self.makeFile('abc')+'.missing', None))
+            fitlib._hashWorker(work, results, True)
+
+            done = sorted(results.get() for i in xrange(2))
+            self.assertEqual([path.basename(done[0][2])], listdir(fitlib.tempDir))
+            self.assertEqual(None, done[1][2])
+            self.assertTrue(isinstance(done[1][3], Exception))
+        finally:
+            rmtree(fitlib.tempDir)
+            fitlib.tempDir = tempDir
+
+class TestStatFile(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        handle, self.statFile = mkstemp()
+        close(handle)
+        remove(self.statFile)
+
+        # mtimes far in the past, so that no item looks racily clean
+        self.stats = {
+            'a/b.png': ('1'*40, (10, 1000, 2000, 3, 4)),
+            'a/c.png': (0, (0, 1001, 2001, 5, 4)),
+            'd.jar': ('2'*40, (30, 1002, 2002, 6, 4)),
+        }
+
+    def tearDown(self):
+        for f in (self.statFile, self.statFile+'.tmp'):
+            try:
+                remove(f)
+            except OSError:
+                pass
+
+    def testMissingFile(self):
+        self.assertEqual({}, fitlib.readStatFile(filePath=self.statFile))
+
+    def testRoundTrip(self):
+        fitlib.writeStatFile(self.stats, filePath=self.statFile)
+        self.assertEqual(self.stats, fitlib.readStatFile(filePath=self.statFile))
+
+    def testLookupSubset(self):
+        fitlib.writeStatFile(self.stats, filePath=self.statFile)
+        actual = fitlib.readStatFile(filePath=self.statFile, items={'d.jar', 'a/b.png', 'missing'})
+        self.assertEqual({i: self.stats[i] for i in ('d.jar', 'a/b.png')}, actual)
+
+    def testAppendedUpdates(self):
+        fitlib.writeStatFile(self.stats, filePath=self.statFile)
+        updated = ('3'*40, (40, 1003, 2003, 7, 4))
+        fitlib.updateStatFile({'a/c.png': updated, 'e.so': updated}, removals={'d.jar'}, filePath=self.statFile)
+
+        expected = dict(self.stats)
+        expected['a/c.png'] = expected['e.so'] = updated
+        del expected['d.jar']
+        self.assertEqual(expected, fitlib.readStatFile(filePath=self.statFile))
+        self.assertEqual({'e.so': updated}, fitlib.readStatFile(filePath=self.statFile, items={'e.so', 'd.jar'}))
+
+    def testRacilyClean(self):
+        stats = {'new.png': ('1'*40, (10, 2**62, 2000, 3, 4))}
+        fitlib.writeStatFile(stats, filePath=self.statFile)
+        h, s = fitlib.readStatFile(filePath=self.statFile)['new.png']
+        self.assertEqual((0,)+stats['new.png'][1][1:], s)
+
+    def testRacilyCleanCompacted(self):
+        racy = ('1'*40, (10, 2**62, 2000, 3, 4))
+        fitlib.writeStatFile(self.stats, filePath=self.statFile)
+        fitlib.updateStatFile({'new.png': racy}, filePath=self.statFile)
+
+        # Later appends and compacting the log keep the entry racily clean
+        minCompactSize = fitlib.statLogMinCompactSize
+        fitlib.statLogMinCompactSize = 0
+        try:
+            fitlib.updateStatFile({'e.so': self.stats['d.jar']}, filePath=self.statFile)
+            fitlib.updateStatFile({'f.so': self.stats['d.jar']}, filePath=self.statFile)
+        finally:
+            fitlib.statLogMinCompactSize = minCompactSize
+
+        stats = fitlib.readStatFile(filePath=self.statFile)
+        self.assertEqual(('1'*40, (0,)+racy[1][1:]), stats['new.png'])
+        self.assertEqual(self.stats['d.jar'], stats['f.so'])
+
+class TestFitFile(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        handle, self.fitFile = mkstemp()
+        close(handle)
+        self.fitData = {
+            'a.png': ['1'*40, 10],
+            'a/b.png': ['2'*40, 20],
+            'a/c/d.png': ['3'*40, 30],
+            'a/e.png': ['4'*40, 40],
+            'f.jar': ['5'*40, 50],
+        }
+
+    def tearDown(self):
+        fitlib._configMemo.clear()
+        remove(self.fitFile)
+
+    def write(self, fitData, manifestFormat='text', changed=None):
+        fitlib._configMemo['manifestFormat'] = manifestFormat
+        fitlib.writeFitFile(fitData, filePath=self.fitFile, changed=changed)
+        return open(self.fitFile, 'rb').read()
+
+    def testTextFormat(self):
+        expected = (
+            'a.png:[%s,10],\n'
+            'f.jar:[%s,50],\n'
+            'a:{\n'
+            'b.png:[%s,20],\n'
+            'e.png:[%s,40],\n'
+            'c:{\n'
+            'd.png:[%s,30]\n'
+            '}\n'
+            '}\n'
+        )%tuple(c*40 for c in '15243')
+        self.assertEqual(expected, self.write(self.fitData))
+        self.assertEqual(self.fitData, fitlib.readFitFile(self.fitFile))
+
+    def testPatchInPlace(self):
+        for manifestFormat in fitlib.manifestFormats:
+            self.write(self.fitData, manifestFormat)
+            fitData = dict(self.fitData)
+            fitData['a/c/d.png'] = ['6'*40, 31]
+            fitData['a.png'] = ['7'*40, 11]
+            patched = self.write(fitData, manifestFormat, changed={'a/c/d.png', 'a.png'})
+            self.assertEqual(fitData, fitlib.readFitFile(self.fitFile), manifestFormat)
+            self.assertEqual(self.write(fitData, manifestFormat), patched, manifestFormat)
+
+    def testPatchFallsBackToRewrite(self):
+        self.write(self.fitData)
+        fitData = dict(self.fitData)
+        fitData['a/b.png'] = ['6'*40, 2000]
+        self.write(fitData, changed={'a/b.png'})
+        self.assertEqual(fitData, fitlib.readFitFile(self.fitFile))
+
+        fitData['g.png'] = ['7'*40, 70]
+        self.write(fitData, changed={'g.png'})
+        self.assertEqual(fitData, fitlib.readFitFile(self.fitFile))
+
+    def testParseFitFileStatus(self):
+        self.assertEqual([], fitlib.parseFitFileStatus(''))
+        self.assertEqual([('R ', 'a/c/.fit'), (' M', '.fit')], fitlib.parseFitFileStatus('R  a/c/.fit\0a/.fit\0 M .fit'))
+
+class TestShardedFitFile(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        self.root = mkdtemp()
+        fitlib._configMemo['manifestFormat'] = 'text'
+        self.fitData = {
+            'a.png': ['1'*40, 10],
+            'a/b.png': ['2'*40, 20],
+            'a/c/d.png': ['3'*40, 30],
+            'e/f.png': ['4'*40, 40],
+            'e-g/h.png': ['5'*40, 50],
+        }
+
+    def tearDown(self):
+        fitlib._configMemo.clear()
+        rmtree(self.root)
+
+    def write(self, fitData, depth, **k):
+        fitlib._writeShardedFitFile(fitData, self.root, depth, **k)
+
+    def read(self, depth, paths=None):
+        return fitlib._readShardedFitFile(self.root, depth, paths=paths)
+
+    def shard(self, d):
+        return fitlib.readFitFile(path.join(self.root, d, '.fit'))
+
+    def fitFiles(self):
+        return {d for d,f in fitlib._findWorkingShards(self.root, 3)}
+
+    def testLayout(self):
+        self.write(self.fitData, 1)
+        self.assertEqual({'a', 'e', 'e-g'}, self.fitFiles())
+        self.assertEqual({'a.png': ['1'*40, 10]}, fitlib.readFitFile(path.join(self.root, '.fit')))
+        self.assertEqual({'b.png': ['2'*40, 20], 'c/d.png': ['3'*40, 30]}, self.shard('a'))
+        self.assertEqual(self.fitData, self.read(1))
+
+    def testPaths(self):
+        self.write(self.fitData, 1)
+        self.assertEqual({'a/c/d.png': ['3'*40, 30]}, self.read(1, paths=['a/c']))
+        self.assertEqual({'e/f.png': ['4'*40, 40]}, self.read(1, paths=['e']))
+        self.assertEqual({'a.png': ['1'*40, 10]}, self.read(1, paths=['a.png']))
+
+    def testOnlyTouchedWritten(self):
+        self.write(self.fitData, 1)
+        fitlib._writeFitFile({'f.png': ['6'*40, 60]}, path.join(self.root, 'e', '.fit'))
+
+        fitData = dict(self.fitData)
+        fitData['a/b.png'] = ['7'*40, 21]
+        del fitData['e-g/h.png']
+        self.write(fitData, 1, touched={'a/b.png', 'e-g/h.png'})
+        self.assertEqual({'a', 'e'}, self.fitFiles())
+        self.assertEqual({'f.png': ['6'*40, 60]}, self.shard('e'))
+        self.assertEqual({'b.png': ['7'*40, 21], 'c/d.png': ['3'*40, 30]}, self.shard('a'))
+
+    def testDepthChanged(self):
+        self.write(self.fitData, 1)
+        self.write(self.fitData, 2, touched=set())
+        self.assertEqual({'a/c'}, self.fitFiles())
+        self.assertEqual(self.fitData, self.read(2))
+
+class TestIsBinaryData(unittest.TestCase):
+    def testText(self):
+        self.assertFalse(fitlib.isBinaryData(''))
+        self.assertFalse(fitlib.isBinaryData('hello\r\n\tworld\n'))
+        self.assertFalse(fitlib.isBinaryData('caf\xc3\xa9 \xe2\x80\x94 utf-8'))
+        self.assertFalse(fitlib.isBinaryData('cut off \xe2\x80'))
+        self.assertFalse(fitlib.isBinaryData('caf\xe9 latin-1\n'*100))
+        self.assertFalse(fitlib.isBinaryData('\xff\xfeu\0t\0f\0-\x001\x006\0'))
+
+    def testBinary(self):
+        self.assertTrue(fitlib.isBinaryData('text with a \0 in it'))
+        self.assertTrue(fitlib.isBinaryData(''.join(chr(c) for c in range(1, 256))*4))
+        self.assertTrue(fitlib.isBinaryData('%PDF-1.4\n' + '\x01\x85\xe9\x13'*100))
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        # Enough items for several blocks, with paths that sort around a
+        # directory ('a.png' and 'a-b/c.png' both sort next to 'a/...')
+        self.fitData = {'a/%03d.png'%i: ['%040x'%i, i] for i in xrange(200)}
+        self.fitData.update({
+            'a.png': ['1'*40, 1],
+            'a-b/c.png': ['2'*40, 2],
+            'a/sub/d.png': ['3'*40, 3],
+            'b.jar': ['4'*40, 4],
+        })
+
+    def write(self, fitData):
+        out = StringIO()
+        manifest.writeManifest(out, fitData)
+        return out.getvalue()
+
+    def testRoundTrip(self):
+        self.assertEqual(self.fitData, fitlib.readManifest(self.write(self.fitData)))
+
+    def testEmpty(self):
+        self.assertEqual({}, fitlib.readManifest(self.write({})))
+        self.assertEqual({}, fitlib.readManifest(self.write({}), paths=['a']))
+
+    def testScopedRead(self):
+        data = self.write(self.fitData)
+        expected = {k:v for k,v in self.fitData.iteritems() if k.startswith('a/')}
+        self.assertEqual(expected, fitlib.readManifest(data, paths=['a']))
+        self.assertEqual({'a/sub/d.png': ['3'*40, 3]}, fitlib.readManifest(data, paths=['a/sub']))
+        self.assertEqual({k:self.fitData[k] for k in ('a/150.png', 'b.jar')}, fitlib.readManifest(data, paths=['a/150.png', 'b.jar']))
+        self.assertEqual({}, fitlib.readManifest(data, paths=['a/1']))
+
+class TestFitManifest(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+        self.paths = ['%s/%s'%(d, f) for d in ('x', 'x/y', 'x-y', 'z') for f in ('a', 'b.png', 'c')] + ['a', 'x.png']
+
+    def randomItems(self, n):
+        return [(p, ['%040x'%random.getrandbits(160), random.randint(0, 2**40)]) for p in random.sample(self.paths, n)]
+
+    def testLikeDict(self):
+        items = self.randomItems(10)
+        # Unsorted, with a path given twice
+        items.append((items[0][0], ['f'*40, 7]))
+        expected = dict(items)
+        fitManifest = fitlib.FitManifest(items)
+        self.assertEqual(expected, fitManifest)
+        self.assertEqual(sorted(expected), list(fitManifest))
+        self.assertEqual(['f'*40, 7], fitManifest[items[0][0]])
+        self.assertEqual(sum(s for h,s in expected.itervalues()), fitManifest.getTotalSize())
+        self.assertRaises(KeyError, lambda: fitManifest['nope'])
+
+    def testChanges(self):
+        for compactMinChanges in (0, 4, 1000):
+            expected = dict(self.randomItems(8))
+            fitManifest = fitlib.FitManifest(expected)
+            fitManifest.compactMinChanges = compactMinChanges
+            for n in xrange(100):
+                p = random.choice(self.paths)
+                if p in expected and random.random() < 0.5:
+                    del expected[p]
+                    del fitManifest[p]
+                else:
+                    expected[p] = fitManifest[p] = ['%040x'%n, n]
+                copy = fitManifest.copy()
+                self.assertEqual(expected, copy)
+                self.assertEqual(len(expected), len(copy))
+                self.assertEqual(set(expected), set(p for p in self.paths if p in copy))
+                self.assertEqual(sum(s for h,s in expected.itervalues()), copy.getTotalSize())
+
+    def testSelect(self):
+        fitManifest = fitlib.FitManifest(self.randomItems(len(self.paths)))
+        del fitManifest['x/a']
+        fitManifest['x/y/d'] = ['0'*40, 0]
+        self.assertEqual({'x/b.png', 'x/c', 'x/y/a', 'x/y/b.png', 'x/y/c', 'x/y/d'}, set(fitManifest.select(['x'])))
+        self.assertEqual({'a', 'x/y/d', 'z/c'}, set(fitManifest.select(['x/y/d', 'z/c', 'a'])))
+        self.assertEqual(set(), set(fitManifest.select(['x/y/c/d', 'x/'])))
+
+    def testPathIndex(self):
+        fitManifest = fitlib.FitManifest(self.randomItems(8))
+        copy = fitManifest.copy()
+        index = copy.getPathIndex()
+        self.assertEqual(sorted(fitManifest), index.paths)
+        # Copies share the index until either one changes
+        self.assertIs(index, fitManifest.getPathIndex())
+        self.assertIs(index, fitManifest.copy().getPathIndex())
+        copy['x/y/d'] = ['0'*40, 0]
+        self.assertEqual(sorted(fitManifest) + ['x/y/d'], sorted(copy.getPathIndex().paths))
+        self.assertIs(index, fitManifest.getPathIndex())
+        copy['x/y/d'] = ['1'*40, 1]
+        del copy[list(fitManifest)[0]]
+        self.assertEqual(sorted(copy), copy.getPathIndex().paths)
+        copy._compact()
+        self.assertEqual(sorted(copy), copy.getPathIndex().paths)
+
+    def testDiff(self):
+        for n in xrange(50):
+            old, new = dict(self.randomItems(10)), dict(self.randomItems(10))
+            for p in random.sample(self.paths, 5):
+                if p in old and p in new:
+                    new[p] = list(old[p])
+            self.assertEqual(merge.fitDiff(old, new), merge.fitDiff(fitlib.FitManifest(old), fitlib.FitManifest(new)))
+
+    def testState(self):
+        fitManifest = fitlib.FitManifest(self.randomItems(10))
+        fitManifest['new'] = ['0'*40, 0]
+        state = marshal.loads(marshal.dumps(fitManifest.getState()))
+        self.assertEqual(fitManifest, fitlib.FitManifest.fromState(state))
@@ -0,0 +1,76 @@
+import unittest
+
+from fitlib import materialize
+from tempfile import mkdtemp
+from os import path, stat, chmod, rename, getuid
+from shutil import rmtree
+import stat as statmode
+
+class TestHardlinkMode(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.cached = self.makeFile('cached', 'cached contents')
+        chmod(self.cached, 0644)
+        materialize._state.clear()
+        materialize._state['mode'] = 'hardlink'
+
+    def tearDown(self):
+        materialize._state.clear()
+        rmtree(self.dir)
+
+    def makeFile(self, name, content):
+        filePath = path.join(self.dir, name)
+        fileOut = open(filePath, 'wb')
+        fileOut.write(content)
+        fileOut.close()
+        return filePath
+
+    def read(self, filePath):
+        return open(filePath, 'rb').read()
+
+    def isWritable(self, filePath):
+        return bool(stat(filePath).st_mode & statmode.S_IWUSR)
+
+    def testEditingLinkedFile(self):
+        working = path.join(self.dir, 'working')
+        materialize.materialize(self.cached, working)
+        self.assertEqual(stat(self.cached).st_ino, stat(working).st_ino)
+        self.assertFalse(self.isWritable(working))
+        if getuid() != 0:
+            self.assertRaises(IOError, open, working, 'r+b')
+
+        # Editors replace the file rather than write over it
+        rename(self.makeFile('edited', 'edited contents'), working)
+        self.assertEqual('cached contents', self.read(self.cached))
+        self.assertFalse(self.isWritable(self.cached))
+
+    def testIngestCopies(self):
+        working = self.makeFile('saved', 'saved contents')
+        materialize.ingest(working, path.join(self.dir, 'object'))
+        self.assertNotEqual(stat(working).st_ino, stat(path.join(self.dir, 'object')).st_ino)
+        self.assertTrue(self.isWritable(working))
+
+        fileOut = open(working, 'r+b')
+        fileOut.write('edited')
+        fileOut.close()
+        self.assertEqual('saved contents', self.read(path.join(self.dir, 'object')))
+
+    def testFallsBackWhenLinkFails(self):
+        def failingLink(src, dst):
+            raise OSError(18, 'Invalid cross-device link')
+        link = materialize.link
+        materialize.link = failingLink
+        try:
+            working = path.join(self.dir, 'working')
+            materialize.materialize(self.cached, working)
+        finally:
+            materialize.link = link
+
+        # A reflink or a copy, which can be edited in place
+        self.assertNotEqual(stat(self.cached).st_ino, stat(working).st_ino)
+        self.assertTrue(self.isWritable(working))
+        fileOut = open(working, 'r+b')
+        fileOut.write('edited')
+        fileOut.close()
+        self.assertEqual('cached contents', self.read(self.cached))
+        self.assertEqual(0644, stat(self.cached).st_mode & 0777)
@@ -1,8 +1,13 @@
 
 import unittest
+import random
 
+import fitlib
 from fitlib import merge
 from uuid import uuid4 as uid
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import path, listdir
 
 def getRandomDict(numItems = 1):
     return {u.hex: u.int for u in [uid() for i in range(numItems)]}
@@ -116,6 +121,81 @@ class TestGetMergedFit(unittest.TestCase):
 
         self.merge(common, mine, other, expected)
 
+class TestIterMergedFit(unittest.TestCase):
+    def setUp(self):
+        self.longMessage = True
+
+    def merge(self, common, mine, other):
+        expected = merge.getMergedFit(dict(common), dict(mine), dict(other))
+        expectedConflicts = expected[4] or {'add': set(), 'mod': set(), 'modRem': set(), 'remMod': set()}
+
+        sortKey = fitlib.fitSortKey
+        conflicts = {'add': set(), 'mod': set(), 'modRem': set(), 'remMod': set()}
+        fitItems = [sorted(d.iteritems(), key=lambda i: sortKey(i[0])) for d in (common, mine, other)]
+        actual = list(merge.iterMergedFit(fitItems[0], fitItems[1], fitItems[2], sortKey, conflicts))
+
+        self.assertEqual(sorted(expected[0].iteritems(), key=lambda i: sortKey(i[0])), actual, '\n\nerror: "merged" not as expected')
+        self.assertEqual(expectedConflicts, conflicts, '\n\nerror: conflicts not as expected')
+
+    def testSomeOfEach(self):
+        common = getStandardDict(10)
+        mine =  {'a': 1, 'b': 1, 'k': 11, 'd': 3, 'e': 5, 'l': 12, 'g': 7, 'h': 7, 'n': 13, 'i': 8}
+        other = {'a': 1, 'b': 1, 'k': 11, 'd': 4, 'e': 4, 'm': 13, 'f': 6, 'h': 9, 'n': 15, 'j': 9}
+        self.merge(common, mine, other)
+
+    def testRandomChanges(self):
+        paths = ['%s/%s'%(d, f) for d in ('x', 'x/y', 'z') for f in 'abcdef'] + list('abcdef')
+        for n in xrange(200):
+            common = {p:random.randint(1, 3) for p in random.sample(paths, 15)}
+            mine = {p:random.randint(1, 3) for p in random.sample(paths, 15)}
+            other = {p:random.randint(1, 3) for p in random.sample(paths, 15)}
+            self.merge(common, mine, other)
+
+    def testUnsorted(self):
+        conflicts = {'add': set(), 'mod': set(), 'modRem': set(), 'remMod': set()}
+        merged = merge.iterMergedFit([], [('b', 1), ('a', 1)], [], fitlib.fitSortKey, conflicts)
+        self.assertRaises(merge.UnsortedFitItems, list, merged)
+
+class TestMergeDriver(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def makeFile(self, name, content):
+        filePath = path.join(self.dir, name)
+        fileOut = open(filePath, 'wb')
+        fileOut.write(content)
+        fileOut.close()
+        return filePath
+
+    def openFiles(self):
+        fds = [path.join('/proc/self/fd', f) for f in listdir('/proc/self/fd')]
+        return [f for f in (path.realpath(f) for f in fds) if f.startswith(self.dir)]
+
+    def testUnsortedFallsBack(self):
+        a, b, c = ('a.png:[%s,1]'%('1'*40), 'b.png:[%s,2]'%('2'*40), 'c.png:[%s,3]'%('3'*40))
+        common = self.makeFile('common', a+',\n'+b+'\n')
+        mine = self.makeFile('mine', b+',\n'+a+'\n')
+        other = self.makeFile('other', a+',\n'+b+',\n'+c+'\n')
+
+        # Nothing of the streaming merge is left open when merging in memory
+        openFiles = []
+        writeFitFile = merge.writeFitFile
+        def recordingWriteFitFile(fitData, filePath):
+            openFiles.extend(self.openFiles())
+            writeFitFile(fitData, filePath)
+        merge.writeFitFile = recordingWriteFitFile
+        try:
+            self.assertTrue(merge.mergeDriver(common, mine, other))
+        finally:
+            merge.writeFitFile = writeFitFile
+
+        self.assertEqual([], openFiles)
+        self.assertEqual(['common', 'mine', 'other'], sorted(listdir(self.dir)))
+        self.assertEqual({'a.png': ['1'*40, 1], 'b.png': ['2'*40, 2], 'c.png': ['3'*40, 3]}, fitlib.readFitFile(mine))
+
 '''
 class TestResolve(unittest.TestCase):
     def setUp(self):
@@ -1,2 +1,50 @@
 import unittest
 
+from fitlib import objects
+
+class TestCheckTransferred(unittest.TestCase):
+    def testOneResultPerObject(self):
+        self.assertEqual([True, False], objects._checkTransferred(iter([True, False]), ['a', 'b']))
+
+    def testMissingResults(self):
+        self.assertRaises(Exception, objects._checkTransferred, [True], ['a', 'b'])
+
+class TestGetRecentBranches(unittest.TestCase):
+    def testNone(self):
+        popen = objects.popen
+        objects.popen = None
+        try:
+            self.assertEqual([], objects._getRecentBranches(0))
+        finally:
+            objects.popen = popen
+
+class FailingStore(object):
+    def checkMany(self, keys):
+        raise Exception('store is down')
+
+class TestCheckAndTransfer(unittest.TestCase):
+    def testCheckFailed(self):
+        failures = []
+        transferred = []
+        items = [('a.png', '1'*40, 10), ('b.png', '2'*40, 20)]
+        objects._checkAndTransfer(items, [FailingStore()], lambda store, batch: transferred.append(batch), lambda i,k: True, objects._QuietProgressPrinter(), failures)
+        self.assertEqual(['a.png (store is down)', 'b.png (store is down)'], failures)
+        self.assertEqual([], transferred)
+
+class TestWorkers(unittest.TestCase):
+    def testFailedBatch(self):
+        from Queue import Queue
+        done = []
+        failures = []
+        def work(store, batch):
+            if batch[0][0] == 'bad.png':
+                raise OSError(2, 'No such file or directory')
+            done.append(batch)
+
+        queue = Queue()
+        queue.put([('bad.png', '1'*40, 10), ('also.png', '2'*40, 20)])
+        queue.put([('good.png', '3'*40, 30)])
+        queue.put(None)
+        objects._waitWorkers(objects._startWorkers([None], work, queue, objects._QuietProgressPrinter(), failures))
+        self.assertEqual([[('good.png', '3'*40, 30)]], done)
+        self.assertEqual(['bad.png ([Errno 2] No such file or directory)', 'also.png ([Errno 2] No such file or directory)'], failures)
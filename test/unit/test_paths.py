@@ -1,2 +1,90 @@
 import unittest
 
+from fitlib.paths import PathIndex, Pathspec, getValidFitPaths, getPathPrefixes
+
+available = [
+    'a.bin',
+    'textures/a.dds',
+    'textures/b.png',
+    'textures/lvl/c.dds',
+    'textures/lvl/deep/d.dds',
+    'textures-old/e.dds',
+    'texturesX',
+    'models/Tree.obj',
+]
+
+class TestPathIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = PathIndex(available)
+
+    def testUnder(self):
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, set(self.index.under('textures/lvl')))
+        self.assertEqual({'a.bin'}, set(self.index.under('a.bin')))
+        self.assertEqual(set(available), set(self.index.under('')))
+        self.assertEqual([], self.index.under('textures/lv'))
+
+    def testStartingWith(self):
+        self.assertEqual(['textures-old/e.dds', 'textures/a.dds', 'textures/b.png', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds', 'texturesX'], self.index.startingWith('textures'))
+
+class TestGetValidFitPaths(unittest.TestCase):
+    def select(self, *given, **k):
+        return getValidFitPaths(list(given), available, basePath='/repo', workingDir=k.get('workingDir', '/repo'))
+
+    def testDirectory(self):
+        self.assertEqual({'textures/a.dds', 'textures/b.png', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select('textures'))
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select('lvl', workingDir='/repo/textures'))
+        self.assertEqual(set(available), self.select('.'))
+
+    def testNothingSelected(self):
+        self.assertEqual(None, self.select())
+        self.assertEqual(set(), self.select('textures/lv'))
+        self.assertEqual(set(), self.select('../elsewhere'))
+
+    def testWildcards(self):
+        # Without the glob magic, wildcards match across directories, like with git
+        self.assertEqual({'textures/a.dds', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select('textures/*.dds'))
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select('textures/**/*.dds'))
+        self.assertEqual({'textures/a.dds', 'textures/b.png'}, self.select('textures/[ab].*'))
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select('*.dds', workingDir='/repo/textures/lvl/deep/..'))
+
+    def testGlobMagic(self):
+        self.assertEqual({'textures/a.dds'}, self.select(':(glob)textures/*.dds'))
+        self.assertEqual({'textures/a.dds', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select(':(glob)textures/**/*.dds'))
+        self.assertEqual({'textures/a.dds', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds', 'textures-old/e.dds'}, self.select(':(glob)**/*.dds'))
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, self.select(':(glob)textures/lvl/**'))
+        self.assertEqual({'textures/b.png'}, self.select(':(glob)textures/[!a].*'))
+
+    def testOtherMagic(self):
+        self.assertEqual({'textures/a.dds'}, self.select(':(literal)textures/a.dds'))
+        self.assertEqual(set(), self.select(':(literal)textures/*.dds'))
+        self.assertEqual({'models/Tree.obj'}, self.select(':(icase)MODELS/tree.OBJ'))
+        self.assertEqual({'models/Tree.obj'}, self.select(':/models', workingDir='/repo/textures'))
+        self.assertEqual({'textures/b.png'}, self.select('textures', ':!*.dds'))
+        self.assertEqual(set(available) - {'a.bin'}, self.select(':^a.bin'))
+        self.assertRaises(Exception, self.select, ':(bogus)textures')
+
+    def testOthers(self):
+        index = PathIndex(available[:4])
+        others = set(available[4:])
+        self.assertEqual({'textures/a.dds', 'textures/b.png', 'textures/lvl/c.dds', 'textures/lvl/deep/d.dds'}, getValidFitPaths(['textures'], index, others=others))
+        self.assertEqual({'textures/lvl/c.dds', 'textures/lvl/deep/d.dds', 'textures-old/e.dds'}, getValidFitPaths(['*.dds', ':!textures/a.dds'], index, others=others))
+        self.assertEqual(set(available) - {'a.bin'}, getValidFitPaths([':^a.bin'], index, others=others))
+
+class TestGetPathPrefixes(unittest.TestCase):
+    def prefixes(self, *given, **k):
+        return getPathPrefixes(list(given), basePath='/repo', workingDir=k.get('workingDir', '/repo'))
+
+    def testPrefixes(self):
+        self.assertEqual(['models', 'textures/lvl'], self.prefixes('textures/lvl', 'models/*.obj', ':!a.bin'))
+        self.assertEqual(['textures/lvl'], self.prefixes(':(glob)**/*.dds', workingDir='/repo/textures/lvl'))
+        self.assertEqual([], self.prefixes('../elsewhere'))
+        self.assertEqual(None, self.prefixes('textures', '*.dds'))
+        self.assertEqual(None, self.prefixes(':!a.bin'))
+        self.assertEqual(None, self.prefixes(':(icase)textures'))
+
+    def testPathspec(self):
+        s = Pathspec('lvl/**/*.dds', basePath='/repo', workingDir='/repo/textures')
+        self.assertEqual('textures/lvl/**/*.dds', s.path)
+        self.assertEqual('textures/lvl', s.getLeadingDir())
+        self.assertTrue(s.matches('textures/lvl/deep/d.dds'))
+        self.assertFalse(s.matches('textures/lvl/c.dds'))